@@ -0,0 +1,131 @@
+"""
+Compares memory usage and speed of syncset operations for different member implementations.
+Run with: python demo/benchmark.py [number of members]
+"""
+import csv
+import gc
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import date, timedelta
+
+import syncset
+from syncset.fsscan import FileMember, scan_tree
+
+
+class SyncURL(syncset.SyncSetMember):
+    """
+    A regular SyncSetMember subclass, like the one in demo/urlsync.py
+    """
+    def __init__(self, url, last_modified):
+        self.url = url
+        self.last_modified = last_modified
+
+    def get_id(self):
+        return self.url
+
+    def get_changekey(self):
+        return self.last_modified
+
+
+SlotsSyncURL = syncset.member_type('SlotsSyncURL', id='url', changekey='last_modified')
+
+
+def make_rows(n, offset=0):
+    start = date(2012, 1, 1)
+    return [('http://example.com/page/%s.html' % i, start + timedelta(days=(i + offset) % 1000)) for i in range(n)]
+
+
+def measure_memory(factory, rows):
+    # Allocate the list up front so only the members themselves are measured
+    members = [None] * len(rows)
+    gc.collect()
+    tracemalloc.start()
+    for i, (url, last_modified) in enumerate(rows):
+        members[i] = factory(url, last_modified)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del members
+    return size
+
+
+def measure_time(func, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def bench_member_types(n):
+    rows, other_rows = make_rows(n), make_rows(n, offset=n // 10 or 1)
+    print('%d members' % n)
+    print('%-14s %16s %10s %10s' % ('member type', 'bytes/member', 'add() s', 'diff() s'))
+    for factory in (SyncURL, SlotsSyncURL):
+        # The url strings and dates are created up front and shared by both member types
+        memory = measure_memory(factory, rows) / n
+        members = [factory(*row) for row in rows]
+        other = syncset.TwoWaySyncSet(factory(*row) for row in other_rows)
+        add_time = measure_time(lambda: syncset.TwoWaySyncSet(members))
+        mine = syncset.TwoWaySyncSet(members)
+        diff_time = measure_time(lambda: mine.diff(other))
+        print('%-14s %16.1f %10.3f %10.3f' % (factory.__name__, memory, add_time, diff_time))
+
+
+def bench_loaders(n):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'pages.csv')
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['url', 'last_modified'])
+            writer.writerows((url, last_modified.isoformat()) for url, last_modified in make_rows(n))
+
+        def naive():
+            items = syncset.OneWaySyncSet()
+            with open(path, newline='') as f:
+                for row in csv.DictReader(f):
+                    items.add(SyncURL(row['url'], date.fromisoformat(row['last_modified'])))
+
+        def loader():
+            syncset.OneWaySyncSet.from_csv(path, 'url', 'last_modified', changekey_type=date.fromisoformat)
+
+        print('%-14s %10s' % ('CSV loader', 'load s'))
+        for name, func in (('naive loop', naive), ('from_csv()', loader)):
+            print('%-14s %10.3f' % (name, measure_time(func)))
+
+
+def bench_scan(n):
+    def make_tree(root, dirs, files_per_dir):
+        for i in range(dirs):
+            path = os.path.join(root, str(i % 100), str(i))
+            os.makedirs(path)
+            for j in range(files_per_dir):
+                open(os.path.join(path, '%s.txt' % j), 'w').close()
+
+    def naive(root):
+        items = syncset.OneWaySyncSet()
+        for path, _, names in os.walk(root):
+            rel_path = os.path.relpath(path, root).replace(os.sep, '/')
+            for name in names:
+                st = os.stat(os.path.join(path, name))
+                item_id = name if rel_path == '.' else rel_path + '/' + name
+                items.add(FileMember(item_id, (st.st_mtime_ns, st.st_size), st.st_size, st.st_mtime_ns, st.st_ino))
+        return items
+
+    print('%-22s %10s %10s' % ('file tree', 'os.walk s', 'scan s'))
+    for dirs, files_per_dir in ((n, 1), (max(n // 1000, 1), 1000)):
+        with tempfile.TemporaryDirectory() as root:
+            make_tree(root, dirs, files_per_dir)
+            print('%-22s %10.3f %10.3f' % ('%d dirs x %d files' % (dirs, files_per_dir),
+                                           measure_time(lambda: naive(root)), measure_time(lambda: scan_tree(root))))
+
+
+if __name__ == '__main__':
+    members = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    bench_member_types(members)
+    bench_loaders(members)
+    bench_scan(members)
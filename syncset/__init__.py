@@ -1,15 +1,359 @@
 import abc
+import keyword
 import logging
+import pickle
+import sys
+import threading
+import time
+from collections import OrderedDict, deque, namedtuple
+from itertools import count, islice
 
 __version__ = '2.0.0'
 
 log = logging.getLogger(__name__)
 
+# Mutation versions are unique across all syncsets, so a syncset at a version is never mistaken for
+# another syncset that reuses its id() after it has been garbage-collected
+_next_version = count(1).__next__
+
 
 class UndefinedBehaviorError(ArithmeticError):
     pass
 
 
+Tombstone = namedtuple('Tombstone', ('changekey', 'deleted_at'))
+
+
+class Tombstones:
+    """
+    Remembers the id and changekey of deleted syncset members, so a deletion can be told apart
+    from a member that was never seen. Assign an instance to the ``tombstones`` attribute of a
+    syncset to enable it.
+
+    To not grow without bounds in long-running processes, tombstones are evicted oldest-first
+    when they are older than ``ttl`` seconds or when there are more than ``max_count`` of them.
+    Entries are kept in deletion order, so eviction only ever looks at the oldest entries.
+    """
+    def __init__(self, ttl=None, max_count=None, clock=time.monotonic):
+        self.ttl = ttl
+        self.max_count = max_count
+        self.clock = clock
+        # id -> (changekey, deleted_at) in deletion order, and the same (id, entry) pairs in a
+        # queue for eviction. Popping the oldest key of a dict gets slower as deleted slots pile
+        # up at its front, so the queue is used instead. Pairs whose entry has been replaced or
+        # discarded are skipped, and dropped when the queue is compacted.
+        self._entries = {}
+        self._queue = deque()
+        self._lock = threading.RLock()
+
+    def add(self, item_id, changekey):
+        """
+        Record that the member with this id and changekey was deleted
+        """
+        with self._lock:
+            entry = (changekey, self.clock())
+            self._entries.pop(item_id, None)
+            self._entries[item_id] = entry
+            self._queue.append((item_id, entry))
+            if len(self._queue) > 2 * len(self._entries) + 64:
+                self._queue = deque(self._entries.items())
+            self.evict()
+
+    def get(self, item_id, default=None):
+        """
+        Return the ``Tombstone`` for this id, if any
+        """
+        with self._lock:
+            self.evict()
+            entry = self._entries.get(item_id)
+        return default if entry is None else Tombstone(*entry)
+
+    def discard(self, item_id):
+        with self._lock:
+            self._entries.pop(item_id, None)
+
+    def _pop_oldest(self):
+        entries, queue = self._entries, self._queue
+        while True:
+            item_id, entry = queue.popleft()
+            if entries.get(item_id) is entry:
+                del entries[item_id]
+                return
+
+    def evict(self):
+        """
+        Drop expired tombstones and tombstones exceeding ``max_count``
+        """
+        entries, queue = self._entries, self._queue
+        with self._lock:
+            if self.ttl is not None:
+                expired_before = self.clock() - self.ttl
+                while queue and queue[0][1][1] <= expired_before:
+                    item_id, entry = queue.popleft()
+                    if entries.get(item_id) is entry:
+                        del entries[item_id]
+            if self.max_count is not None:
+                while len(entries) > self.max_count:
+                    self._pop_oldest()
+
+    def items(self):
+        """
+        Return (id, ``Tombstone``) pairs, oldest first
+        """
+        with self._lock:
+            self.evict()
+            return [(item_id, Tombstone(*entry)) for item_id, entry in self._entries.items()]
+
+    def __contains__(self, item_id):
+        with self._lock:
+            self.evict()
+            return item_id in self._entries
+
+    def __len__(self):
+        self.evict()
+        return len(self._entries)
+
+    def __iter__(self):
+        self.evict()
+        return iter(self._entries)
+
+
+class DiffCache:
+    """
+    Remembers the results of the last ``maxsize`` calls to ``diff()``, keyed on both syncsets and
+    their mutation ``version``. Assign an instance to the ``diff_cache`` attribute of a syncset, or
+    of a syncset class, to enable it. A cached result is returned until either syncset is mutated.
+
+    Results are copied on the way in and out, so callers may modify them freely. Diffs with slice
+    arguments, and diffs where either side has ``tombstones``, are not cached, because tombstones
+    change and expire without mutating the syncset. Members must not be changed in place, which
+    would not be noticed.
+
+    ``hits`` and ``misses`` count cached and computed diffs. Call ``invalidate()`` to drop the
+    results involving a syncset, or ``clear()`` to drop all results.
+    """
+    def __init__(self, maxsize=16):
+        if maxsize < 1:
+            raise ValueError("'maxsize' must be positive")
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._results = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, syncset, other, diff_func):
+        """
+        Return the cached result of diffing ``syncset`` against ``other``, or call
+        ``diff_func(other)`` and cache its result
+        """
+        if syncset.tombstones is not None or getattr(other, 'tombstones', None) is not None \
+                or not isinstance(other, BaseSyncSet):
+            return diff_func(other)
+        key = syncset._version_key() + other._version_key()
+        with self._lock:
+            result = self._results.get(key)
+            if result is not None:
+                self._results.move_to_end(key)
+                self.hits += 1
+        if result is None:
+            result = tuple(items.copy() for items in diff_func(other))
+            with self._lock:
+                self.misses += 1
+                self._results[key] = result
+                while len(self._results) > self.maxsize:
+                    self._results.popitem(last=False)
+        return tuple(items.copy() for items in result)
+
+    def invalidate(self, syncset):
+        """
+        Drop all results involving ``syncset``
+        """
+        syncset_id = syncset._version_key()[0]
+        with self._lock:
+            for key in [key for key in self._results if syncset_id in (key[0], key[2])]:
+                del self._results[key]
+
+    def clear(self):
+        with self._lock:
+            self._results.clear()
+
+    @property
+    def hit_rate(self):
+        """
+        The share of lookups that were cache hits, or 0.0 if there were none
+        """
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def __len__(self):
+        return len(self._results)
+
+
+DeltaRecord = namedtuple('DeltaRecord', ('id', 'changekey', 'payload'))
+
+
+class Delta:
+    """
+    A compact description of the changes between two syncsets: a list of deleted ids, and lists
+    of updated and new ``DeltaRecord`` (id, changekey, payload) tuples. Create one with
+    ``delta()`` on a syncset and apply it to another with ``apply_delta()``.
+
+    Deltas can be serialized with ``to_bytes()`` and ``from_bytes()``. The format is based on
+    ``pickle``, so only load deltas from trusted sources. Adding two deltas returns a new delta
+    with the effect of applying the first and then the second, with changes to the same id
+    coalesced into one.
+    """
+    # Bump if the serialization format changes
+    format_version = 1
+
+    def __init__(self, deleted=(), updated=(), new=()):
+        self.deleted = list(deleted)
+        self.updated = [DeltaRecord(*r) for r in updated]
+        self.new = [DeltaRecord(*r) for r in new]
+
+    def _ops(self):
+        ops = OrderedDict()
+        for item_id in self.deleted:
+            ops[item_id] = ('deleted', None)
+        for record in self.updated:
+            ops[record.id] = ('updated', record)
+        for record in self.new:
+            ops[record.id] = ('new', record)
+        return ops
+
+    def __add__(self, other):
+        ops = self._ops()
+        for item_id, (kind, record) in other._ops().items():
+            previous_kind, _ = ops.pop(item_id, (None, None))
+            if previous_kind == 'new':
+                # The member didn't exist before self, so the combined change is either a
+                # new member or nothing at all.
+                if kind != 'deleted':
+                    ops[item_id] = ('new', record)
+            elif previous_kind is not None and kind == 'new':
+                # The member existed before self, so re-creating it is an update
+                ops[item_id] = ('updated', record)
+            else:
+                ops[item_id] = (kind, record)
+        delta = self.__class__()
+        for item_id, (kind, record) in ops.items():
+            if kind == 'deleted':
+                delta.deleted.append(item_id)
+            else:
+                getattr(delta, kind).append(record)
+        return delta
+
+    def __len__(self):
+        return len(self.deleted) + len(self.updated) + len(self.new)
+
+    def __eq__(self, other):
+        if not isinstance(other, Delta):
+            return NotImplemented
+        return (self.deleted, self.updated, self.new) == (other.deleted, other.updated, other.new)
+
+    def __repr__(self):
+        return '%s(deleted=%r, updated=%r, new=%r)' % (self.__class__.__name__, self.deleted, self.updated, self.new)
+
+    def to_bytes(self):
+        return pickle.dumps(
+            (self.format_version, self.deleted, [tuple(r) for r in self.updated], [tuple(r) for r in self.new]),
+            protocol=pickle.HIGHEST_PROTOCOL,
+        )
+
+    @classmethod
+    def from_bytes(cls, data):
+        format_version, deleted, updated, new = pickle.loads(data)
+        if format_version != cls.format_version:
+            raise ValueError('Unsupported delta format version %r' % format_version)
+        return cls(deleted=deleted, updated=updated, new=new)
+
+
+def _chunks(iterable, n):
+    if n < 1:
+        raise ValueError("'n' must be a positive integer")
+    iterator = iter(iterable)
+
+    def gen():
+        while True:
+            chunk = tuple(islice(iterator, n))
+            if not chunk:
+                return
+            yield chunk
+    return gen()
+
+
+DiffEstimate = namedtuple(
+    'DiffEstimate', ('only_in_self', 'only_in_other', 'changed_in_self', 'changed_in_other', 'sample_rate')
+)
+
+
+def _in_sample(item_id, level):
+    """
+    Consistent hash sampling. An id is in the sample at ``level`` if the top ``level`` bits of its
+    scrambled hash are zero, so each level is a subset of the levels below it.
+    """
+    if level == 0:
+        return True
+    return ((hash(item_id) * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF) >> (64 - level) == 0
+
+
+class _MemberIndex:
+    """
+    A secondary index of syncset members by the result of ``key_func(member)``. Members with a
+    key of ``None`` are not indexed.
+    """
+    __slots__ = ('key_func', 'unique', 'entries')
+
+    def __init__(self, key_func, unique):
+        self.key_func = key_func
+        self.unique = unique
+        # Key -> dict of members by id
+        self.entries = {}
+
+    def add(self, item_id, item):
+        key = self.key_func(item)
+        if key is not None:
+            self.entries.setdefault(key, {})[item_id] = item
+
+    def remove(self, item_id, item):
+        key = self.key_func(item)
+        members = self.entries.get(key)
+        if members is not None:
+            members.pop(item_id, None)
+            if not members:
+                del self.entries[key]
+
+    def check(self, item_id, item, name):
+        """
+        Raise ``ValueError`` if the index is unique and has another member with the same key
+        """
+        if not self.unique:
+            return
+        key = self.key_func(item)
+        for other_id in self.entries.get(key, ()):
+            if other_id != item_id:
+                raise ValueError('Member %r has the same key %r in unique index %r as member %r'
+                                 % (item_id, key, name, other_id))
+
+
+def _as_id(item):
+    """
+    Return the id of a member, or the value itself if it is not a member
+    """
+    get_id = getattr(item, 'get_id', None)
+    return item if get_id is None else get_id()
+
+
+def _ids_of(items):
+    """
+    Return a container supporting fast membership tests on the ids of ``items``. Syncsets
+    already have one, so only plain iterables need to be materialized.
+    """
+    if isinstance(items, BaseSyncSet):
+        return items.item_dict
+    return {item.get_id() for item in items}
+
+
 class BaseSyncSet(set):
     """
     An extension of ``set()`` which, in addition to the usual membership
@@ -35,30 +379,63 @@ class BaseSyncSet(set):
     ``OneWaySyncSet`` and ``TwoWaySyncSet`` instead.
     """
     __metaclass__ = abc.ABCMeta
+    tombstones = None
+    # Consistent hash samples by level, used by diff_estimate()
+    _samples = None
+    # Ordered index of ids, used for range and prefix queries
+    _id_index = None
+    # Secondary indexes by name, see create_index()
+    _indexes = None
+    # See DiffCache
+    diff_cache = None
 
     def __init__(self, iterable=None):
         super().__init__()
         self.item_dict = dict()
+        # Changed by every mutation, see DiffCache
+        self.version = _next_version()
         # Make sure items enter the syncset the way we want by using the add() method.
         if iterable:
             self.update(iterable)
 
+    @classmethod
+    def _from_item_dict(cls, item_dict):
+        """
+        Create a syncset from a dict of members by id which is already consistent, without
+        going through add() for each member.
+        """
+        items = cls()
+        items.item_dict = dict(item_dict)
+        set.update(items, items.item_dict.values())
+        return items
+
     def copy(self):
         """
         Return a copy of self
         """
-        return self.__class__(self.item_dict.values())
+        return self._from_item_dict(self.item_dict)
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        # Versions are only unique within a process
+        self.version = _next_version()
+
+    def _version_key(self):
+        """
+        Return the (id, version) pair identifying the current contents of self, see ``DiffCache``
+        """
+        return id(self), self.version
 
     def sync(self, deleted, updated, new):
         """
-        Update syncset with changes in-place
+        Update syncset with changes in-place. ``deleted`` may contain members or plain ids.
         """
-        self.difference_update(deleted)
+        self.discard_ids(_as_id(item) for item in deleted)
         self.symmetric_difference_update(updated)
         self.update(new)
 
     @abc.abstractmethod
-    def diff(self, other):
+    def diff(self, other, ids=None, id_range=None, prefix=None, where=None):
         raise NotImplementedError()
 
     @abc.abstractmethod
@@ -94,6 +471,13 @@ class BaseSyncSet(set):
     def get(self, item_id, default=None):
         return self.item_dict.get(item_id, default)
 
+    def _peek(self, item_id):
+        """
+        Get an object by id like ``[]``, for lookups by diffs and set operations which must not
+        count as a use of the member
+        """
+        return self[item_id]
+
     def __ior__(self, *others):
         """
         The |= operator. Alias for ``update()``
@@ -120,8 +504,11 @@ class BaseSyncSet(set):
         Update the set, keeping only elements found in it and all ``others``.
         """
         for other in others:
-            for item in self.difference(other):
-                self.remove(item)
+            other_ids = _ids_of(other)
+            # Only collect the ids to remove. We can't remove while iterating item_dict
+            outdated = [item_id for item_id in self.item_dict if item_id not in other_ids]
+            for item_id in outdated:
+                self.remove(self.item_dict[item_id])
         return self
 
     def __isub__(self, *others):
@@ -149,18 +536,41 @@ class BaseSyncSet(set):
         """
         Update the syncset, keeping only elements found in either set, but not in both.
         """
-        # We need to calculate in two steps. Otherwise, intersection() will impact difference()
-        in_common = self.intersection(other)
-        only_in_other = other.difference(self)
-        for item in in_common:
-            self.remove(item)
-        for item in only_in_other:
-            self.add(item)
+        if other is self:
+            self.clear()
+            return self
+        # Mutate in a single pass over other. Members of other have unique ids, so an item added
+        # in this loop can never be hit by a later iteration and be removed again.
+        item_dict = self.item_dict
+        for item in other:
+            existing_item = item_dict.get(item.get_id())
+            if existing_item is None:
+                self.add(item)
+            else:
+                self.remove(existing_item)
         return self
 
-    def remove(self, item):
-        del self.item_dict[item.get_id()]
+    def remove(self, item, tombstone=False):
+        """
+        Remove item. With ``tombstone=True``, the id and changekey of the removed member is
+        recorded in ``tombstones``.
+        """
+        item_id = item.get_id()
+        if tombstone:
+            if self.tombstones is None:
+                raise ValueError('Tombstones are not enabled on this syncset')
+            self.tombstones.add(item_id, self.item_dict[item_id].get_changekey())
+        if self._indexes is not None:
+            stored_item = self.item_dict[item_id]
+            for index in self._indexes.values():
+                index.remove(item_id, stored_item)
+        del self.item_dict[item_id]
         super().remove(item)
+        self.version = _next_version()
+        if self._samples is not None:
+            self._unsample(item_id)
+        if self._id_index is not None:
+            self._id_index.remove(item_id)
 
     def __delitem__(self, item):
         """
@@ -168,18 +578,338 @@ class BaseSyncSet(set):
         """
         return self.remove(item)
 
-    def discard(self, item):
+    def discard(self, item, tombstone=False):
         if item.get_id() in self.item_dict:
-            self.remove(item)
+            self.remove(item, tombstone=tombstone)
+
+    def discard_ids(self, ids, tombstone=False):
+        """
+        Remove the members with the given ids, if present. Works like ``discard()``, but on plain
+        ids, and removes the members in bulk.
+        """
+        self._remove_many(self.item_dict.keys() & set(ids), tombstone=tombstone)
+
+    def remove_ids(self, ids, tombstone=False):
+        """
+        Remove the members with the given ids. Raises ``KeyError`` without removing anything if
+        any of the ids is not present.
+        """
+        ids = set(ids)
+        missing = ids - self.item_dict.keys()
+        if missing:
+            raise KeyError(next(iter(missing)))
+        self._remove_many(ids, tombstone=tombstone)
+
+    def get_many(self, ids, default=None):
+        """
+        Return a list of the members with the given ids, with ``default`` for missing ids
+        """
+        if default is None:
+            return list(map(self.item_dict.get, ids))
+        get = self.item_dict.get
+        return [get(item_id, default) for item_id in ids]
+
+    def contains_ids(self, ids):
+        """
+        Return a list of booleans telling whether a member with each of the given ids is present
+        """
+        return list(map(self.item_dict.__contains__, ids))
+
+    def is_tombstoned(self, item):
+        """
+        Returns true if a member with the same id and the same or a newer changekey was deleted
+        """
+        if self.tombstones is None:
+            return False
+        tombstone = self.tombstones.get(item.get_id())
+        return tombstone is not None and tombstone.changekey >= item.get_changekey()
 
     def pop(self):
-        _, item = self.item_dict.popitem()
+        item_id, item = self.item_dict.popitem()
         super().remove(item)
+        self.version = _next_version()
+        if self._samples is not None:
+            self._unsample(item_id)
+        if self._id_index is not None:
+            self._id_index.remove(item_id)
+        if self._indexes is not None:
+            for index in self._indexes.values():
+                index.remove(item_id, item)
         return item
 
     def clear(self):
         self.item_dict.clear()
         super().clear()
+        self.version = _next_version()
+        if self._samples is not None:
+            for sample in self._samples.values():
+                sample.clear()
+        if self._id_index is not None:
+            self._id_index.clear()
+        if self._indexes is not None:
+            for index in self._indexes.values():
+                index.entries.clear()
+
+    def _store(self, item_id, item):
+        """
+        Insert an item whose id is not present. All insertions by subclasses go through here.
+        """
+        self.item_dict[item_id] = item
+        set.add(self, item)
+        self.version = _next_version()
+        if self._samples is not None:
+            for level, sample in self._samples.items():
+                if _in_sample(item_id, level):
+                    sample[item_id] = item
+        if self._id_index is not None:
+            self._id_index.add(item_id)
+        if self._indexes is not None:
+            for index in self._indexes.values():
+                index.add(item_id, item)
+
+    def _store_many(self, items):
+        """
+        Insert a dict of items by id, none of which are present
+        """
+        if self._indexes is not None:
+            # Check unique indexes up front, so a failing batch isn't half inserted
+            self._check_indexes_many(items)
+        self.item_dict.update(items)
+        set.update(self, items.values())
+        self.version = _next_version()
+        if self._samples is not None:
+            for item_id, item in items.items():
+                for level, sample in self._samples.items():
+                    if _in_sample(item_id, level):
+                        sample[item_id] = item
+        if self._id_index is not None:
+            self._id_index.update(items)
+        if self._indexes is not None:
+            for index in self._indexes.values():
+                for item_id, item in items.items():
+                    index.add(item_id, item)
+
+    def _remove_many(self, item_ids, tombstone=False):
+        """
+        Remove the members with the given ids, all of which must be present. All bulk removals
+        by id go through here.
+        """
+        if tombstone and self.tombstones is None:
+            raise ValueError('Tombstones are not enabled on this syncset')
+        item_ids = list(item_ids)
+        if not item_ids:
+            return
+        items = list(map(self.item_dict.pop, item_ids))
+        set.difference_update(self, items)
+        self.version = _next_version()
+        if tombstone:
+            for item_id, item in zip(item_ids, items):
+                self.tombstones.add(item_id, item.get_changekey())
+        if self._samples is not None:
+            for item_id in item_ids:
+                self._unsample(item_id)
+        if self._id_index is not None:
+            for item_id in item_ids:
+                self._id_index.remove(item_id)
+        if self._indexes is not None:
+            for index in self._indexes.values():
+                for item_id, item in zip(item_ids, items):
+                    index.remove(item_id, item)
+
+    def _add_many(self, items):
+        """
+        Add items with the same result as ``update()``, but insert members with new ids in bulk
+        """
+        if self.tombstones is not None:
+            return self.update(items)
+        item_dict = self.item_dict
+        fresh = {}
+        for item in items:
+            item_id = item.get_id()
+            if item_id in fresh:
+                # Let add() decide between duplicates
+                self._store_many(fresh)
+                fresh = {}
+            if item_id in item_dict:
+                self.add(item)
+            else:
+                fresh[item_id] = item
+        if fresh:
+            self._store_many(fresh)
+        return self
+
+    @classmethod
+    def from_csv(cls, path, id_col, changekey_col, **kwargs):
+        """
+        Create a syncset from a CSV file. See ``syncset.loaders.load_csv()``
+        """
+        from .loaders import load_csv
+        return load_csv(cls(), path, id_col, changekey_col, **kwargs)
+
+    @classmethod
+    def from_jsonl(cls, path, id_key, changekey_key, **kwargs):
+        """
+        Create a syncset from a JSON Lines file. See ``syncset.loaders.load_jsonl()``
+        """
+        from .loaders import load_jsonl
+        return load_jsonl(cls(), path, id_key, changekey_key, **kwargs)
+
+    @classmethod
+    def from_cursor(cls, cursor, id_col, changekey_col, **kwargs):
+        """
+        Create a syncset from the rows of an executed DB-API cursor. See ``syncset.loaders.load_cursor()``
+        """
+        from .loaders import load_cursor
+        return load_cursor(cls(), cursor, id_col, changekey_col, **kwargs)
+
+    def _unsample(self, item_id):
+        for sample in self._samples.values():
+            sample.pop(item_id, None)
+
+    def _sample(self, level):
+        """
+        Return the members whose id falls in the consistent hash sample at ``level``, i.e. a
+        sampling rate of 2 ** -level. Samples are built on first use and kept up to date on
+        mutation after that.
+        """
+        if level == 0:
+            return self.item_dict
+        if self._samples is None:
+            self._samples = {}
+        try:
+            return self._samples[level]
+        except KeyError:
+            pass
+        # Samples are nested, so build from a coarser sample if we have one
+        finer = [lvl for lvl in self._samples if lvl < level]
+        source = self._samples[max(finer)] if finer else self.item_dict
+        sample = {item_id: item for item_id, item in source.items() if _in_sample(item_id, level)}
+        self._samples[level] = sample
+        return sample
+
+    def create_index(self, name, key_func, unique=False):
+        """
+        Create an index of the members by ``key_func(member)``, for lookups with ``lookup()``.
+        Members with a key of ``None`` are not indexed. The index is maintained by all mutations
+        of the syncset, but not copied to copies of the syncset or to the syncsets returned by
+        its methods. With ``unique=True``, adding a member with the same key as a member with
+        another id raises ``ValueError``.
+        """
+        if self._indexes is None:
+            self._indexes = {}
+        if name in self._indexes:
+            raise ValueError('Index %r already exists' % name)
+        index = _MemberIndex(key_func, unique)
+        for item_id, item in self.item_dict.items():
+            index.check(item_id, item, name)
+            index.add(item_id, item)
+        self._indexes[name] = index
+
+    def drop_index(self, name):
+        if self._indexes is None or name not in self._indexes:
+            raise KeyError('No index named %r' % name)
+        del self._indexes[name]
+
+    def lookup(self, name, value):
+        """
+        Return a list of the members with the key ``value`` in the index ``name``
+        """
+        if self._indexes is None or name not in self._indexes:
+            raise KeyError('No index named %r' % name)
+        return list(self._indexes[name].entries.get(value, {}).values())
+
+    def _check_indexes(self, item_id, item):
+        for name, index in self._indexes.items():
+            index.check(item_id, item, name)
+
+    def _check_indexes_many(self, items):
+        for name, index in self._indexes.items():
+            if not index.unique:
+                continue
+            seen = {}
+            for item_id, item in items.items():
+                index.check(item_id, item, name)
+                key = index.key_func(item)
+                if key is not None and seen.setdefault(key, item_id) != item_id:
+                    raise ValueError('Member %r has the same key %r in unique index %r as member %r'
+                                     % (item_id, key, name, seen[key]))
+
+    def _ordered_ids(self):
+        """
+        Return the ordered index of ids, a ``syncset.sortedlist.SortedIdList``. The index is built
+        on first use and kept up to date on mutation after that. Ids must be totally ordered.
+        """
+        if self._id_index is None:
+            from .sortedlist import SortedIdList
+            self._id_index = SortedIdList(self.item_dict)
+        return self._id_index
+
+    def slice(self, ids=None, id_range=None, prefix=None, where=None):
+        """
+        Return a new syncset with the members matching all of the given conditions: the id is in
+        ``ids``, the id is in the half-open range ``id_range=(lo, hi)`` where ``None`` is
+        unbounded, the id starts with ``prefix``, and ``where(member)`` is true. Ranges and
+        prefixes are looked up in an ordered index of the ids (see ``_ordered_ids()``), so the cost
+        is proportional to the size of the slice. The slice shares ``tombstones`` with self.
+        """
+        item_dict = self.item_dict
+        checks = []
+        if id_range is not None:
+            lo, hi = id_range
+            checks.append(lambda i: (lo is None or lo <= i) and (hi is None or i < hi))
+        if prefix is not None:
+            n = len(prefix)
+            checks.append(lambda i: i[:n] == prefix)
+        if ids is not None:
+            candidates = (i for i in ids if i in item_dict)
+        elif prefix is not None:
+            candidates = self._ordered_ids().iprefix(prefix)
+            checks.pop()
+        elif id_range is not None:
+            candidates = self._ordered_ids().irange(*id_range)
+            checks.pop()
+        else:
+            candidates = item_dict
+        if checks:
+            candidates = (i for i in candidates if all(check(i) for check in checks))
+        items = {i: item_dict[i] for i in candidates}
+        if where is not None:
+            items = {i: item for i, item in items.items() if where(item)}
+        sliced = self._from_item_dict(items)
+        sliced.tombstones = self.tombstones
+        return sliced
+
+    def _sliced(self, other, ids, id_range, prefix, where):
+        """
+        Return self and other limited to a slice for ``diff()``, or None if no slice was requested
+        """
+        if ids is None and id_range is None and prefix is None and where is None:
+            return None
+        if ids is not None:
+            ids = list(ids)
+        return self.slice(ids, id_range, prefix, where), other.slice(ids, id_range, prefix, where)
+
+    def diff_estimate(self, other, error=0.01):
+        """
+        Estimate the sizes of the four syncsets returned by ``diff()`` without doing a full diff.
+        Both syncsets are sampled consistently by id hash, at a rate which gives about
+        ``1 / error ** 2`` samples from the larger syncset. The estimates are then within roughly
+        ``error`` times the size of the larger syncset. The samples are cached on each syncset
+        and maintained on mutation, so repeated estimates take time proportional to the sample
+        size, not the syncset size.
+        """
+        if not 0 < error < 1:
+            raise ValueError("'error' must be between 0 and 1")
+        target = 1 / error ** 2
+        level = 0
+        while max(len(self), len(other)) / 2 ** (level + 1) >= target and level < 64:
+            level += 1
+        self_sample = self._from_item_dict(self._sample(level))
+        self_sample.tombstones = self.tombstones
+        other_sample = other._from_item_dict(other._sample(level))
+        other_sample.tombstones = other.tombstones
+        scale = 2 ** level
+        return DiffEstimate(*(len(bucket) * scale for bucket in self_sample._diff(other_sample)), 1 / scale)
 
     def __ne__(self, other):
         """
@@ -284,6 +1014,53 @@ class BaseSyncSet(set):
         """
         return self.item_dict.keys()
 
+    def iter_chunks(self, n):
+        """
+        Iterate over the members of the syncset in tuples of at most ``n`` members, e.g. for bulk
+        API calls. Only one chunk is held in memory at a time.
+        """
+        return _chunks(self.item_dict.values(), n)
+
+    def iter_id_chunks(self, n):
+        """
+        Like ``iter_chunks()``, but yields tuples of ids without touching the members
+        """
+        return _chunks(self.item_dict.keys(), n)
+
+    def delta(self, other, payload=None):
+        """
+        Return a ``Delta`` with the changes that bring self up to date with ``other``, according
+        to the ``diff()`` semantics of this class. ``payload`` is called with each updated and
+        new member to get the payload to store in the delta. By default, the payload is the
+        member itself.
+        """
+        only_in_self, only_in_other, _, updated_in_other = self.diff(other)
+
+        def records(items):
+            return [DeltaRecord(i.get_id(), i.get_changekey(), payload(i) if payload else i) for i in items]
+
+        return Delta(
+            deleted=self._deleted_ids(other, only_in_self),
+            updated=records(updated_in_other),
+            new=records(only_in_other),
+        )
+
+    @abc.abstractmethod
+    def _deleted_ids(self, other, only_in_self):
+        raise NotImplementedError()
+
+    def apply_delta(self, delta, factory=None):
+        """
+        Apply the changes in ``delta`` in-place. ``factory`` is called with the id, changekey and
+        payload of updated and new records to create the member to add. By default, the payload
+        is expected to be the member itself.
+        """
+        self.discard_ids(delta.deleted)
+        for records in (delta.updated, delta.new):
+            for record in records:
+                self.add(factory(*record) if factory else record.payload)
+        return self
+
 
 class OneWaySyncSet(BaseSyncSet):
     """
@@ -297,11 +1074,22 @@ class OneWaySyncSet(BaseSyncSet):
     For all methods defined in this class, data passed in arguments are preferred
     to existing data.
     """
-    def diff(self, other):
+    def diff(self, other, ids=None, id_range=None, prefix=None, where=None):
         """
         Returns four syncsets containing the members that are only in self, only in
         other, outdated in self, updated in master. 'other' is considered the master.
+
+        Pass ``ids``, ``id_range``, ``prefix`` or ``where`` to only diff a slice of both
+        syncsets. See ``slice()``.
         """
+        sliced = self._sliced(other, ids, id_range, prefix, where)
+        if sliced is not None:
+            return sliced[0]._diff(sliced[1])
+        if self.diff_cache is not None:
+            return self.diff_cache.get(self, other, self._diff)
+        return self._diff(other)
+
+    def _diff(self, other):
         only_in_self = self.difference(other)
         only_in_master = other.difference(self)
         common = self.intersection(other)
@@ -309,8 +1097,8 @@ class OneWaySyncSet(BaseSyncSet):
         outdated_in_self = self.__class__()
         for item in common:
             common_id = item.get_id()
-            self_item = self[common_id]
-            master_item = other[common_id]
+            self_item = self._peek(common_id)
+            master_item = other._peek(common_id)
             # force __cmp__(); cmp(a, b) somehow prefers a.__eq__
             if self_item.__cmp__(master_item) != 0:
                 log.debug('oneway diff: %s differs from %s', self_item, master_item)
@@ -318,10 +1106,56 @@ class OneWaySyncSet(BaseSyncSet):
                 outdated_in_self.add(self_item)
         return only_in_self, only_in_master, outdated_in_self, updated_in_master
 
+    def diff_iter(self, iterable):
+        """
+        Like ``diff()``, but with the master given as an iterable of members which is consumed
+        once, e.g. a generator reading from a file or an API. The master is never built as a
+        syncset, so only the differing members are kept in memory.
+
+        Each member is classified as it arrives. Only the ids of members that are also in self
+        are remembered, to find the members that are only in self at the end. If an id occurs more
+        than once in ``iterable``, the last member wins, like with ``add()``.
+        """
+        self_items = self.item_dict
+        seen = set()
+        only_in_master, outdated_in_self, updated_in_master = {}, {}, {}
+        for item in iterable:
+            item_id = item.get_id()
+            self_item = self_items.get(item_id)
+            if self_item is None:
+                only_in_master[item_id] = item
+                continue
+            if item_id in seen:
+                outdated_in_self.pop(item_id, None)
+                updated_in_master.pop(item_id, None)
+            else:
+                seen.add(item_id)
+            if self_item.__cmp__(item) != 0:
+                outdated_in_self[item_id] = self_item
+                updated_in_master[item_id] = item
+        only_in_self = {} if len(seen) == len(self_items) else \
+            {item_id: item for item_id, item in self_items.items() if item_id not in seen}
+        return tuple(self._from_item_dict(items)
+                     for items in (only_in_self, only_in_master, outdated_in_self, updated_in_master))
+
     def add(self, item):
-        self.discard(item)
-        self.item_dict[item.get_id()] = item
-        super().add(item)
+        """
+        Add an item, replacing any existing item with the same id. The master wins, so this also
+        forgets any tombstone for the id.
+        """
+        item_id = item.get_id()
+        if self._indexes is not None:
+            self._check_indexes(item_id, item)
+        existing_item = self.item_dict.get(item_id)
+        if existing_item is not None:
+            self.remove(existing_item)
+        if self.tombstones is not None:
+            self.tombstones.discard(item_id)
+        self._store(item_id, item)
+
+    def _deleted_ids(self, other, only_in_self):
+        # The master is authoritative, so everything it doesn't have is deleted
+        return list(only_in_self.keys())
 
     def intersection(self, *others):
         """
@@ -332,7 +1166,7 @@ class OneWaySyncSet(BaseSyncSet):
         for item in self:
             item_id = item.get_id()
             try:
-                common_item = [other[item_id] for other in others][-1]
+                common_item = [other._peek(item_id) for other in others][-1]
                 items.add(common_item)
             except KeyError:
                 pass
@@ -351,20 +1185,38 @@ class TwoWaySyncSet(BaseSyncSet):
     For all methods defined in this class, data passed in arguments are
     preferred to existing data only if existing data is older.
     """
-    def diff(self, other):
+    def diff(self, other, ids=None, id_range=None, prefix=None, where=None):
         """
         Returns four syncsets containing the members that are only in self, only
-        in other, newer in self, and newer in other.
+        in other, newer in self, and newer in other. Members that are missing on one
+        side because they were deleted there (see ``tombstones``) are not reported.
+
+        Pass ``ids``, ``id_range``, ``prefix`` or ``where`` to only diff a slice of both
+        syncsets. See ``slice()``.
         """
+        sliced = self._sliced(other, ids, id_range, prefix, where)
+        if sliced is not None:
+            return sliced[0]._diff(sliced[1])
+        if self.diff_cache is not None:
+            return self.diff_cache.get(self, other, self._diff)
+        return self._diff(other)
+
+    def _diff(self, other):
         only_in_self = self.difference(other)
         only_in_other = other.difference(self)
+        if self.tombstones is not None:
+            for item in [i for i in only_in_other if self.is_tombstoned(i)]:
+                only_in_other.remove(item)
+        if getattr(other, 'tombstones', None) is not None:
+            for item in [i for i in only_in_self if other.is_tombstoned(i)]:
+                only_in_self.remove(item)
         common = self.intersection(other)
         newer_in_self = self.__class__()
         newer_in_other = self.__class__()
         for item in common:
             common_id = item.get_id()
-            self_item = self[common_id]
-            other_item = other[common_id]
+            self_item = self._peek(common_id)
+            other_item = other._peek(common_id)
             if self_item > other_item:
                 log.debug('diff: %s larger than %s', self_item, other_item)
                 newer_in_self.add(self_item)
@@ -373,17 +1225,68 @@ class TwoWaySyncSet(BaseSyncSet):
                 newer_in_other.add(other_item)
         return only_in_self, only_in_other, newer_in_self, newer_in_other
 
+    def diff_iter(self, iterable):
+        """
+        Like ``diff()``, but with the other side given as an iterable of members which is consumed
+        once. See ``OneWaySyncSet.diff_iter()``. Members in ``iterable`` which are tombstoned in
+        self are not reported. If an id occurs more than once in ``iterable``, the newest member
+        wins, like with ``add()``.
+        """
+        self_items = self.item_dict
+        tombstoned = self.is_tombstoned if self.tombstones is not None else None
+        seen = set()
+        only_in_other, newer_in_self, newer_in_other = {}, {}, {}
+        for item in iterable:
+            item_id = item.get_id()
+            self_item = self_items.get(item_id)
+            if self_item is None:
+                if tombstoned is not None and tombstoned(item):
+                    continue
+                existing_item = only_in_other.get(item_id)
+                if existing_item is None or item > existing_item:
+                    only_in_other[item_id] = item
+                continue
+            if self_item < item:
+                newer_in_self.pop(item_id, None)
+                existing_item = newer_in_other.get(item_id)
+                if existing_item is None or item > existing_item:
+                    newer_in_other[item_id] = item
+            elif self_item > item:
+                # Only newer in self if no other member with this id was the same or newer
+                if item_id not in seen:
+                    newer_in_self[item_id] = self_item
+            else:
+                newer_in_self.pop(item_id, None)
+            seen.add(item_id)
+        only_in_self = {} if len(seen) == len(self_items) else \
+            {item_id: item for item_id, item in self_items.items() if item_id not in seen}
+        return tuple(self._from_item_dict(items)
+                     for items in (only_in_self, only_in_other, newer_in_self, newer_in_other))
+
     def add(self, item):
         """
-        Add a new item. Only replace an existing item if the existing item is older
+        Add a new item. Only replace an existing item if the existing item is older. An item
+        is not added if it was deleted at the same or a newer changekey (see ``tombstones``).
         """
-        existing_item = self.item_dict.get(item.get_id())
-        if existing_item:
-            if existing_item >= item:
+        item_id = item.get_id()
+        if self.tombstones is not None:
+            if self.is_tombstoned(item):
                 return
-            self.remove(item)
-        self.item_dict[item.get_id()] = item
-        super().add(item)
+            self.tombstones.discard(item_id)
+        existing_item = self.item_dict.get(item_id)
+        if existing_item is not None and existing_item >= item:
+            return
+        if self._indexes is not None:
+            self._check_indexes(item_id, item)
+        if existing_item is not None:
+            self.remove(existing_item)
+        self._store(item_id, item)
+
+    def _deleted_ids(self, other, only_in_self):
+        # Absence on the other side doesn't mean deletion. Only its tombstones do.
+        if getattr(other, 'tombstones', None) is None:
+            return []
+        return [item_id for item_id, item in self.item_dict.items() if other.is_tombstoned(item)]
 
     def intersection(self, *others):
         """
@@ -394,7 +1297,7 @@ class TwoWaySyncSet(BaseSyncSet):
         for item in self:
             item_id = item.get_id()
             try:
-                common_item = max([other[item_id] for other in others])
+                common_item = max([other._peek(item_id) for other in others])
                 items.add(common_item)
             except KeyError:
                 pass
@@ -467,3 +1370,106 @@ class SyncSetMember:
         # is used as changekey.
         a, b = self.get_changekey(), other.get_changekey()
         return (a > b) - (a < b)
+
+
+_member_type_template = '''
+class {typename}(SyncSetMember):
+    __slots__ = {slots!r}
+
+    def __init__(self, {init_args}):
+{init_body}
+
+    def get_id(self):
+        return self.{id}
+
+    def get_changekey(self):
+        return self.{changekey}
+
+    def __hash__(self):
+        return hash(self.{id})
+
+    def __eq__(self, other):
+        return hash(self.{id}) == hash(other)
+
+    def __repr__(self):
+        return '{typename}(' + ', '.join(repr(getattr(self, f)) for f in self.__slots__) + ')'
+
+    def __getstate__(self):
+        return tuple(getattr(self, f) for f in self.__slots__)
+
+    def __setstate__(self, state):
+        for f, value in zip(self.__slots__, state):
+            setattr(self, f, value)
+
+    def __cmp__(self, other):
+        if other.__class__ is {typename}:
+            a, b = self.{id}, other.{id}
+        else:
+            a, b = self.{id}, other.get_id()
+        c = (a > b) - (a < b)
+        if c != 0:
+            return c
+        if other.__class__ is {typename}:
+            a, b = self.{changekey}, other.{changekey}
+        else:
+            a, b = self.{changekey}, other.get_changekey()
+        return (a > b) - (a < b)
+'''
+
+_member_type_compare_template = '''
+    def {name}(self, other):
+        if other.__class__ is not {typename}:
+            return SyncSetMember.{name}(self, other)
+        a, b = self.{id}, other.{id}
+        if a < b:
+            return {if_less}
+        if a > b:
+            return {if_greater}
+        return self.{changekey} {op} other.{changekey}
+'''
+
+
+def member_type(typename, id, changekey, fields=(), module=None):
+    """
+    Create a lightweight ``SyncSetMember`` subclass named ``typename``, similar to
+    ``collections.namedtuple()``. Instances only have ``__slots__`` for the ``id`` and
+    ``changekey`` attributes and any extra ``fields``, which default to ``None``. ``get_id()``,
+    ``get_changekey()``, hashing and comparisons are generated to access the attributes directly
+    instead of going through the generic ``SyncSetMember`` implementation.
+
+        SyncURL = member_type('SyncURL', id='url', changekey='last_modified', fields=['body'])
+        page = SyncURL('http://example.com/', date(2012, 1, 1))
+    """
+    field_names = (id, changekey) + tuple(f for f in fields if f not in (id, changekey))
+    for name in (typename,) + field_names:
+        if not isinstance(name, str) or not name.isidentifier() or keyword.iskeyword(name) or name.startswith('_'):
+            raise ValueError('Type names and field names must be valid identifiers not starting with an '
+                             'underscore: %r' % name)
+    if len(set(field_names)) != len(field_names):
+        raise ValueError('Duplicate field names: %r' % (field_names,))
+    init_args = ', '.join(field_names[:2] + tuple('%s=None' % f for f in field_names[2:]))
+    init_body = '\n'.join('        self.%s = %s' % (f, f) for f in field_names)
+    source = _member_type_template.format(
+        typename=typename, slots=field_names, init_args=init_args, init_body=init_body, id=id, changekey=changekey,
+    )
+    for name, op, if_less, if_greater in (
+            ('__lt__', '<', True, False),
+            ('__le__', '<=', True, False),
+            ('__gt__', '>', False, True),
+            ('__ge__', '>=', False, True),
+    ):
+        source += _member_type_compare_template.format(
+            name=name, typename=typename, id=id, changekey=changekey, op=op, if_less=if_less, if_greater=if_greater,
+        )
+    namespace = {'SyncSetMember': SyncSetMember, '__name__': 'syncset_member_%s' % typename}
+    exec(source, namespace)
+    cls = namespace[typename]
+    # Like namedtuple(), make instances picklable by pointing at the module that created the type
+    if module is None:
+        try:
+            module = sys._getframe(1).f_globals.get('__name__', '__main__')
+        except (AttributeError, ValueError):
+            pass
+    if module is not None:
+        cls.__module__ = module
+    return cls
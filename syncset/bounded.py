@@ -0,0 +1,158 @@
+"""
+Syncsets with a maximum size, which evict the least recently used members, e.g. for local caches.
+"""
+import sys
+from collections import OrderedDict
+
+from . import OneWaySyncSet, TwoWaySyncSet
+
+
+def approximate_size(item):
+    """
+    Return the approximate size in bytes of a member: the size of the object itself plus the
+    shallow size of its attribute values
+    """
+    size = sys.getsizeof(item)
+    values = getattr(item, '__dict__', None)
+    if values is not None:
+        size += sys.getsizeof(values) + sum(sys.getsizeof(v) for v in values.values())
+    for cls in type(item).__mro__:
+        slots = cls.__dict__.get('__slots__', ())
+        for name in (slots,) if isinstance(slots, str) else slots:
+            value = getattr(item, name, None)
+            if value is not None and name not in ('__dict__', '__weakref__'):
+                size += sys.getsizeof(value)
+    return size
+
+
+class BoundedSyncSetMixin:
+    """
+    Keeps at most ``max_count`` members, or members of at most ``max_bytes`` in total as
+    estimated by ``size_func(member)``, and evicts the least recently used members when a limit is
+    exceeded. The newest member is never evicted, even if it alone exceeds ``max_bytes``.
+
+    ``add()``, ``[]`` and ``get()`` mark a member as recently used, in constant time. Membership
+    tests, iteration and the lookups done by ``diff()`` and set operations like
+    ``intersection()`` don't, so diffing doesn't disturb the eviction order. ``on_evict`` is
+    called with each evicted member. ``hits`` and ``misses`` count lookups with ``[]`` and
+    ``get()``, and ``evictions`` counts evicted members.
+
+    Evicted members are simply absent, so ``diff()`` reports them like any other missing member.
+    Copies and the syncsets returned by ``diff()`` and set operations are not bounded.
+    """
+    def __init__(self, iterable=None, max_count=None, max_bytes=None, size_func=approximate_size, on_evict=None):
+        if max_count is not None and max_count < 1:
+            raise ValueError("'max_count' must be positive")
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.size_func = size_func
+        self.on_evict = on_evict
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.total_bytes = 0
+        # Id -> size of each member, least recently used first
+        self._recency = OrderedDict()
+        super().__init__(iterable)
+
+    @classmethod
+    def _from_item_dict(cls, item_dict):
+        items = super()._from_item_dict(item_dict)
+        items._recency = OrderedDict.fromkeys(items.item_dict, 0)
+        return items
+
+    def _touch(self, item_id):
+        if item_id in self._recency:
+            self._recency.move_to_end(item_id)
+
+    def __getitem__(self, item_id):
+        try:
+            item = super().__getitem__(item_id)
+        except KeyError:
+            self.misses += 1
+            raise
+        self.hits += 1
+        self._recency.move_to_end(item_id)
+        return item
+
+    def _peek(self, item_id):
+        return self.item_dict[item_id]
+
+    def get(self, item_id, default=None):
+        item = self.item_dict.get(item_id)
+        if item is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self._recency.move_to_end(item_id)
+        return item
+
+    def add(self, item):
+        super().add(item)
+        # Also count as a use if the existing member was newer and kept
+        self._touch(item.get_id())
+        self._evict()
+
+    def _add_many(self, items):
+        super()._add_many(items)
+        self._evict()
+
+    def _forget(self, item_id):
+        self.total_bytes -= self._recency.pop(item_id, 0)
+
+    def _store(self, item_id, item):
+        super()._store(item_id, item)
+        size = self.size_func(item) if self.max_bytes is not None else 0
+        self._recency[item_id] = size
+        self.total_bytes += size
+
+    def _store_many(self, items):
+        super()._store_many(items)
+        for item_id, item in items.items():
+            size = self.size_func(item) if self.max_bytes is not None else 0
+            self._recency[item_id] = size
+            self.total_bytes += size
+
+    def remove(self, item, tombstone=False):
+        super().remove(item, tombstone=tombstone)
+        self._forget(item.get_id())
+
+    def _remove_many(self, item_ids, tombstone=False):
+        item_ids = list(item_ids)
+        super()._remove_many(item_ids, tombstone=tombstone)
+        for item_id in item_ids:
+            self._forget(item_id)
+
+    def pop(self):
+        item = super().pop()
+        self._forget(item.get_id())
+        return item
+
+    def clear(self):
+        super().clear()
+        self._recency.clear()
+        self.total_bytes = 0
+
+    def _over_limit(self):
+        return (self.max_count is not None and len(self._recency) > self.max_count) or \
+            (self.max_bytes is not None and self.total_bytes > self.max_bytes)
+
+    def _evict(self):
+        while len(self._recency) > 1 and self._over_limit():
+            item = self.item_dict[next(iter(self._recency))]
+            self.remove(item)
+            self.evictions += 1
+            if self.on_evict is not None:
+                self.on_evict(item)
+
+
+class BoundedOneWaySyncSet(BoundedSyncSetMixin, OneWaySyncSet):
+    """
+    A ``OneWaySyncSet`` with a maximum size and LRU eviction
+    """
+
+
+class BoundedTwoWaySyncSet(BoundedSyncSetMixin, TwoWaySyncSet):
+    """
+    A ``TwoWaySyncSet`` with a maximum size and LRU eviction
+    """
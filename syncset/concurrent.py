@@ -0,0 +1,423 @@
+"""
+Syncsets which can be mutated from many threads at once, also on free-threaded CPython.
+"""
+import threading
+import weakref
+from contextlib import contextmanager
+
+from . import OneWaySyncSet, TwoWaySyncSet, _ids_of
+
+# Pre-image of a member id which didn't exist at the version of a snapshot
+_MISSING = object()
+
+
+class _NoLock:
+    """
+    A context manager which does nothing, like ``contextlib.nullcontext()`` of Python 3.7
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+_NO_LOCK = _NoLock()
+
+
+class _VersionLog:
+    """
+    The members as they were at the version of a snapshot, for the ids that have changed since.
+    Logs of newer versions are chained from older ones, so a snapshot keeps all newer logs alive,
+    and a log is garbage-collected when no snapshot of its version or an older one is left.
+    """
+    __slots__ = ('version', 'preimages', 'next', '__weakref__')
+
+    def __init__(self, version):
+        self.version = version
+        self.preimages = {}
+        self.next = None
+
+
+class ConcurrentSyncSetMixin:
+    """
+    Makes the multi-step mutations of a syncset atomic per member id. Mutations lock one of
+    ``stripes`` reentrant locks, chosen by the hash of the member id, so writers working on
+    different ids rarely contend. Operations which touch the whole syncset (``clear()``,
+    ``pop()`` and ``copy()``) hold all locks. The in-place set operations check and change each
+    member under the lock for its id.
+
+    The ordered id index and the indexes created with ``create_index()`` are shared by all
+    stripes, so they are updated under one more lock. ``add()`` holds it from the unique index
+    check until the member is stored, so writers only run in parallel while there are no indexes.
+
+    Iterating the syncset directly while other threads are writing is not safe. Take a
+    read-only snapshot with ``snapshot()`` and iterate or compare that instead.
+    """
+    snapshot_class = None
+    # The version log of the newest snapshot, as long as any snapshot needs it
+    _log_ref = None
+    _log_version = 0
+
+    def __init__(self, iterable=None, stripes=64):
+        self._locks = tuple(threading.RLock() for _ in range(stripes))
+        # Guards the ordered id index and the secondary indexes, which are shared by all stripes
+        self._index_lock = threading.RLock()
+        super().__init__(iterable)
+
+    def _lock_for(self, item_id):
+        return self._locks[hash(item_id) % len(self._locks)]
+
+    @contextmanager
+    def _all_locks(self):
+        # Always acquire in the same order to avoid deadlocks between two whole-set operations
+        for lock in self._locks:
+            lock.acquire()
+        try:
+            yield
+        finally:
+            for lock in reversed(self._locks):
+                lock.release()
+
+    def _index_guard(self):
+        """
+        Return the index lock if the syncset has an ordered id index or secondary indexes. Indexes
+        are only created while holding all locks, so the answer doesn't change while the caller
+        holds the lock for an id.
+        """
+        if self._id_index is None and self._indexes is None:
+            return _NO_LOCK
+        return self._index_lock
+
+    def _record(self, item_id):
+        """
+        Save the current member with this id for live snapshots before it is changed. Must be
+        called with the lock for the id held.
+        """
+        log = self._log_ref() if self._log_ref is not None else None
+        if log is not None and item_id not in log.preimages:
+            log.preimages[item_id] = self.item_dict.get(item_id, _MISSING)
+
+    def add(self, item):
+        # Hold the index lock from the unique index check until the member is stored
+        with self._lock_for(item.get_id()), self._index_guard():
+            super().add(item)
+
+    def remove(self, item, tombstone=False):
+        item_id = item.get_id()
+        with self._lock_for(item_id), self._index_guard():
+            self._record(item_id)
+            super().remove(item, tombstone=tombstone)
+
+    def discard(self, item, tombstone=False):
+        with self._lock_for(item.get_id()):
+            super().discard(item, tombstone=tombstone)
+
+    def discard_ids(self, ids, tombstone=False):
+        for item_id in ids:
+            with self._lock_for(item_id):
+                item = self.item_dict.get(item_id)
+                if item is not None:
+                    self.remove(item, tombstone=tombstone)
+
+    def remove_ids(self, ids, tombstone=False):
+        """
+        Remove the members with the given ids, one at a time. Unlike in plain syncsets, members are
+        removed up to the first missing id, before ``KeyError`` is raised.
+        """
+        for item_id in ids:
+            with self._lock_for(item_id):
+                self.remove(self.item_dict[item_id], tombstone=tombstone)
+
+    def intersection_update(self, *others):
+        for other in others:
+            other_ids = _ids_of(other)
+            with self._all_locks():
+                item_ids = list(self.item_dict)
+            for item_id in item_ids:
+                if item_id in other_ids:
+                    continue
+                with self._lock_for(item_id):
+                    item = self.item_dict.get(item_id)
+                    if item is not None:
+                        self.remove(item)
+        return self
+
+    def difference_update(self, *others):
+        for other in others:
+            self.discard_ids(item.get_id() for item in other)
+        return self
+
+    def symmetric_difference_update(self, other):
+        if other is self:
+            self.clear()
+            return self
+        for item in other:
+            item_id = item.get_id()
+            with self._lock_for(item_id):
+                existing_item = self.item_dict.get(item_id)
+                if existing_item is None:
+                    self.add(item)
+                else:
+                    self.remove(existing_item)
+        return self
+
+    def _store(self, item_id, item):
+        self._record(item_id)
+        with self._index_guard():
+            super()._store(item_id, item)
+
+    def _store_many(self, items):
+        for item_id in items:
+            self._record(item_id)
+        with self._index_guard():
+            super()._store_many(items)
+
+    def _remove_many(self, item_ids, tombstone=False):
+        item_ids = list(item_ids)
+        with self._all_locks(), self._index_guard():
+            for item_id in item_ids:
+                self._record(item_id)
+            super()._remove_many(item_ids, tombstone=tombstone)
+
+    def _add_many(self, items):
+        # The bulk path checks and inserts in separate steps, so add one at a time instead
+        return self.update(items)
+
+    def pop(self):
+        with self._all_locks():
+            if not self.item_dict:
+                raise KeyError('pop from an empty set')
+            item = next(iter(self.item_dict.values()))
+            self.remove(item)
+            return item
+
+    def clear(self):
+        with self._all_locks(), self._index_lock:
+            for item_id in self.item_dict:
+                self._record(item_id)
+            super().clear()
+
+    def create_index(self, name, key_func, unique=False):
+        with self._all_locks(), self._index_lock:
+            super().create_index(name, key_func, unique)
+
+    def drop_index(self, name):
+        with self._all_locks(), self._index_lock:
+            super().drop_index(name)
+
+    def lookup(self, name, value):
+        with self._index_lock:
+            return super().lookup(name, value)
+
+    def copy(self):
+        with self._all_locks():
+            return super().copy()
+
+    def snapshot(self):
+        """
+        Return a read-only syncset pinned to the current version of self, in constant time.
+        Writers are not blocked by snapshots. Instead, they save the previous version of the
+        members they change for as long as any snapshot needs it. Snapshots of the same version
+        share this state.
+
+        Point lookups on a snapshot (``get()``, ``in`` and ``[]``) go through the live syncset.
+        The members of the snapshot are collected when it is first iterated or compared, after
+        which the snapshot doesn't hold on to any version state.
+        """
+        with self._all_locks():
+            log = self._log_ref() if self._log_ref is not None else None
+            if log is None or log.preimages:
+                # There were writes since the newest snapshot, so start a new version
+                self._log_version += 1
+                new_log = _VersionLog(self._log_version)
+                if log is not None:
+                    log.next = new_log
+                log = new_log
+                self._log_ref = weakref.ref(log)
+            snapshot = self.snapshot_class(self, log)
+            snapshot.tombstones = self.tombstones
+            return snapshot
+
+    def slice(self, ids=None, id_range=None, prefix=None, where=None):
+        with self._all_locks():
+            return super().slice(ids, id_range, prefix, where)
+
+    def diff(self, other, ids=None, id_range=None, prefix=None, where=None):
+        """
+        Diff snapshots of self and other. The returned syncsets are of the plain, non-concurrent
+        syncset type. A slice of self is taken while holding all locks.
+        """
+        sliced = self._sliced(other, ids, id_range, prefix, where)
+        if sliced is not None:
+            return sliced[0]._diff(sliced[1])
+        if isinstance(other, ConcurrentSyncSetMixin):
+            other = other.snapshot()
+        return self.snapshot().diff(other)
+
+    def diff_iter(self, iterable):
+        """
+        Diff a snapshot of self against an iterable. See ``OneWaySyncSet.diff_iter()``.
+        """
+        return self.snapshot().diff_iter(iterable)
+
+
+class SyncSetSnapshotMixin:
+    """
+    A read-only view of a concurrent syncset at a version, created by ``snapshot()``. Mutating
+    methods raise ``TypeError``. ``copy()`` and the methods that return new syncsets, like
+    ``diff()``, return syncsets of the plain, writable ``plain_class`` type.
+    """
+    plain_class = None
+
+    def __init__(self, source, log):
+        # Don't call the syncset constructor, which sets up an empty item_dict
+        set.__init__(self)
+        # The mutation version of the source, which snapshot() reads while holding all locks
+        self.version = source.version
+        self._source = source
+        self._source_id = id(source)
+        self.diff_cache = source.diff_cache
+        self._log = log
+        self._items = None
+        self._lock = threading.Lock()
+
+    def _materialize(self):
+        with self._lock:
+            if self._items is not None:
+                return
+            # Copy the live members first, then undo all changes recorded since our version.
+            # Writers record before they change a member, so the logs are at least as recent as
+            # the copy.
+            items = self._source.item_dict.copy()
+            seen = set()
+            log = self._log
+            while log is not None:
+                for item_id, item in log.preimages.copy().items():
+                    if item_id in seen:
+                        continue
+                    seen.add(item_id)
+                    if item is _MISSING:
+                        items.pop(item_id, None)
+                    else:
+                        items[item_id] = item
+                log = log.next
+            set.update(self, items.values())
+            self._items = items
+            # Release the version state
+            self._source = self._log = None
+
+    @property
+    def item_dict(self):
+        if self._items is None:
+            self._materialize()
+        return self._items
+
+    def _lookup(self, item_id, default=None):
+        # _materialize() clears _source before _log, so read them in the opposite order
+        log, source = self._log, self._source
+        if source is None:
+            return self._items.get(item_id, default)
+        # Read the live member before the logs, for the same reason as in _materialize()
+        item = source.item_dict.get(item_id, _MISSING)
+        while log is not None:
+            preimage = log.preimages.get(item_id)
+            if preimage is not None:
+                item = preimage
+                break
+            log = log.next
+        return default if item is _MISSING else item
+
+    def get(self, item_id, default=None):
+        return self._lookup(item_id, default)
+
+    def __getitem__(self, item_id):
+        item = self._lookup(item_id, _MISSING)
+        if item is _MISSING:
+            raise KeyError(item_id)
+        return item
+
+    def __contains__(self, item):
+        existing_item = self._lookup(item.get_id())
+        return existing_item is not None and existing_item.__cmp__(item) == 0
+
+    def contains_similar(self, item):
+        return self._lookup(item.get_id()) is not None
+
+    def __len__(self):
+        return len(self.item_dict)
+
+    def __iter__(self):
+        self._materialize()
+        return set.__iter__(self)
+
+    def __repr__(self):
+        self._materialize()
+        return set.__repr__(self)
+
+    def __reduce__(self):
+        return self.copy().__reduce__()
+
+    @classmethod
+    def _from_item_dict(cls, item_dict):
+        return cls.plain_class._from_item_dict(item_dict)
+
+    def _version_key(self):
+        # Snapshots of the same version of a syncset have the same contents
+        return self._source_id, self.version
+
+    def _diff(self, other):
+        items = self.copy()
+        items.tombstones = self.tombstones
+        return items._diff(other)
+
+    def intersection(self, *others):
+        return self.copy().intersection(*others)
+
+    def symmetric_difference(self, other):
+        return self.copy().symmetric_difference(other)
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError('%s is read-only' % self.__class__.__name__)
+
+    add = remove = discard = pop = clear = _store = _store_many = _remove_many = _read_only
+
+
+class OneWaySyncSetSnapshot(SyncSetSnapshotMixin, OneWaySyncSet):
+    """
+    A read-only snapshot of a ``ConcurrentOneWaySyncSet``
+    """
+    plain_class = OneWaySyncSet
+
+
+class TwoWaySyncSetSnapshot(SyncSetSnapshotMixin, TwoWaySyncSet):
+    """
+    A read-only snapshot of a ``ConcurrentTwoWaySyncSet``
+    """
+    plain_class = TwoWaySyncSet
+
+
+class ConcurrentOneWaySyncSet(ConcurrentSyncSetMixin, OneWaySyncSet):
+    """
+    A thread-safe ``OneWaySyncSet``
+    """
+    snapshot_class = OneWaySyncSetSnapshot
+
+
+class ConcurrentTwoWaySyncSet(ConcurrentSyncSetMixin, TwoWaySyncSet):
+    """
+    A thread-safe ``TwoWaySyncSet``
+    """
+    snapshot_class = TwoWaySyncSetSnapshot
+
+    def add_if_newer(self, item):
+        """
+        Atomically add item unless a member with the same id and the same or a newer changekey
+        is present or was deleted. Returns ``True`` if the item was added.
+        """
+        with self._lock_for(item.get_id()):
+            existing_item = self.item_dict.get(item.get_id())
+            if existing_item is not None and existing_item >= item:
+                return False
+            super().add(item)
+            return self.item_dict.get(item.get_id()) is item
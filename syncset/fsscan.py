@@ -0,0 +1,113 @@
+"""
+A parallel filesystem scanner which builds a syncset of the files in a directory tree.
+"""
+import os
+import queue
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatchcase
+
+from . import OneWaySyncSet, log, member_type
+
+FileMember = member_type('FileMember', id='path', changekey='changekey', fields=['size', 'mtime_ns', 'inode'],
+                         module=__name__)
+
+# Number of directory entries a worker scans before handing the directories it has not reached yet
+# back, to be spread over idle workers
+BATCH_SIZE = 1000
+
+
+def _changekey_stat(st):
+    return st.st_mtime_ns, st.st_size
+
+
+def _changekey_inode(st):
+    return st.st_ino, st.st_mtime_ns, st.st_size
+
+
+CHANGEKEYS = {
+    'stat': _changekey_stat,
+    'inode': _changekey_inode,
+}
+
+
+def _matches(path, name, patterns):
+    return any(fnmatchcase(path, pattern) or fnmatchcase(name, pattern) for pattern in patterns)
+
+
+def _scan_dir(path, rel_path, changekey, include, exclude, members, subdirs):
+    """
+    Add the file members and the subdirectories of one directory to ``members`` and ``subdirs``
+    """
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                entry_rel_path = rel_path + '/' + entry.name if rel_path else entry.name
+                if exclude and _matches(entry_rel_path, entry.name, exclude):
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append((entry.path, entry_rel_path))
+                elif entry.is_file(follow_symlinks=False):
+                    if include and not _matches(entry_rel_path, entry.name, include):
+                        continue
+                    st = entry.stat(follow_symlinks=False)
+                    members.append(FileMember(entry_rel_path, changekey(st), st.st_size, st.st_mtime_ns, st.st_ino))
+    except OSError as e:
+        log.warning('Could not scan %s: %s', path, e)
+
+
+def _scan_dirs(dirs, changekey, include, exclude):
+    """
+    Runs in a worker thread. Scan ``dirs`` and their subdirectories depth-first until about
+    ``BATCH_SIZE`` entries have been seen. Return the file members found and the directories which
+    are left to scan.
+    """
+    members, stack = [], list(dirs)
+    entries = 0
+    while stack and entries < BATCH_SIZE:
+        path, rel_path = stack.pop()
+        before = len(members) + len(stack)
+        _scan_dir(path, rel_path, changekey, include, exclude, members, stack)
+        entries += len(members) + len(stack) - before + 1
+    return members, stack
+
+
+def scan_tree(root, syncset_class=OneWaySyncSet, workers=8, include=None, exclude=None, changekey='stat'):
+    """
+    Walk the directory tree at ``root`` with a pool of ``workers`` threads and return a syncset of
+    ``FileMember`` objects for all regular files. Symlinks are not followed.
+
+    Member ids are paths relative to ``root``, with ``/`` as separator. The changekey is
+    ``(mtime_ns, size)`` by default, or ``(inode, mtime_ns, size)`` with ``changekey='inode'``, or
+    the result of calling ``changekey`` with the ``os.stat_result`` of the file.
+
+    ``include`` and ``exclude`` are lists of ``fnmatch`` patterns matched against both the relative
+    path and the name of each entry, so ``exclude=['.git']`` skips ``.git`` directories at any
+    level, while ``exclude=['src/build']`` only skips that one path. Files are only included if
+    they match an ``include`` pattern, if given. Files and directories matching an ``exclude``
+    pattern are skipped, including everything below an excluded directory.
+
+    Each worker scans a batch of directories depth-first, and hands the directories it hasn't
+    reached after ``BATCH_SIZE`` entries back to be split among idle workers. This keeps the
+    number of tasks low for trees with many small directories.
+    """
+    changekey = CHANGEKEYS[changekey] if isinstance(changekey, str) else changekey
+    include, exclude = list(include or ()), list(exclude or ())
+    items = syncset_class()
+    results = queue.Queue()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+
+        def submit(dirs):
+            executor.submit(_scan_dirs, dirs, changekey, include, exclude).add_done_callback(results.put)
+
+        submit([(os.fspath(root), '')])
+        running = 1
+        while running:
+            members, dirs = results.get().result()
+            running -= 1
+            items._add_many(members)
+            # Split the remaining directories among the idle workers
+            chunks = min(len(dirs), workers - running)
+            for i in range(chunks):
+                submit(dirs[i::chunks])
+            running += chunks
+    return items
@@ -0,0 +1,115 @@
+"""
+Content hashes as changekeys for file members, backed by a persistent cache so that only files
+whose metadata changed since the last run are hashed again.
+"""
+import hashlib
+import mmap
+import os
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+from . import log
+from .fsscan import FileMember
+
+
+def _hash_file(path, algorithm):
+    """
+    Runs in a worker process. Return the hex digest of the file contents, or None if the file
+    can't be read.
+    """
+    h = hashlib.new(algorithm)
+    try:
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                    h.update(m)
+    except (OSError, ValueError) as e:
+        log.warning('Could not hash %s: %s', path, e)
+        return None
+    return h.hexdigest()
+
+
+class HashCache:
+    """
+    A persistent cache of file content hashes in an SQLite database at ``path``. Entries are keyed
+    on the absolute file path and only valid while the size, mtime and inode of the file are
+    unchanged.
+
+    ``apply()`` takes a syncset of ``FileMember`` objects, as returned by
+    ``syncset.fsscan.scan_tree()``, and returns a copy with content hashes as changekeys. Files
+    missing from the cache, or with changed metadata, are hashed in a pool of ``workers``
+    processes using memory-mapped reads (``workers=0`` hashes in-process).
+    """
+    def __init__(self, path, algorithm='sha256', workers=None):
+        self.algorithm = algorithm
+        self.workers = workers
+        self.hits = 0
+        self.misses = 0
+        self._db = sqlite3.connect(path)
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS hashes ('
+            'path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, inode INTEGER, algorithm TEXT, digest TEXT)'
+        )
+
+    def _hash_files(self, paths):
+        if not paths:
+            return []
+        if self.workers == 0:
+            return [_hash_file(p, self.algorithm) for p in paths]
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            return list(executor.map(_hash_file, paths, repeat(self.algorithm), chunksize=64))
+
+    def apply(self, root, files, prune=True):
+        """
+        Return a syncset of the same type as ``files`` with the content hash of each file as
+        changekey. Member ids are paths relative to ``root``. Files that can't be read are left
+        out. With ``prune=True``, cache entries for paths below ``root`` which are not in
+        ``files`` are evicted.
+        """
+        root = os.path.abspath(root)
+        cached = {}
+        prefix = os.path.join(root, '')
+        rows = self._db.execute(
+            'SELECT path, size, mtime_ns, inode, digest FROM hashes WHERE algorithm = ? AND substr(path, 1, ?) = ?',
+            (self.algorithm, len(prefix), prefix),
+        )
+        for path, size, mtime_ns, inode, digest in rows:
+            cached[path] = (size, mtime_ns, inode), digest
+        result = files.__class__()
+        stale = []
+        for member in files:
+            abs_path = os.path.join(root, *member.path.split('/'))
+            entry = cached.get(abs_path)
+            if entry is not None and entry[0] == (member.size, member.mtime_ns, member.inode):
+                self.hits += 1
+                result.add(FileMember(member.path, entry[1], member.size, member.mtime_ns, member.inode))
+            else:
+                stale.append((abs_path, member))
+        self.misses += len(stale)
+        digests = self._hash_files([abs_path for abs_path, _ in stale])
+        updates = []
+        for (abs_path, member), digest in zip(stale, digests):
+            if digest is None:
+                continue
+            updates.append((abs_path, member.size, member.mtime_ns, member.inode, self.algorithm, digest))
+            result.add(FileMember(member.path, digest, member.size, member.mtime_ns, member.inode))
+        with self._db:
+            self._db.executemany('INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?)', updates)
+            if prune:
+                seen = {os.path.join(root, *member.path.split('/')) for member in files}
+                self._db.executemany('DELETE FROM hashes WHERE path = ?',
+                                     ((path,) for path in cached if path not in seen))
+        return result
+
+    def __len__(self):
+        return self._db.execute('SELECT COUNT(*) FROM hashes').fetchone()[0]
+
+    def close(self):
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,281 @@
+"""
+An asyncio adapter which builds a master syncset of web resources from HTTP HEAD requests, and
+only fetches the bodies of the resources that are new or updated.
+"""
+import asyncio
+import ssl
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from urllib.parse import urlsplit
+
+from . import OneWaySyncSet, log, member_type
+
+WebResource = member_type('WebResource', id='url', changekey='changekey', fields=['last_modified', 'etag', 'body'],
+                          module=__name__)
+
+
+def _changekey(last_modified, etag):
+    # Both parts must be comparable, so use a timestamp and an empty string for missing headers
+    return last_modified.timestamp() if last_modified else 0.0, etag or ''
+
+
+def _parse_date(value):
+    try:
+        return parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class HTTPResponse:
+    __slots__ = ('status', 'headers', 'body', 'keep_alive')
+
+    def __init__(self, status, headers, body, keep_alive):
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.keep_alive = keep_alive
+
+
+async def _read_response(reader, method):
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionResetError('Connection closed by server')
+    version, status = status_line.decode('latin-1').split(None, 2)[:2]
+    status = int(status)
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+    body = b''
+    if method == 'HEAD' or status in (204, 304) or 100 <= status < 200:
+        pass
+    elif headers.get('transfer-encoding', '').lower() == 'chunked':
+        chunks = []
+        while True:
+            size = int((await reader.readline()).split(b';')[0], 16)
+            if size == 0:
+                # Skip trailers
+                while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    pass
+                break
+            chunks.append(await reader.readexactly(size))
+            await reader.readexactly(2)
+        body = b''.join(chunks)
+    elif 'content-length' in headers:
+        body = await reader.readexactly(int(headers['content-length']))
+    else:
+        body = await reader.read()
+        keep_alive = False
+    return HTTPResponse(status, headers, body, keep_alive)
+
+
+class _HostPool:
+    """
+    Idle keep-alive connections to one host, and a limit on concurrent requests to it
+    """
+    def __init__(self, limit):
+        self.idle = []
+        self.semaphore = asyncio.Semaphore(limit)
+
+
+class HTTPAdapter:
+    """
+    Issues HTTP requests for many URLs concurrently, with at most ``concurrency`` requests in
+    flight and at most ``per_host`` per host. Connections are HTTP/1.1 keep-alive connections which
+    are reused for later requests to the same host. Use as an async context manager, or call
+    ``close()`` when done.
+
+    ``master()`` builds a syncset of ``WebResource`` members from HEAD requests, with
+    ``(last_modified_timestamp, etag)`` of each resource as changekey. ``sync()`` diffs a local
+    syncset against that and fetches bodies only for the ``only_in_master`` and
+    ``updated_in_master`` buckets.
+
+    URLs which fail, or respond with an error status, are left out of the master syncset and
+    recorded in ``failed`` as url -> status code or exception.
+    """
+    def __init__(self, concurrency=20, per_host=6, timeout=30, ssl_context=None, member_factory=WebResource):
+        self.concurrency = concurrency
+        self.per_host = per_host
+        self.timeout = timeout
+        self.ssl_context = ssl_context
+        self.member_factory = member_factory
+        self.failed = {}
+        # Number of requests sent and connections opened
+        self.requests = 0
+        self.connections = 0
+        self._pools = {}
+        self._semaphore = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def close(self):
+        pools, self._pools = self._pools, {}
+        for pool in pools.values():
+            for _, writer in pool.idle:
+                writer.close()
+            pool.idle.clear()
+
+    def _pool(self, key):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        try:
+            return self._pools[key]
+        except KeyError:
+            pool = self._pools[key] = _HostPool(self.per_host)
+            return pool
+
+    async def _connect(self, scheme, host, port):
+        if scheme == 'https':
+            context = self.ssl_context or ssl.create_default_context()
+            conn = await asyncio.open_connection(host, port, ssl=context, server_hostname=host)
+        else:
+            conn = await asyncio.open_connection(host, port)
+        self.connections += 1
+        return conn
+
+    async def request(self, method, url, headers=None):
+        """
+        Send a request and return an ``HTTPResponse``. A request on a reused keep-alive
+        connection is retried if the server has closed the connection in the meantime. The whole
+        exchange, including connecting and retrying, must finish within ``timeout`` seconds.
+        """
+        parts = urlsplit(url)
+        if parts.scheme not in ('http', 'https'):
+            raise ValueError('Unsupported URL scheme in %r' % url)
+        port = parts.port or (443 if parts.scheme == 'https' else 80)
+        key = (parts.scheme, parts.hostname, port)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        lines = ['%s %s HTTP/1.1' % (method, path), 'Host: %s' % parts.netloc, 'Accept-Encoding: identity']
+        lines.extend('%s: %s' % header for header in (headers or {}).items())
+        data = ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+        pool = self._pool(key)
+        # Wait for the host before taking a global slot, so requests queued for a busy host don't
+        # hold slots that requests to other hosts could use
+        async with pool.semaphore, self._semaphore:
+            return await asyncio.wait_for(self._exchange(pool, key, method, data), self.timeout)
+
+    async def _exchange(self, pool, key, method, data):
+        while True:
+            reused = bool(pool.idle)
+            reader, writer = pool.idle.pop() if reused else await self._connect(*key)
+            try:
+                writer.write(data)
+                await writer.drain()
+                response = await _read_response(reader, method)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                writer.close()
+                if reused:
+                    continue
+                raise
+            except BaseException:
+                writer.close()
+                raise
+            self.requests += 1
+            if response.keep_alive:
+                pool.idle.append((reader, writer))
+            else:
+                writer.close()
+            return response
+
+    def _member(self, url, response, body=None):
+        last_modified = _parse_date(response.headers.get('last-modified'))
+        etag = response.headers.get('etag')
+        return self.member_factory(url, _changekey(last_modified, etag), last_modified, etag, body)
+
+    async def _head(self, url, known):
+        headers = {}
+        etag, last_modified = getattr(known, 'etag', None), getattr(known, 'last_modified', None)
+        if etag:
+            headers['If-None-Match'] = etag
+        if isinstance(last_modified, datetime):
+            headers['If-Modified-Since'] = format_datetime(last_modified.astimezone(timezone.utc), usegmt=True)
+        try:
+            response = await self.request('HEAD', url, headers)
+        except (OSError, asyncio.TimeoutError, ValueError) as e:
+            log.warning('HEAD %s failed: %s', url, e)
+            self.failed[url] = e
+            return None
+        if response.status == 304 and known is not None:
+            return known
+        if response.status >= 300:
+            self.failed[url] = response.status
+            return None
+        return self._member(url, response)
+
+    async def iter_members(self, urls, known=None):
+        """
+        Send HEAD requests for ``urls`` and yield ``WebResource`` members as responses arrive.
+        If a member with the same URL is in the ``known`` syncset, the request is conditional on
+        its ``etag`` and ``last_modified``, and the known member is yielded if the resource is
+        unchanged.
+        """
+        known_items = known.item_dict if known is not None else {}
+        tasks = [asyncio.ensure_future(self._head(url, known_items.get(url))) for url in urls]
+        try:
+            for task in asyncio.as_completed(tasks):
+                member = await task
+                if member is not None:
+                    yield member
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def master(self, urls, syncset_class=OneWaySyncSet, known=None):
+        """
+        Return a syncset of ``WebResource`` members for ``urls``, without bodies. See
+        ``iter_members()``.
+        """
+        items = syncset_class()
+        async for member in self.iter_members(urls, known=known):
+            items.add(member)
+        return items
+
+    async def _get(self, member):
+        try:
+            response = await self.request('GET', member.get_id())
+        except (OSError, asyncio.TimeoutError, ValueError) as e:
+            log.warning('GET %s failed: %s', member.get_id(), e)
+            self.failed[member.get_id()] = e
+            return None
+        if response.status >= 300:
+            self.failed[member.get_id()] = response.status
+            return None
+        return self._member(member.get_id(), response, body=response.body)
+
+    async def fetch(self, members):
+        """
+        GET the bodies of ``members`` and return a syncset of the same type with the fetched
+        ``WebResource`` members. The changekeys come from the GET responses.
+        """
+        items = members.__class__()
+        for member in await asyncio.gather(*(self._get(m) for m in members)):
+            if member is not None:
+                items.add(member)
+        return items
+
+    async def sync(self, local, urls):
+        """
+        Diff ``local`` against the master syncset built from HEAD requests for ``urls``, and
+        return the four ``diff()`` buckets with bodies fetched for ``only_in_master`` and
+        ``updated_in_master``. Requests are conditional if members of ``local`` have ``etag`` or
+        ``last_modified`` attributes, like ``WebResource``. Members of URLs that failed are not
+        reported as ``only_in_self``.
+        """
+        master = await self.master(urls, syncset_class=local.__class__, known=local)
+        only_in_self, only_in_master, outdated_in_self, updated_in_master = local.diff(master)
+        for member in [m for m in only_in_self if m.get_id() in self.failed]:
+            only_in_self.remove(member)
+        only_in_master, updated_in_master = await asyncio.gather(
+            self.fetch(only_in_master), self.fetch(updated_in_master)
+        )
+        return only_in_self, only_in_master, outdated_in_self, updated_in_master
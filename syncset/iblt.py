@@ -0,0 +1,230 @@
+"""
+Set reconciliation with invertible Bloom lookup tables (IBLT). Two syncsets which differ in only a
+few members can be diffed by exchanging fixed-size sketches, with a size proportional to the number
+of differences instead of the number of members.
+"""
+import hashlib
+import pickle
+
+from . import TwoWaySyncSet, log
+
+
+class IBLTDecodeError(ValueError):
+    pass
+
+
+class IBLT:
+    """
+    An invertible Bloom lookup table over (id, changekey) pairs of syncset members. Each pair is
+    added to ``hash_count`` cells, one in each of ``hash_count`` equally sized partitions of the
+    table. Subtracting the IBLT of another syncset cancels out all pairs present in both, and
+    ``decode()`` then recovers the pairs that differ, as long as there aren't too many of them
+    compared to the size of the table.
+
+    Ids and changekeys must be picklable, and must pickle to the same bytes on both sides.
+    """
+    def __init__(self, size, hash_count=3):
+        if hash_count < 1 or size < hash_count:
+            raise ValueError("'size' must be at least 'hash_count', which must be positive")
+        self.hash_count = hash_count
+        self.partition_size = -(-size // hash_count)
+        self.size = self.partition_size * hash_count
+        self.counts = [0] * self.size
+        self.key_sums = [0] * self.size
+        self.hash_sums = [0] * self.size
+
+    @classmethod
+    def from_syncset(cls, syncset, size, hash_count=3):
+        table = cls(size, hash_count=hash_count)
+        for item_id, item in syncset.item_dict.items():
+            table.add(item_id, item.get_changekey())
+        return table
+
+    @staticmethod
+    def _encode(item_id, changekey):
+        # Prefix with a 1 byte so leading zero bytes survive the round-trip through an int
+        return int.from_bytes(b'\x01' + pickle.dumps((item_id, changekey), protocol=4), 'big')
+
+    @staticmethod
+    def _decode_key(key):
+        return pickle.loads(key.to_bytes((key.bit_length() + 7) // 8, 'big')[1:])
+
+    def _hashes(self, key):
+        """
+        Return the check hash and the cell indices of a key
+        """
+        data = key.to_bytes((key.bit_length() + 7) // 8, 'big')
+        digest = hashlib.blake2b(data, digest_size=8 + 4 * self.hash_count).digest()
+        indices = [
+            i * self.partition_size + int.from_bytes(digest[8 + 4 * i:12 + 4 * i], 'little') % self.partition_size
+            for i in range(self.hash_count)
+        ]
+        return int.from_bytes(digest[:8], 'little'), indices
+
+    def _update(self, key, count):
+        check, indices = self._hashes(key)
+        for i in indices:
+            self.counts[i] += count
+            self.key_sums[i] ^= key
+            self.hash_sums[i] ^= check
+
+    def add(self, item_id, changekey):
+        self._update(self._encode(item_id, changekey), 1)
+
+    def remove(self, item_id, changekey):
+        self._update(self._encode(item_id, changekey), -1)
+
+    def __sub__(self, other):
+        if (self.size, self.hash_count) != (other.size, other.hash_count):
+            raise ValueError('Can only subtract IBLTs of the same size and hash count')
+        result = self.__class__(self.size, hash_count=self.hash_count)
+        result.counts = [a - b for a, b in zip(self.counts, other.counts)]
+        result.key_sums = [a ^ b for a, b in zip(self.key_sums, other.key_sums)]
+        result.hash_sums = [a ^ b for a, b in zip(self.hash_sums, other.hash_sums)]
+        return result
+
+    def _is_pure(self, i):
+        return self.counts[i] in (1, -1) and self._hashes(self.key_sums[i])[0] == self.hash_sums[i]
+
+    def decode(self):
+        """
+        Peel the table and return two dicts of id -> changekey for pairs that were only added to
+        the minuend and only to the subtrahend of a subtraction. Raises ``IBLTDecodeError`` if
+        the table holds too many differences to decode. Does not modify the table.
+        """
+        table = self - self.__class__(self.size, hash_count=self.hash_count)
+        only_in_self, only_in_other = {}, {}
+        pure = [i for i in range(table.size) if table._is_pure(i)]
+        while pure:
+            i = pure.pop()
+            if not table._is_pure(i):
+                continue
+            key, count = table.key_sums[i], table.counts[i]
+            item_id, changekey = self._decode_key(key)
+            (only_in_self if count == 1 else only_in_other)[item_id] = changekey
+            check, indices = table._hashes(key)
+            for j in indices:
+                table.counts[j] -= count
+                table.key_sums[j] ^= key
+                table.hash_sums[j] ^= check
+                if table._is_pure(j):
+                    pure.append(j)
+        if any(table.counts) or any(table.key_sums) or any(table.hash_sums):
+            raise IBLTDecodeError('Could not decode IBLT of size %s' % self.size)
+        return only_in_self, only_in_other
+
+    def to_bytes(self):
+        """
+        Serialize the table. The format is based on ``pickle``, so only load tables from trusted
+        sources with ``from_bytes()``.
+        """
+        return pickle.dumps((self.size, self.hash_count, self.counts, self.key_sums, self.hash_sums),
+                            protocol=pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def from_bytes(cls, data):
+        size, hash_count, counts, key_sums, hash_sums = pickle.loads(data)
+        table = cls(size, hash_count=hash_count)
+        table.counts, table.key_sums, table.hash_sums = counts, key_sums, hash_sums
+        return table
+
+
+def _cmp(a, b):
+    return (a > b) - (a < b)
+
+
+def reconcile(local, fetch_sketch, fetch_members, expected_difference=10, max_size=None, fetch_tombstones=None):
+    """
+    Diff the syncset ``local`` against a remote syncset with IBLT sketches, and return the same
+    four syncsets as ``local.diff(remote)``.
+
+    ``fetch_sketch(size)`` must return the ``IBLT`` of the remote syncset with the given size,
+    e.g. by asking the remote side for ``IBLT.from_syncset(remote, size).to_bytes()``.
+    ``fetch_members(ids)`` must return the remote members with the given ids. Both are only
+    asked for data proportional to the number of differences.
+
+    Members deleted on the remote side are reported in ``only_in_self`` unless
+    ``fetch_tombstones(ids)`` is given. For a ``TwoWaySyncSet``, it must return a dict of id ->
+    changekey of the remote tombstones among ``ids``, and tombstoned members are then left out,
+    like in ``diff()``. Tombstones of ``local`` are always applied.
+
+    The first sketch has room for about ``expected_difference`` differences. If it can't be
+    decoded, the size is doubled until it can. ``IBLTDecodeError`` is raised if that would
+    exceed ``max_size`` cells. By default, the limit is a few times the number of members on
+    both sides, where a sketch is as large as the member lists and growing it further won't
+    help.
+    """
+    size = max(2 * expected_difference, 6)
+    while True:
+        remote_sketch = fetch_sketch(size)
+        local_sketch = IBLT.from_syncset(local, remote_sketch.size, hash_count=remote_sketch.hash_count)
+        if max_size is None:
+            # Each remote member adds 1 to the count of hash_count cells
+            remote_len = sum(remote_sketch.counts) // remote_sketch.hash_count
+            max_size = 8 * (len(local) + remote_len) + 6
+        try:
+            only_local, only_remote = (local_sketch - remote_sketch).decode()
+            break
+        except IBLTDecodeError:
+            if size * 2 > max_size:
+                raise
+            log.debug('IBLT of size %s could not be decoded, retrying with size %s', size, size * 2)
+            size *= 2
+    two_way = isinstance(local, TwoWaySyncSet)
+    only_in_self, only_in_other, changed_in_self, changed_in_other = (local.__class__() for _ in range(4))
+    remote_ids, remote_targets = [], {}
+    for item_id, changekey in only_local.items():
+        if item_id not in only_remote:
+            only_in_self.add(local[item_id])
+            continue
+        c = _cmp(changekey, only_remote[item_id])
+        if two_way and c > 0:
+            changed_in_self.add(local[item_id])
+        elif two_way and c < 0:
+            remote_ids.append(item_id)
+            remote_targets[item_id] = changed_in_other
+        elif not two_way and c != 0:
+            changed_in_self.add(local[item_id])
+            remote_ids.append(item_id)
+            remote_targets[item_id] = changed_in_other
+    for item_id in only_remote:
+        if item_id not in only_local:
+            remote_ids.append(item_id)
+            remote_targets[item_id] = only_in_other
+    if remote_ids:
+        for item in fetch_members(remote_ids):
+            remote_targets[item.get_id()].add(item)
+    if local.tombstones is not None:
+        for item in [i for i in only_in_other if local.is_tombstoned(i)]:
+            only_in_other.remove(item)
+    if two_way and fetch_tombstones is not None and only_in_self:
+        # Absence on the remote side doesn't mean deletion. Only its tombstones do.
+        remote_tombstones = fetch_tombstones(list(only_in_self.keys()))
+        for item in [i for i in only_in_self if i.get_id() in remote_tombstones]:
+            if remote_tombstones[item.get_id()] >= item.get_changekey():
+                only_in_self.remove(item)
+    return only_in_self, only_in_other, changed_in_self, changed_in_other
+
+
+def _fetch_tombstones(syncset):
+    if getattr(syncset, 'tombstones', None) is None:
+        return None
+
+    def fetch_tombstones(ids):
+        tombstones = ((item_id, syncset.tombstones.get(item_id)) for item_id in ids)
+        return {item_id: tombstone.changekey for item_id, tombstone in tombstones if tombstone is not None}
+
+    return fetch_tombstones
+
+
+def diff_iblt(syncset, other, expected_difference=10):
+    """
+    Diff two syncsets in the same process through IBLT sketches, like ``reconcile()``
+    """
+    return reconcile(
+        syncset,
+        fetch_sketch=lambda size: IBLT.from_syncset(other, size),
+        fetch_members=lambda ids: [other[item_id] for item_id in ids],
+        expected_difference=expected_difference,
+        fetch_tombstones=_fetch_tombstones(other),
+    )
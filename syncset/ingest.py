@@ -0,0 +1,153 @@
+"""
+A buffer for change streams which coalesces upserts and deletes per member id, and applies them to
+a syncset in batches.
+"""
+import threading
+import time
+
+from . import TwoWaySyncSet
+
+
+class IngestBuffer:
+    """
+    Collects ``upsert()`` and ``delete()`` events for ``syncset`` and keeps only one pending event
+    per id: the one with the newest changekey for a ``TwoWaySyncSet``, or the last one otherwise.
+    On a tie in a ``TwoWaySyncSet``, a delete wins over an upsert, like with ``tombstones``.
+
+    Pending events are applied with ``flush()``, which happens automatically when there are
+    ``flush_size`` pending ids, or when the oldest pending event is older than ``flush_interval``
+    seconds. Time-based flushes are checked on each event, or by a background thread started with
+    ``start()``. Only one flush applies events at a time. Producers that trigger a flush while
+    another one is running wait for it to finish, which bounds the number of pending events.
+
+    Deletes are recorded in the ``tombstones`` of the syncset, if enabled. The buffer is
+    thread-safe if the syncset is, e.g. a ``ConcurrentTwoWaySyncSet``, or if only the buffer
+    mutates it. Use as a context manager, or call ``close()`` to apply the remaining events.
+    """
+    def __init__(self, syncset, flush_size=1000, flush_interval=None, clock=time.monotonic):
+        if flush_size < 1:
+            raise ValueError("'flush_size' must be positive")
+        self.syncset = syncset
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.clock = clock
+        self.two_way = isinstance(syncset, TwoWaySyncSet)
+        # id -> (changekey, member), where a member of None is a delete
+        self._pending = {}
+        self._oldest = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+        # Number of events received, events merged into a pending event, events applied to the
+        # syncset, and flushes with at least one event
+        self.events_in = 0
+        self.coalesced = 0
+        self.applied = 0
+        self.flushes = 0
+
+    def __len__(self):
+        """
+        Return the number of pending events
+        """
+        return len(self._pending)
+
+    def _put(self, item_id, changekey, item):
+        with self._lock:
+            self.events_in += 1
+            pending = self._pending.get(item_id)
+            if pending is not None:
+                self.coalesced += 1
+                if self.two_way:
+                    pending_changekey, pending_item = pending
+                    if changekey < pending_changekey or (changekey == pending_changekey and pending_item is None):
+                        return
+            elif not self._pending:
+                self._oldest = self.clock()
+            self._pending[item_id] = (changekey, item)
+            due = len(self._pending) >= self.flush_size or (
+                self.flush_interval is not None and self.clock() - self._oldest >= self.flush_interval
+            )
+        if due:
+            self.flush()
+
+    def upsert(self, item):
+        """
+        Queue a member to be added to the syncset
+        """
+        self._put(item.get_id(), item.get_changekey(), item)
+
+    def delete(self, item_id, changekey=None):
+        """
+        Queue the deletion of a member. For a ``TwoWaySyncSet``, ``changekey`` is required, and
+        only members with the same or an older changekey are deleted.
+        """
+        if self.two_way and changekey is None:
+            raise ValueError("'changekey' is required for deletes from a TwoWaySyncSet")
+        self._put(item_id, changekey, None)
+
+    def flush(self):
+        """
+        Apply all pending events to the syncset. Returns the number of events applied.
+        """
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            if not pending:
+                return 0
+            syncset = self.syncset
+            tombstones = syncset.tombstones
+            upserts = []
+            for item_id, (changekey, item) in pending.items():
+                if item is not None:
+                    upserts.append(item)
+                    continue
+                existing_item = syncset.get(item_id)
+                if self.two_way and existing_item is not None and existing_item.get_changekey() > changekey:
+                    continue
+                if existing_item is not None:
+                    syncset.remove(existing_item)
+                if tombstones is not None:
+                    if changekey is None and existing_item is not None:
+                        changekey = existing_item.get_changekey()
+                    if changekey is not None:
+                        tombstones.add(item_id, changekey)
+            syncset._add_many(upserts)
+            self.applied += len(pending)
+            self.flushes += 1
+            return len(pending)
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            with self._lock:
+                due = self._pending and self.clock() - self._oldest >= self.flush_interval
+            if due:
+                self.flush()
+
+    def start(self):
+        """
+        Start a background thread which flushes when the oldest pending event is older than
+        ``flush_interval`` seconds, also when no new events arrive
+        """
+        if self.flush_interval is None:
+            raise ValueError("'flush_interval' must be set to flush in the background")
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='syncset-ingest', daemon=True)
+            self._thread.start()
+
+    def close(self):
+        """
+        Stop the background thread, if any, and apply the remaining events
+        """
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
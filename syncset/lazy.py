@@ -0,0 +1,141 @@
+"""
+Stub syncset members that only hold an id and a changekey. The full payload of a member is only
+fetched when it is accessed, in batches and through a bounded cache.
+"""
+from collections import OrderedDict, deque
+from itertools import islice
+
+from . import SyncSetMember
+
+
+class StubMember(SyncSetMember):
+    """
+    A syncset member with only an id and a changekey. ``payload`` fetches the full payload
+    through the ``PayloadLoader`` that created the stub.
+    """
+    __slots__ = ('id', 'changekey', 'loader')
+
+    def __init__(self, id, changekey, loader):
+        self.id = id
+        self.changekey = changekey
+        self.loader = loader
+
+    def get_id(self):
+        return self.id
+
+    def get_changekey(self):
+        return self.changekey
+
+    def __hash__(self):
+        return hash(self.id)
+
+    @property
+    def payload(self):
+        return self.loader.get(self)
+
+    def __repr__(self):
+        return '%s(%r, %r)' % (self.__class__.__name__, self.id, self.changekey)
+
+
+class PayloadLoader:
+    """
+    Fetches payloads for ``StubMember`` objects. ``fetch`` is called with a list of ids and must
+    return a mapping of id to payload. Fetched payloads are kept in an LRU cache of at most
+    ``cache_size`` entries, keyed on id and changekey.
+
+    A cache miss fetches up to ``batch_size`` payloads at once: the requested one, plus the next
+    members queued with ``prefetch()``. To process all members of a ``diff()`` bucket, either
+    ``prefetch()`` the bucket before touching ``payload`` on its members, or use
+    ``iter_payloads()``.
+    """
+    def __init__(self, fetch, batch_size=100, cache_size=1000):
+        if batch_size < 1 or cache_size < batch_size:
+            raise ValueError("'cache_size' must be at least 'batch_size', which must be positive")
+        self.fetch = fetch
+        self.batch_size = batch_size
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._pending = deque()
+        # Number of payloads served from the cache, number of fetch() calls and payloads fetched
+        self.hits = 0
+        self.fetches = 0
+        self.fetched = 0
+
+    def stub(self, item_id, changekey):
+        """
+        Create a stub member loading its payload through this loader
+        """
+        return StubMember(item_id, changekey, self)
+
+    def stubs(self, rows):
+        """
+        Return a generator of stub members from an iterable of (id, changekey) tuples
+        """
+        for item_id, changekey in rows:
+            yield StubMember(item_id, changekey, self)
+
+    def prefetch(self, members):
+        """
+        Queue members to be fetched together with the next cache miss. ``members`` is consumed
+        lazily, so queueing a large syncset doesn't copy it.
+        """
+        self._pending.append(iter(members))
+
+    def _next_pending(self, n):
+        while n > 0 and self._pending:
+            batch = list(islice(self._pending[0], n))
+            if len(batch) < n:
+                self._pending.popleft()
+            n -= len(batch)
+            yield from batch
+
+    def _load(self, members):
+        missing = OrderedDict()
+        for member in members:
+            key = (member.get_id(), member.get_changekey())
+            if key in self._cache:
+                # Protect cached members of this batch from being evicted by the fetched ones
+                self._cache.move_to_end(key)
+            else:
+                missing[key] = None
+        if not missing:
+            return
+        payloads = self.fetch([item_id for item_id, _ in missing])
+        self.fetches += 1
+        self.fetched += len(missing)
+        for key in missing:
+            self._cache[key] = payloads[key[0]]
+        # The batch is never larger than the cache, so this only evicts older entries
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def _cached(self, key):
+        payload = self._cache[key]
+        self._cache.move_to_end(key)
+        return payload
+
+    def get(self, member):
+        """
+        Return the payload of ``member``
+        """
+        key = (member.get_id(), member.get_changekey())
+        try:
+            payload = self._cached(key)
+        except KeyError:
+            self._load([member] + list(self._next_pending(self.batch_size - 1)))
+            return self._cached(key)
+        self.hits += 1
+        return payload
+
+    def iter_payloads(self, members):
+        """
+        Yield (member, payload) tuples for ``members``, fetching payloads ``batch_size`` at a time
+        """
+        members = iter(members)
+        while True:
+            batch = list(islice(members, self.batch_size))
+            if not batch:
+                return
+            self._load(batch)
+            for member in batch:
+                yield member, self._cached((member.get_id(), member.get_changekey()))
@@ -0,0 +1,111 @@
+"""
+Streaming loaders which fill a syncset from CSV files, JSON Lines files and DB-API cursors.
+Rows are read and added in blocks, and members are lightweight ``Record`` objects unless a
+``member_factory`` is given.
+"""
+import csv
+import functools
+import io
+import json
+from itertools import islice
+from operator import itemgetter
+
+from . import member_type
+
+Record = member_type('Record', id='id', changekey='changekey', fields=['row'], module=__name__)
+
+BLOCK_SIZE = 10000
+
+
+def _converter(func, cache_size):
+    """
+    Wrap a changekey conversion function in a cache. Changekeys like dates and timestamps are
+    often repeated, so most rows are converted with a dict lookup.
+    """
+    if func is None:
+        return None
+    if cache_size:
+        return functools.lru_cache(maxsize=cache_size)(func)
+    return func
+
+
+def _fill(syncset, rows, get_id, get_changekey, changekey_type, member_factory, keep_row, block_size, cache_size):
+    convert = _converter(changekey_type, cache_size)
+    if member_factory is None:
+        member_factory = Record
+    else:
+        keep_row = True
+    rows = iter(rows)
+    while True:
+        block = list(islice(rows, block_size))
+        if not block:
+            return syncset
+        # Use map() to keep the per-row work in C as far as possible
+        ids = map(get_id, block)
+        changekeys = map(get_changekey, block) if convert is None else map(convert, map(get_changekey, block))
+        if keep_row:
+            syncset._add_many(list(map(member_factory, ids, changekeys, block)))
+        else:
+            syncset._add_many(list(map(member_factory, ids, changekeys)))
+
+
+def _getter(col, header):
+    if isinstance(col, int):
+        return itemgetter(col)
+    try:
+        return itemgetter(header.index(col))
+    except ValueError:
+        raise ValueError('Column %r not found in %r' % (col, header))
+
+
+def load_csv(syncset, path, id_col, changekey_col, changekey_type=None, member_factory=None, keep_row=False,
+             block_size=BLOCK_SIZE, cache_size=65536, **csv_kwargs):
+    """
+    Add the rows of the CSV file at ``path`` to ``syncset``. Columns are given by index, or by
+    name if the file has a header row. ``changekey_type`` is called to convert changekey strings,
+    e.g. ``int`` or ``datetime.date.fromisoformat``, and its results are cached for up to
+    ``cache_size`` distinct values.
+
+    By default, members are ``Record`` objects with ``id`` and ``changekey`` attributes, and the
+    raw row in ``row`` if ``keep_row`` is true. Pass ``member_factory(id, changekey, row)`` to
+    create other member types. Extra keyword arguments are passed to ``csv.reader()``.
+    """
+    with open(path, newline='', buffering=io.DEFAULT_BUFFER_SIZE * 64) as f:
+        reader = csv.reader(f, **csv_kwargs)
+        header = None
+        if not isinstance(id_col, int) or not isinstance(changekey_col, int):
+            header = next(reader, [])
+        return _fill(syncset, reader, _getter(id_col, header), _getter(changekey_col, header), changekey_type,
+                     member_factory, keep_row, block_size, cache_size)
+
+
+def load_jsonl(syncset, path, id_key, changekey_key, changekey_type=None, member_factory=None, keep_row=False,
+               block_size=BLOCK_SIZE, cache_size=65536):
+    """
+    Add the objects in the JSON Lines file at ``path`` to ``syncset``. Works like ``load_csv()``,
+    with ``id_key`` and ``changekey_key`` naming the object keys to use. Blank lines are skipped.
+    """
+    with open(path, encoding='utf-8', buffering=io.DEFAULT_BUFFER_SIZE * 64) as f:
+        rows = (json.loads(line) for line in f if line.strip())
+        return _fill(syncset, rows, itemgetter(id_key), itemgetter(changekey_key), changekey_type,
+                     member_factory, keep_row, block_size, cache_size)
+
+
+def load_cursor(syncset, cursor, id_col, changekey_col, changekey_type=None, member_factory=None, keep_row=False,
+                block_size=BLOCK_SIZE, cache_size=65536):
+    """
+    Add the rows of an executed DB-API ``cursor`` to ``syncset``, fetching ``block_size`` rows at
+    a time with ``fetchmany()``. Columns are given by index, or by name as found in
+    ``cursor.description``. Works like ``load_csv()`` otherwise.
+    """
+    header = [column[0] for column in cursor.description or ()]
+
+    def rows():
+        while True:
+            block = cursor.fetchmany(block_size)
+            if not block:
+                return
+            yield from block
+
+    return _fill(syncset, rows(), _getter(id_col, header), _getter(changekey_col, header), changekey_type,
+                 member_factory, keep_row, block_size, cache_size)
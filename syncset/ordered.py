@@ -0,0 +1,124 @@
+"""
+Syncsets which keep their members sorted by id, for ordered iteration, range and prefix scans,
+and merge-based diffs.
+"""
+from . import OneWaySyncSet, TwoWaySyncSet
+from .sortedlist import SortedIdList
+
+_END = object()
+
+
+class SortedSyncSetMixin:
+    """
+    Keeps an ordered index of the member ids from the start, instead of building it on first use.
+    Iteration is in id order, ``irange()`` and ``prefix()`` scan a part of the id space in
+    O(log n + k), and ``add()`` and ``remove()`` stay O(log n), plus shifting the values of one
+    block of the index. Ids must be totally ordered.
+
+    ``diff()`` against another sorted syncset walks both indexes in a linear merge instead of
+    copying the syncsets and looking up each id. The returned syncsets are sorted syncsets, too.
+    """
+    def __init__(self, iterable=None):
+        self._id_index = SortedIdList()
+        super().__init__(iterable)
+
+    @classmethod
+    def _from_item_dict(cls, item_dict):
+        items = super()._from_item_dict(item_dict)
+        items._id_index = SortedIdList(items.item_dict)
+        return items
+
+    def __iter__(self):
+        item_dict = self.item_dict
+        return (item_dict[item_id] for item_id in self._id_index)
+
+    def __reversed__(self):
+        item_dict = self.item_dict
+        return (item_dict[item_id] for item_id in reversed(self._id_index))
+
+    def irange(self, lo=None, hi=None, inclusive=(True, False), reverse=False):
+        """
+        Iterate over the members with ids between ``lo`` and ``hi``, in id order. A bound of
+        ``None`` is unbounded. ``inclusive`` tells whether each bound is included, and defaults
+        to a half-open range.
+        """
+        item_dict = self.item_dict
+        return (item_dict[item_id] for item_id in self._id_index.irange(lo, hi, inclusive, reverse))
+
+    def prefix(self, prefix):
+        """
+        Iterate over the members with ids starting with ``prefix``, in id order. Works for string,
+        bytes and tuple ids.
+        """
+        item_dict = self.item_dict
+        return (item_dict[item_id] for item_id in self._id_index.iprefix(prefix))
+
+    def _merge(self, other):
+        """
+        Walk the ids of self and other in order, and yield (self_item, other_item) pairs with
+        ``None`` for the side where the id is missing
+        """
+        self_items, other_items = self.item_dict, other.item_dict
+        self_ids, other_ids = iter(self._id_index), iter(other._id_index)
+        a, b = next(self_ids, _END), next(other_ids, _END)
+        while a is not _END and b is not _END:
+            if a == b:
+                yield self_items[a], other_items[b]
+                a, b = next(self_ids, _END), next(other_ids, _END)
+            elif a < b:
+                yield self_items[a], None
+                a = next(self_ids, _END)
+            else:
+                yield None, other_items[b]
+                b = next(other_ids, _END)
+        while a is not _END:
+            yield self_items[a], None
+            a = next(self_ids, _END)
+        while b is not _END:
+            yield None, other_items[b]
+            b = next(other_ids, _END)
+
+
+class SortedOneWaySyncSet(SortedSyncSetMixin, OneWaySyncSet):
+    """
+    A ``OneWaySyncSet`` sorted by id
+    """
+    def _diff(self, other):
+        if not isinstance(other, SortedSyncSetMixin):
+            return super()._diff(other)
+        only_in_self, only_in_master, outdated_in_self, updated_in_master = {}, {}, {}, {}
+        for self_item, master_item in self._merge(other):
+            if master_item is None:
+                only_in_self[self_item.get_id()] = self_item
+            elif self_item is None:
+                only_in_master[master_item.get_id()] = master_item
+            elif self_item.__cmp__(master_item) != 0:
+                outdated_in_self[self_item.get_id()] = self_item
+                updated_in_master[master_item.get_id()] = master_item
+        return tuple(self._from_item_dict(items)
+                     for items in (only_in_self, only_in_master, outdated_in_self, updated_in_master))
+
+
+class SortedTwoWaySyncSet(SortedSyncSetMixin, TwoWaySyncSet):
+    """
+    A ``TwoWaySyncSet`` sorted by id
+    """
+    def _diff(self, other):
+        if not isinstance(other, SortedSyncSetMixin):
+            return super()._diff(other)
+        self_tombstoned = self.is_tombstoned if self.tombstones is not None else None
+        other_tombstoned = other.is_tombstoned if other.tombstones is not None else None
+        only_in_self, only_in_other, newer_in_self, newer_in_other = {}, {}, {}, {}
+        for self_item, other_item in self._merge(other):
+            if other_item is None:
+                if other_tombstoned is None or not other_tombstoned(self_item):
+                    only_in_self[self_item.get_id()] = self_item
+            elif self_item is None:
+                if self_tombstoned is None or not self_tombstoned(other_item):
+                    only_in_other[other_item.get_id()] = other_item
+            elif self_item > other_item:
+                newer_in_self[self_item.get_id()] = self_item
+            elif self_item < other_item:
+                newer_in_other[other_item.get_id()] = other_item
+        return tuple(self._from_item_dict(items)
+                     for items in (only_in_self, only_in_other, newer_in_self, newer_in_other))
@@ -0,0 +1,129 @@
+"""
+A driver for long-running ``diff()`` calls which splits the id space into ranges and checkpoints
+the result of each range to a local file, so an interrupted diff can resume where it stopped.
+"""
+import os
+import pickle
+import random
+from bisect import bisect_right
+
+from . import log
+
+
+class ResumableDiff:
+    """
+    Diff ``syncset`` against ``other`` one id range at a time. Results for each completed range
+    are appended to the checkpoint file at ``path``. If the file already exists, ranges recorded
+    in it are not diffed again, so calling ``run()`` after a crash continues from the last
+    completed range. The result is identical to ``syncset.diff(other)``, provided the contents
+    of both syncsets are the same when resuming.
+
+    Ids must be totally ordered. The range boundaries are either given as a sorted list of
+    ``boundaries``, or chosen from a sample of ids to get ``ranges`` ranges of roughly equal size.
+    Boundaries are stored in the checkpoint file and reused when resuming.
+
+    The checkpoint file contains pickled data, so only resume from files you created yourself.
+    """
+    format_version = 1
+    sample_size = 10000
+
+    def __init__(self, syncset, other, path, ranges=16, boundaries=None):
+        self.syncset = syncset
+        self.other = other
+        self.path = path
+        self.ranges = ranges
+        self.boundaries = list(boundaries) if boundaries is not None else None
+        # Range index -> tuple of four lists of ids
+        self.completed = {}
+
+    def _choose_boundaries(self):
+        rnd = random.Random(0)
+        sample = []
+        for items in (self.syncset, self.other):
+            ids = list(items.keys())
+            sample.extend(rnd.sample(ids, min(len(ids), self.sample_size)))
+        sample = sorted(set(sample))
+        if not sample:
+            return []
+        step = len(sample) / self.ranges
+        return sorted(set(sample[int(step * i)] for i in range(1, self.ranges)))
+
+    def _load(self):
+        """
+        Read the checkpoint file, if any. A record that was only partially written before a crash
+        is cut off.
+        """
+        if not os.path.exists(self.path):
+            return False
+        with open(self.path, 'r+b') as f:
+            try:
+                format_version, boundaries = pickle.load(f)
+            except (EOFError, pickle.UnpicklingError):
+                return False
+            if format_version != self.format_version:
+                raise ValueError('Unsupported checkpoint format version %r' % format_version)
+            if self.boundaries is not None and self.boundaries != boundaries:
+                raise ValueError('Checkpoint file %r was created with different boundaries' % self.path)
+            self.boundaries = boundaries
+            size = os.fstat(f.fileno()).st_size
+            while f.tell() < size:
+                offset = f.tell()
+                try:
+                    range_index, result = pickle.load(f)
+                except (EOFError, pickle.UnpicklingError, ValueError, IndexError):
+                    log.warning('Discarding partial record at offset %s in %s', offset, self.path)
+                    f.truncate(offset)
+                    break
+                self.completed[range_index] = result
+        return True
+
+    def _append(self, record):
+        with open(self.path, 'ab') as f:
+            pickle.dump(record, f, protocol=pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _ids_by_range(self, items, pending):
+        ids_by_range = {i: [] for i in pending}
+        boundaries = self.boundaries
+        for item_id in items.keys():
+            range_index = bisect_right(boundaries, item_id)
+            if range_index in ids_by_range:
+                ids_by_range[range_index].append(item_id)
+        return ids_by_range
+
+    def _subset(self, items, ids):
+        subset = items._from_item_dict({item_id: items.item_dict[item_id] for item_id in ids})
+        subset.tombstones = items.tombstones
+        return subset
+
+    def run(self):
+        """
+        Diff all remaining ranges and return the same four syncsets as ``syncset.diff(other)``
+        """
+        if not self._load():
+            if self.boundaries is None:
+                self.boundaries = self._choose_boundaries()
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            self._append((self.format_version, self.boundaries))
+        pending = [i for i in range(len(self.boundaries) + 1) if i not in self.completed]
+        self_ids = self._ids_by_range(self.syncset, pending)
+        other_ids = self._ids_by_range(self.other, pending)
+        for range_index in pending:
+            buckets = self._subset(self.syncset, self_ids.pop(range_index))._diff(
+                self._subset(self.other, other_ids.pop(range_index)))
+            result = tuple(list(bucket.keys()) for bucket in buckets)
+            self._append((range_index, result))
+            self.completed[range_index] = result
+            log.debug('resumable diff: completed range %s of %s', range_index + 1, len(self.boundaries) + 1)
+        return self._result()
+
+    def _result(self):
+        buckets = tuple(self.syncset.__class__() for _ in range(4))
+        sources = (self.syncset, self.other) * 2
+        for range_index in sorted(self.completed):
+            for bucket, source, ids in zip(buckets, sources, self.completed[range_index]):
+                for item_id in ids:
+                    bucket.add(source[item_id])
+        return buckets
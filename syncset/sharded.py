@@ -0,0 +1,378 @@
+"""
+A syncset which is partitioned across a number of worker processes by a stable hash of the member
+id. Each worker holds the members of one shard, so the calling process never holds the whole
+collection. ``diff()`` between two sharded syncsets with the same layout runs in all shards in
+parallel. Needs Python 3.8 or later for ``multiprocessing.shared_memory``.
+"""
+import hashlib
+import multiprocessing
+import pickle
+from itertools import islice
+from multiprocessing import shared_memory
+
+from . import OneWaySyncSet, TwoWaySyncSet, log
+
+# Number of members sent to the shards at a time by update()
+BLOCK_SIZE = 10000
+
+
+def stable_hash(item_id):
+    """
+    Return a hash of ``item_id`` which, unlike ``hash()``, is the same in all processes. Ids must
+    pickle to the same bytes every time, which is true for e.g. strings, numbers and tuples of those.
+    """
+    digest = hashlib.blake2b(pickle.dumps(item_id, protocol=4), digest_size=8).digest()
+    return int.from_bytes(digest, 'little')
+
+
+def _cmp(a, b):
+    return (a > b) - (a < b)
+
+
+def _read_block(name, size):
+    block = shared_memory.SharedMemory(name=name)
+    try:
+        return pickle.loads(block.buf[:size])
+    finally:
+        block.close()
+
+
+class _ShardServer:
+    """
+    The members of one shard, and a shared memory block with their (id, changekey) table. The
+    table is written when the corresponding shard of another syncset diffs against it, and kept
+    until the shard is mutated. Runs in the worker process of the shard.
+    """
+    def __init__(self, syncset_class):
+        self.syncset = syncset_class()
+        self.block = None
+        self.block_size = 0
+
+    def _changed(self):
+        if self.block is not None:
+            self.block.close()
+            self.block.unlink()
+            self.block = None
+
+    def add_many(self, items):
+        self.syncset._add_many(items)
+        self._changed()
+
+    def remove(self, item):
+        self.syncset.remove(item)
+        self._changed()
+
+    def discard(self, item):
+        if self.syncset.contains_similar(item):
+            self.syncset.remove(item)
+            self._changed()
+
+    def clear(self):
+        self.syncset.clear()
+        self._changed()
+
+    def contains(self, item):
+        return item in self.syncset
+
+    def contains_similar(self, item):
+        return self.syncset.contains_similar(item)
+
+    def get(self, item_id):
+        return self.syncset.get(item_id)
+
+    def get_many(self, ids):
+        return self.syncset.get_many(ids)
+
+    def len(self):
+        return len(self.syncset)
+
+    def members(self):
+        return list(self.syncset)
+
+    def keys(self):
+        return list(self.syncset.keys())
+
+    def export(self):
+        if self.block is None:
+            data = pickle.dumps(
+                [(item_id, item.get_changekey()) for item_id, item in self.syncset.item_dict.items()],
+                protocol=pickle.HIGHEST_PROTOCOL,
+            )
+            block = shared_memory.SharedMemory(create=True, size=max(len(data), 1))
+            block.buf[:len(data)] = data
+            self.block, self.block_size = block, len(data)
+        return self.block.name, self.block_size
+
+    def diff(self, block, two_way):
+        """
+        Diff the exported table of the same shard of another syncset against the members of this
+        shard. Returns four lists of ids in the order of the buckets returned by ``diff()`` of the
+        other syncset.
+        """
+        self_changekeys = dict(_read_block(*block))
+        other_items = self.syncset.item_dict
+        only_in_self = [i for i in self_changekeys if i not in other_items]
+        only_in_other = [i for i in other_items if i not in self_changekeys]
+        changed_in_self, changed_in_other = [], []
+        for item_id, changekey in self_changekeys.items():
+            other_item = other_items.get(item_id)
+            if other_item is None:
+                continue
+            c = _cmp(changekey, other_item.get_changekey())
+            if c == 0:
+                continue
+            if not two_way:
+                # The master always wins, so both the outdated and the updated member are reported
+                changed_in_self.append(item_id)
+                changed_in_other.append(item_id)
+            elif c > 0:
+                changed_in_self.append(item_id)
+            else:
+                changed_in_other.append(item_id)
+        return only_in_self, only_in_other, changed_in_self, changed_in_other
+
+    def close(self):
+        self._changed()
+
+
+def _serve(conn, syncset_class):
+    """
+    The main loop of a shard worker process. Receives (method, args) calls and sends back
+    (True, result) or (False, exception) until the connection is closed.
+    """
+    server = _ShardServer(syncset_class)
+    try:
+        while True:
+            try:
+                method, args = conn.recv()
+            except EOFError:
+                return
+            if method is None:
+                return
+            try:
+                result = True, getattr(server, method)(*args)
+            except Exception as e:
+                result = False, e
+            conn.send(result)
+    finally:
+        server.close()
+        conn.close()
+
+
+class _Shard:
+    """
+    The calling side of one shard. ``send()`` starts a call and ``recv()`` waits for its result, so
+    calls to all shards can run in parallel. Without a multiprocessing ``context``, the shard is
+    served in the calling process.
+    """
+    def __init__(self, syncset_class, context):
+        self._server = None
+        self._process = None
+        self._result = None
+        if context is None:
+            self._server = _ShardServer(syncset_class)
+            return
+        self._conn, child_conn = context.Pipe()
+        self._process = context.Process(target=_serve, args=(child_conn, syncset_class), daemon=True,
+                                        name='syncset-shard')
+        self._process.start()
+        child_conn.close()
+
+    def send(self, method, *args):
+        if self._server is None:
+            self._conn.send((method, args))
+            return
+        try:
+            self._result = True, getattr(self._server, method)(*args)
+        except Exception as e:
+            self._result = False, e
+
+    def recv(self):
+        """
+        Return the (ok, result) pair of the pending call
+        """
+        if self._server is None:
+            return self._conn.recv()
+        result, self._result = self._result, None
+        return result
+
+    def call(self, method, *args):
+        self.send(method, *args)
+        return _gather([self])[0]
+
+    def close(self):
+        if self._server is not None:
+            self._server.close()
+        elif self._process is not None:
+            try:
+                self._conn.send((None, ()))
+            except OSError:
+                # The worker is gone already
+                pass
+            self._process.join()
+            self._conn.close()
+            self._process = None
+
+
+def _gather(shards):
+    """
+    Wait for the pending calls of ``shards``, and return their results or raise the first error.
+    All results are received before raising, so no shard is left with an unread reply.
+    """
+    results = [shard.recv() for shard in shards]
+    for ok, result in results:
+        if not ok:
+            raise result
+    return [result for _, result in results]
+
+
+class ShardedSyncSet:
+    """
+    A syncset partitioned into ``shards`` syncsets of type ``syncset_class``, each held by its own
+    worker process. Members are routed to a shard by ``stable_hash()`` of their id, so two sharded
+    syncsets with the same number of shards place a given id in the same shard, also across
+    processes. Members must be picklable.
+
+    ``add()``, ``update()``, ``remove()``, ``discard()``, ``in``, ``contains_similar()``, ``[]`` and
+    ``get()`` are sent to the shard of the id. ``update()`` sends members in batches of
+    ``BLOCK_SIZE`` to all shards in parallel. Iteration fetches the members of one shard at a time.
+
+    ``diff()`` against another ``ShardedSyncSet`` with the same layout runs in all shards in
+    parallel. Each shard of self writes its (id, changekey) table to a
+    ``multiprocessing.shared_memory`` block, which is kept until the shard is mutated, and the same
+    shard of ``other`` diffs its members against that table. Only the members of the differing ids
+    are sent back, and returned in the same four-tuple as ``OneWaySyncSet.diff()`` and
+    ``TwoWaySyncSet.diff()``.
+
+    With ``processes=False``, the shards are served in the calling process, e.g. for debugging.
+    Call ``close()``, or use the syncset as a context manager, to stop the worker processes and free
+    the shared memory blocks.
+    """
+    def __init__(self, iterable=None, shards=4, syncset_class=TwoWaySyncSet, processes=True):
+        if shards < 1:
+            raise ValueError("'shards' must be a positive integer")
+        if not issubclass(syncset_class, (OneWaySyncSet, TwoWaySyncSet)):
+            raise ValueError("'syncset_class' must be a OneWaySyncSet or TwoWaySyncSet class")
+        self.syncset_class = syncset_class
+        context = multiprocessing.get_context() if processes else None
+        self._shards = []
+        try:
+            for _ in range(shards):
+                self._shards.append(_Shard(syncset_class, context))
+            if iterable:
+                self.update(iterable)
+        except BaseException:
+            self.close()
+            raise
+
+    def _shard_for(self, item_id):
+        return self._shards[stable_hash(item_id) % len(self._shards)]
+
+    def _call_all(self, method, *args):
+        for shard in self._shards:
+            shard.send(method, *args)
+        return _gather(self._shards)
+
+    def add(self, item):
+        self._shard_for(item.get_id()).call('add_many', [item])
+
+    def update(self, *others):
+        for other in others:
+            items = iter(other)
+            while True:
+                block = list(islice(items, BLOCK_SIZE))
+                if not block:
+                    break
+                by_shard = {}
+                for item in block:
+                    by_shard.setdefault(self._shard_for(item.get_id()), []).append(item)
+                for shard, shard_items in by_shard.items():
+                    shard.send('add_many', shard_items)
+                _gather(by_shard)
+        return self
+
+    def remove(self, item):
+        self._shard_for(item.get_id()).call('remove', item)
+
+    def discard(self, item):
+        self._shard_for(item.get_id()).call('discard', item)
+
+    def clear(self):
+        self._call_all('clear')
+
+    def __contains__(self, item):
+        return self._shard_for(item.get_id()).call('contains', item)
+
+    def contains_similar(self, item):
+        return self._shard_for(item.get_id()).call('contains_similar', item)
+
+    def __getitem__(self, item_id):
+        item = self._shard_for(item_id).call('get', item_id)
+        if item is None:
+            raise KeyError(item_id)
+        return item
+
+    def get(self, item_id, default=None):
+        item = self._shard_for(item_id).call('get', item_id)
+        return default if item is None else item
+
+    def __len__(self):
+        return sum(self._call_all('len'))
+
+    def __iter__(self):
+        for shard in self._shards:
+            yield from shard.call('members')
+
+    def keys(self):
+        """
+        Return the unique ids of the syncset
+        """
+        for shard in self._shards:
+            yield from shard.call('keys')
+
+    def __repr__(self):
+        return '%s(shards=%s, syncset_class=%s, len=%s)' % (
+            self.__class__.__name__, len(self._shards), self.syncset_class.__name__, len(self))
+
+    def diff(self, other):
+        """
+        Return four syncsets with the same meaning as ``diff()`` of ``syncset_class``. ``other`` must
+        be a ``ShardedSyncSet`` with the same number of shards and the same syncset class.
+        """
+        if not isinstance(other, ShardedSyncSet) or len(other._shards) != len(self._shards) \
+                or other.syncset_class is not self.syncset_class:
+            raise ValueError('Can only diff against a ShardedSyncSet with the same layout')
+        two_way = issubclass(self.syncset_class, TwoWaySyncSet)
+        blocks = self._call_all('export')
+        for shard, block in zip(other._shards, blocks):
+            shard.send('diff', block, two_way)
+        results = _gather(other._shards)
+        # Fetch the differing members from the shards holding them
+        for self_shard, result in zip(self._shards, results):
+            log.debug('sharded diff: shard result sizes %s', [len(ids) for ids in result])
+            only_in_self, _, changed_in_self, _ = result
+            self_shard.send('get_many', only_in_self + changed_in_self)
+        self_members = _gather(self._shards)
+        for other_shard, (_, only_in_other, _, changed_in_other) in zip(other._shards, results):
+            other_shard.send('get_many', only_in_other + changed_in_other)
+        other_members = _gather(other._shards)
+        buckets = tuple(self.syncset_class() for _ in range(4))
+        for (only_in_self, only_in_other, _, _), self_items, other_items in zip(results, self_members, other_members):
+            buckets[0]._add_many(self_items[:len(only_in_self)])
+            buckets[1]._add_many(other_items[:len(only_in_other)])
+            buckets[2]._add_many(self_items[len(only_in_self):])
+            buckets[3]._add_many(other_items[len(only_in_other):])
+        return buckets
+
+    def close(self):
+        """
+        Stop the worker processes and release the shared memory blocks
+        """
+        for shard in self._shards:
+            shard.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
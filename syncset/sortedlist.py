@@ -0,0 +1,154 @@
+"""
+A sorted list of member ids, used as the ordered-id index of syncsets.
+"""
+from bisect import bisect_left, bisect_right, insort
+from itertools import chain, islice
+
+
+class SortedIdList:
+    """
+    A sorted list of unique, totally ordered values, stored as a list of sorted blocks of at most
+    ``2 * load`` values. Inserts and removals only shift the values of one block, and
+    ``irange()`` finds the first value of a range by bisecting the block maxima and then the
+    block, so range queries take time proportional to the number of values returned.
+    """
+    load = 1000
+
+    def __init__(self, iterable=()):
+        self._blocks = []
+        self._maxes = []
+        self._len = 0
+        self.update(iterable)
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        return chain.from_iterable(self._blocks)
+
+    def __reversed__(self):
+        return chain.from_iterable(reversed(block) for block in reversed(self._blocks))
+
+    def __contains__(self, value):
+        i = bisect_left(self._maxes, value)
+        if i == len(self._maxes):
+            return False
+        block = self._blocks[i]
+        return block[bisect_left(block, value)] == value
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, list(self))
+
+    def _rebuild(self, values):
+        self._blocks = [values[i:i + self.load] for i in range(0, len(values), self.load)]
+        self._maxes = [block[-1] for block in self._blocks]
+        self._len = len(values)
+
+    def update(self, iterable):
+        """
+        Add many values at once. Values must not be present already.
+        """
+        values = list(iterable)
+        if not values:
+            return
+        if self._len < len(values) * 8:
+            # Cheaper to sort everything and cut new blocks
+            values.extend(self)
+            values.sort()
+            self._rebuild(values)
+        else:
+            for value in values:
+                self.add(value)
+
+    def add(self, value):
+        """
+        Add a value which must not be present already
+        """
+        maxes = self._maxes
+        if not maxes:
+            self._blocks.append([value])
+            maxes.append(value)
+            self._len = 1
+            return
+        i = bisect_left(maxes, value)
+        if i == len(maxes):
+            i -= 1
+            self._blocks[i].append(value)
+            maxes[i] = value
+        else:
+            insort(self._blocks[i], value)
+        self._len += 1
+        block = self._blocks[i]
+        if len(block) > 2 * self.load:
+            self._blocks[i:i + 1] = [block[:self.load], block[self.load:]]
+            maxes[i:i + 1] = [block[self.load - 1], block[-1]]
+
+    def remove(self, value):
+        """
+        Remove a value. Raises ``ValueError`` if it is not present.
+        """
+        maxes = self._maxes
+        i = bisect_left(maxes, value)
+        if i == len(maxes):
+            raise ValueError('%r not in list' % (value,))
+        block = self._blocks[i]
+        j = bisect_left(block, value)
+        if block[j] != value:
+            raise ValueError('%r not in list' % (value,))
+        del block[j]
+        self._len -= 1
+        if not block:
+            del self._blocks[i]
+            del maxes[i]
+        elif j == len(block):
+            maxes[i] = block[-1]
+
+    def discard(self, value):
+        if value in self:
+            self.remove(value)
+
+    def clear(self):
+        self._blocks = []
+        self._maxes = []
+        self._len = 0
+
+    def irange(self, lo=None, hi=None, inclusive=(True, False), reverse=False):
+        """
+        Iterate over the values between ``lo`` and ``hi``. A bound of ``None`` is unbounded.
+        ``inclusive`` tells whether each bound is included, and defaults to a half-open range.
+        """
+        blocks, maxes = self._blocks, self._maxes
+        if lo is None:
+            i, j = 0, 0
+        else:
+            i = (bisect_left if inclusive[0] else bisect_right)(maxes, lo)
+            j = (bisect_left if inclusive[0] else bisect_right)(blocks[i], lo) if i < len(blocks) else 0
+        if hi is None:
+            k, m = len(blocks) - 1, len(blocks[-1]) if blocks else 0
+        else:
+            k = (bisect_right if inclusive[1] else bisect_left)(maxes, hi)
+            if k < len(blocks):
+                m = (bisect_right if inclusive[1] else bisect_left)(blocks[k], hi)
+            else:
+                k, m = len(blocks) - 1, len(blocks[-1]) if blocks else 0
+        if i > k or (i == k and j >= m):
+            return iter(())
+        if i == k:
+            chunks = [islice(blocks[i], j, m)]
+        else:
+            chunks = [islice(blocks[i], j, None)]
+            chunks.extend(blocks[i + 1:k])
+            chunks.append(islice(blocks[k], 0, m))
+        if reverse:
+            return reversed(list(chain.from_iterable(chunks)))
+        return chain.from_iterable(chunks)
+
+    def iprefix(self, prefix):
+        """
+        Iterate over the values starting with ``prefix``. Works for strings, bytes and tuples.
+        """
+        n = len(prefix)
+        for value in self.irange(lo=prefix):
+            if value[:n] != prefix:
+                return
+            yield value
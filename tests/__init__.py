@@ -1,8 +1,44 @@
 # -*- coding: utf-8 -*-
 
+import asyncio
+import gc
+import hashlib
+import os
+import pickle
+import socket
+import sqlite3
+import tempfile
+import threading
+import time
 import unittest
-from datetime import datetime
-from syncset import BaseSyncSet, OneWaySyncSet, TwoWaySyncSet, SyncSetMember, UndefinedBehaviorError
+from unittest import mock
+from datetime import date, datetime, timezone
+from email.utils import format_datetime
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from syncset import BaseSyncSet, OneWaySyncSet, TwoWaySyncSet, SyncSetMember, UndefinedBehaviorError, Tombstone, \
+    Tombstones, Delta, DeltaRecord, DiffCache, member_type, _in_sample
+from syncset.bounded import BoundedOneWaySyncSet, BoundedTwoWaySyncSet, approximate_size
+from syncset.concurrent import ConcurrentOneWaySyncSet, ConcurrentTwoWaySyncSet
+from syncset.fsscan import scan_tree
+from syncset.hashcache import HashCache
+from syncset.httpsync import HTTPAdapter
+from syncset.ingest import IngestBuffer
+from syncset.iblt import IBLT, IBLTDecodeError, diff_iblt, reconcile
+from syncset.lazy import PayloadLoader
+from syncset.ordered import SortedOneWaySyncSet, SortedTwoWaySyncSet
+from syncset.resumable import ResumableDiff
+from syncset.sortedlist import SortedIdList
+try:
+    from syncset.sharded import ShardedSyncSet, stable_hash
+except ImportError:
+    # syncset.sharded needs multiprocessing.shared_memory from Python 3.8
+    ShardedSyncSet = stable_hash = None
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    # http.server.ThreadingHTTPServer needs Python 3.7
+    daemon_threads = True
 
 
 # Create a minimal implementation of the SyncSetMember interface
@@ -20,6 +56,9 @@ class TestMember(SyncSetMember):
         return self.changekey
 
 
+SlotsMember = member_type('SlotsMember', id='uid', changekey='changekey', fields=['body'])
+
+
 class _OneWayBaseClass(unittest.TestCase):
 
     def setUp(self):
@@ -110,6 +149,43 @@ class SyncSetMemberTest(unittest.TestCase):
         # according to SyncSetMember specs.
 
 
+class MemberTypeTest(unittest.TestCase):
+    def test_member_type(self):
+        a1 = SlotsMember('a', 1, body='foo')
+        self.assertIsInstance(a1, SyncSetMember)
+        self.assertEqual((a1.get_id(), a1.get_changekey(), a1.body), ('a', 1, 'foo'))
+        self.assertIsNone(SlotsMember('a', 1).body)
+        self.assertFalse(hasattr(a1, '__dict__'))
+        self.assertEqual(hash(a1), hash('a'))
+        self.assertEqual(repr(a1), "SlotsMember('a', 1, 'foo')")
+        self.assertEqual(pickle.loads(pickle.dumps(a1)).__getstate__(), ('a', 1, 'foo'))
+
+    def test_compare(self):
+        # Generated comparisons must match the generic SyncSetMember implementation, also against other types
+        values = [('a', 1), ('a', 2), ('b', 1), ('b', 2)]
+        for x in values:
+            for y in values:
+                for other in (SlotsMember(*y), TestMember(*y)):
+                    expected, generic = TestMember(*x), TestMember(*y)
+                    member = SlotsMember(*x)
+                    self.assertEqual(member.__cmp__(other), expected.__cmp__(generic))
+                    for op in ('__eq__', '__lt__', '__le__', '__gt__', '__ge__'):
+                        self.assertEqual(getattr(member, op)(other), getattr(expected, op)(generic), (x, y, op))
+
+    def test_syncset(self):
+        myset = TwoWaySyncSet([SlotsMember('a', 1), TestMember('b', 2)])
+        myset.add(SlotsMember('a', 2))
+        myset.add(SlotsMember('b', 1))
+        self.assertEqual(myset['a'].changekey, 2)
+        self.assertIsInstance(myset['b'], TestMember)
+
+    def test_invalid(self):
+        for kwargs in (dict(id='uid', changekey='uid'), dict(id='class', changekey='ck'),
+                       dict(id='uid', changekey='ck', fields=['_private']), dict(id='1', changekey='ck')):
+            with self.assertRaises(ValueError):
+                member_type('Invalid', **kwargs)
+
+
 class BaseSyncSetTest(unittest.TestCase):
     def test_add(self):
         # diff() and intersection() semantics are left as an implementation detail for subclasses
@@ -239,6 +315,17 @@ class OneWaySyncSetTest(_OneWayBaseClass):
         self.assertRaises(KeyError, self.myslave.pop)
 
     # Strictly dict functionality
+    def test_iter_chunks(self):
+        self.myslave.update([TestMember(i, 1) for i in range(7)])
+        chunks = list(self.myslave.iter_chunks(3))
+        self.assertEqual([len(c) for c in chunks], [3, 3, 1])
+        self.assertIsInstance(chunks[0], tuple)
+        self.assertEqual(OneWaySyncSet(m for c in chunks for m in c), self.myslave)
+        self.assertEqual(sorted(i for c in self.myslave.iter_id_chunks(5) for i in c), list(range(7)))
+        self.assertEqual(list(OneWaySyncSet().iter_chunks(3)), [])
+        with self.assertRaises(ValueError):
+            self.myslave.iter_chunks(0)
+
     def test_keys(self):
         self.myslave.add(self.a1)
         self.assertEqual(list(self.myslave.keys()), [self.a1.get_id()])
@@ -490,6 +577,29 @@ class OneWaySyncSetTest(_OneWayBaseClass):
         self.assertIn(self.c3, self.myslave)
         self.assertNotIn(self.b1, self.myslave)
 
+    def test_inplace_operators_dont_copy(self):
+        # In-place operators must mutate directly instead of building temporary syncsets
+        self.myslave = OneWaySyncSet([self.a1, self.b1, self.c1])
+        self.mymaster = OneWaySyncSet([self.b2, self.c1])
+        with mock.patch.object(OneWaySyncSet, 'intersection', side_effect=AssertionError), \
+                mock.patch.object(OneWaySyncSet, 'difference', side_effect=AssertionError), \
+                mock.patch.object(OneWaySyncSet, 'copy', side_effect=AssertionError):
+            self.myslave.intersection_update(self.mymaster)
+            self.assertEqual(self.myslave, OneWaySyncSet([self.b1, self.c1]))
+            self.myslave.symmetric_difference_update(OneWaySyncSet([self.a3, self.b2]))
+            self.assertEqual(self.myslave, OneWaySyncSet([self.a3, self.c1]))
+            self.myslave.sync(deleted=[self.c1], updated=[self.a1], new=[self.b3])
+            self.assertEqual(self.myslave, OneWaySyncSet([self.b3]))
+
+    def test_inplace_operators_plain_iterables(self):
+        self.myslave = OneWaySyncSet([self.a1, self.b1, self.c1])
+        self.myslave.intersection_update([self.a2, self.b1], (self.b3,))
+        self.assertEqual(self.myslave, OneWaySyncSet([self.b1]))
+        self.myslave.symmetric_difference_update([self.b2, self.c2])
+        self.assertEqual(self.myslave, OneWaySyncSet([self.c2]))
+        self.myslave ^= self.myslave
+        self.assertEqual(self.myslave, OneWaySyncSet())
+
     # Diff tests
     def test_oneway_diff(self):
         for m in (self.a2, self.b2, self.c2):
@@ -940,5 +1050,1428 @@ class TwoWaySyncSetTest(_TwoWayBaseClass):
         self.assertEqual(self.myset, self.otherset)
 
 
+class DiffEstimateTest(unittest.TestCase):
+    def test_small_sets_are_exact(self):
+        mine = TwoWaySyncSet([TestMember(i, 1) for i in range(100)])
+        theirs = TwoWaySyncSet([TestMember(i, 1 + i % 2) for i in range(10, 120)])
+        estimate = mine.diff_estimate(theirs, error=0.05)
+        self.assertEqual(estimate.sample_rate, 1)
+        self.assertEqual(estimate[:4], tuple(len(bucket) for bucket in mine.diff(theirs)))
+
+    def test_bypasses_diff_cache(self):
+        mine = TwoWaySyncSet([TestMember(i, 1) for i in range(100)])
+        theirs = TwoWaySyncSet([TestMember(i, 2) for i in range(50, 150)])
+        cache = DiffCache()
+        with mock.patch.object(TwoWaySyncSet, 'diff_cache', cache):
+            self.assertEqual(mine.diff_estimate(theirs, error=0.05)[:4], (50, 50, 0, 50))
+        # The throwaway samples must not fill the cache
+        self.assertEqual((cache.hits, cache.misses, len(cache._results)), (0, 0, 0))
+
+    def test_estimate(self):
+        n = 20000
+        mine = OneWaySyncSet([TestMember(i, 1) for i in range(n)])
+        # 10% only in mine, 10% only in theirs and 5% changed
+        theirs = OneWaySyncSet([TestMember(i, 2 if i % 20 == 0 else 1) for i in range(n // 10, n + n // 10)])
+        error = 0.05
+        estimate = mine.diff_estimate(theirs, error=error)
+        self.assertLess(estimate.sample_rate, 1)
+        for estimated, exact in zip(estimate, (n // 10, n // 10, n // 20, n // 20)):
+            self.assertAlmostEqual(estimated, exact, delta=error * n)
+
+    def test_samples_follow_mutations(self):
+        mine = TwoWaySyncSet([TestMember(i, 1) for i in range(5000)])
+        mine.diff_estimate(TwoWaySyncSet(), error=0.1)
+        levels = list(mine._samples)
+        self.assertEqual(len(levels), 1)
+        mine.update([TestMember(i, 2) for i in range(4000, 6000)])
+        mine.difference_update([TestMember(i, 1) for i in range(1000)])
+        mine.pop()
+        for level in levels:
+            expected = {i: m for i, m in mine.item_dict.items() if _in_sample(i, level)}
+            self.assertEqual(mine._sample(level), expected)
+            self.assertTrue(all(m is mine[i] for i, m in mine._sample(level).items()))
+        mine.clear()
+        self.assertEqual(mine._sample(levels[0]), {})
+        with self.assertRaises(ValueError):
+            mine.diff_estimate(mine, error=0)
+
+
+class TombstonesTest(_TwoWayBaseClass):
+    def test_eviction(self):
+        now = [0]
+        tombstones = Tombstones(ttl=10, max_count=3, clock=lambda: now[0])
+        for i, item_id in enumerate('abcd'):
+            now[0] = i
+            tombstones.add(item_id, 1)
+        # Count limit evicts the oldest
+        self.assertEqual(list(tombstones), ['b', 'c', 'd'])
+        # Re-deleting an id moves it to the end of the time-ordered index
+        tombstones.add('b', 2)
+        self.assertEqual(list(tombstones), ['c', 'd', 'b'])
+        self.assertEqual(tombstones.get('b'), Tombstone(2, 3))
+        now[0] = 12
+        self.assertEqual(list(tombstones), ['d', 'b'])
+        now[0] = 20
+        self.assertEqual(len(tombstones), 0)
+        self.assertNotIn('b', tombstones)
+        # Replaced and discarded entries are skipped when evicting by count
+        tombstones = Tombstones(max_count=2)
+        for i in range(1000):
+            tombstones.add('a', i)
+        tombstones.add('b', 1)
+        tombstones.add('c', 1)
+        tombstones.discard('b')
+        tombstones.add('d', 1)
+        self.assertEqual(tombstones.items(), [('c', tombstones.get('c')), ('d', tombstones.get('d'))])
+        self.assertLess(len(tombstones._queue), 100)
+
+    def test_remove(self):
+        self.myset.add(self.a2)
+        with self.assertRaises(ValueError):
+            self.myset.remove(self.a2, tombstone=True)
+        self.myset.tombstones = Tombstones()
+        # Discarding an absent member records nothing
+        self.myset.discard(self.c1, tombstone=True)
+        self.assertNotIn('c', self.myset.tombstones)
+        self.myset.add(self.b1)
+        self.myset.remove(self.b1)
+        self.assertNotIn('b', self.myset.tombstones)
+        # The changekey of the deleted member is recorded, not the one of the argument
+        self.myset.discard(self.a1, tombstone=True)
+        self.assertEqual(self.myset.tombstones.get('a').changekey, 2)
+
+    def test_twoway_add(self):
+        self.myset.tombstones = Tombstones()
+        self.myset.add(self.a2)
+        self.myset.remove(self.a2, tombstone=True)
+        self.assertTrue(self.myset.is_tombstoned(self.a1))
+        self.assertTrue(self.myset.is_tombstoned(self.a2))
+        self.assertFalse(self.myset.is_tombstoned(self.a3))
+        self.myset.add(self.a1)
+        self.myset.add(self.a2)
+        self.assertEqual(len(self.myset), 0)
+        # A newer version resurrects the member and drops the tombstone
+        self.myset.add(self.a3)
+        self.assertIn(self.a3, self.myset)
+        self.assertNotIn('a', self.myset.tombstones)
+
+    def test_oneway_add(self):
+        myslave = OneWaySyncSet([self.a2])
+        myslave.tombstones = Tombstones()
+        myslave.remove(self.a2, tombstone=True)
+        # The master wins
+        myslave.add(self.a1)
+        self.assertIn(self.a1, myslave)
+        self.assertNotIn('a', myslave.tombstones)
+
+    def test_twoway_diff(self):
+        self.myset.tombstones = Tombstones()
+        self.otherset.tombstones = Tombstones()
+        self.myset.update([self.a2, self.b1, self.c1])
+        self.otherset.update([self.a2, self.b1, self.c2])
+        self.myset.remove(self.a2, tombstone=True)
+        self.otherset.remove(self.b1, tombstone=True)
+        only_in_self, only_in_other, newer_in_self, newer_in_other = self.myset.diff(self.otherset)
+        self.assertEqual(only_in_self, TwoWaySyncSet())
+        self.assertEqual(only_in_other, TwoWaySyncSet())
+        self.assertEqual(newer_in_self, TwoWaySyncSet())
+        self.assertEqual(newer_in_other, TwoWaySyncSet([self.c2]))
+        # A newer version on the other side is still reported
+        self.otherset.add(self.a3)
+        self.assertEqual(self.myset.diff(self.otherset)[1], TwoWaySyncSet([self.a3]))
+
+
+class DeltaTest(_OneWayBaseClass):
+    def test_oneway_delta(self):
+        self.myslave.update([self.a1, self.b1, self.c1])
+        self.mymaster.update([self.a2, self.b1, TestMember('d', 1)])
+        delta = self.myslave.delta(self.mymaster)
+        self.assertEqual(delta.deleted, ['c'])
+        self.assertEqual(delta.updated, [DeltaRecord('a', 2, self.a2)])
+        self.assertEqual(len(delta.new), 1)
+        self.assertEqual(len(delta), 3)
+        replica = OneWaySyncSet([self.a1, self.b1, self.c1])
+        replica.apply_delta(Delta.from_bytes(delta.to_bytes()))
+        self.assertEqual(replica, self.mymaster)
+
+    def test_twoway_delta(self):
+        myset = TwoWaySyncSet([self.a2, self.b1, self.c1])
+        otherset = TwoWaySyncSet([self.a1, self.b2])
+        delta = myset.delta(otherset)
+        # Members missing in the other set are not deletions
+        self.assertEqual(delta.deleted, [])
+        self.assertEqual(delta.updated, [DeltaRecord('b', 2, self.b2)])
+        self.assertEqual(delta.new, [])
+        otherset.tombstones = Tombstones()
+        otherset.add(self.c1)
+        otherset.remove(self.c1, tombstone=True)
+        self.assertEqual(myset.delta(otherset).deleted, ['c'])
+
+    def test_payload(self):
+        self.mymaster.update([self.a2, self.b1])
+        delta = self.myslave.delta(self.mymaster, payload=lambda item: item.get_id().upper())
+        self.assertEqual(sorted(delta.new), [('a', 2, 'A'), ('b', 1, 'B')])
+        self.myslave.apply_delta(delta, factory=lambda item_id, changekey, payload: TestMember(payload, changekey))
+        self.assertEqual(sorted(self.myslave.keys()), ['A', 'B'])
+
+    def test_compose(self):
+        d1 = Delta(deleted=['a', 'b'], updated=[('c', 2, 'c2'), ('d', 2, 'd2')], new=[('e', 1, 'e1'), ('f', 1, 'f1')])
+        d2 = Delta(deleted=['c', 'e'], updated=[('d', 3, 'd3'), ('f', 2, 'f2')], new=[('a', 3, 'a3')])
+        combined = d1 + d2
+        self.assertEqual(combined.deleted, ['b', 'c'])
+        self.assertEqual(sorted(combined.updated), [('a', 3, 'a3'), ('d', 3, 'd3')])
+        self.assertEqual(combined.new, [('f', 2, 'f2')])
+        self.assertEqual(Delta.from_bytes(combined.to_bytes()), combined)
+        # Applying the combined delta is the same as applying both in turn
+        members = {r.payload: TestMember(r.id, r.changekey) for r in d1.updated + d1.new + d2.updated + d2.new}
+
+        def factory(item_id, changekey, payload):
+            return members[payload]
+
+        base = [TestMember(i, 1) for i in 'abcd']
+        one, two = OneWaySyncSet(base), OneWaySyncSet(base)
+        one.apply_delta(d1, factory=factory).apply_delta(d2, factory=factory)
+        two.apply_delta(combined, factory=factory)
+        self.assertEqual(one, two)
+
+
+class ResumableDiffTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'diff.checkpoint')
+        self.mine = [TestMember(i, 1) for i in range(0, 80)]
+        self.theirs = [TestMember(i, i % 3) for i in range(20, 100)]
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _test_resume(self, syncset_class):
+        a, b = syncset_class(self.mine), syncset_class(self.theirs)
+        expected = a.diff(b)
+
+        class Crash(Exception):
+            pass
+
+        class CrashingDiff(ResumableDiff):
+            appended = 0
+
+            def _append(self, record):
+                if self.appended == 3:
+                    raise Crash()
+                self.appended += 1
+                super()._append(record)
+
+        with self.assertRaises(Crash):
+            CrashingDiff(a, b, self.path, ranges=5).run()
+        # Simulate a partially written record
+        with open(self.path, 'ab') as f:
+            f.write(b'\x80\x05\x95garbage')
+        resumed = ResumableDiff(a, b, self.path)
+        with mock.patch.object(syncset_class, '_diff', side_effect=syncset_class._diff, autospec=True) as diff, \
+                self.assertLogs('syncset', 'WARNING'):
+            result = resumed.run()
+        # Header and two ranges were written before the crash
+        self.assertEqual(diff.call_count, 3)
+        self.assertEqual(len(resumed.boundaries), 4)
+        for bucket, expected_bucket in zip(result, expected):
+            self.assertIsInstance(bucket, syncset_class)
+            self.assertEqual(bucket, expected_bucket)
+        # Everything is in the checkpoint now
+        with mock.patch.object(syncset_class, 'diff') as diff:
+            result = ResumableDiff(a, b, self.path).run()
+        self.assertEqual(diff.call_count, 0)
+        self.assertEqual(result, expected)
+        os.remove(self.path)
+
+    def test_resume(self):
+        self._test_resume(OneWaySyncSet)
+        self._test_resume(TwoWaySyncSet)
+
+    def test_boundaries(self):
+        a, b = TwoWaySyncSet(self.mine), TwoWaySyncSet(self.theirs)
+        self.assertEqual(ResumableDiff(a, b, self.path, boundaries=[50]).run(), a.diff(b))
+        with self.assertRaises(ValueError):
+            ResumableDiff(a, b, self.path, boundaries=[40]).run()
+        os.remove(self.path)
+        self.assertEqual(ResumableDiff(TwoWaySyncSet(), TwoWaySyncSet(), self.path).run(), (TwoWaySyncSet(),) * 4)
+
+
+class LazyPayloadTest(unittest.TestCase):
+    def setUp(self):
+        self.fetched = []
+
+        def fetch(ids):
+            self.fetched.append(list(ids))
+            return {item_id: 'body of %s' % item_id for item_id in ids}
+
+        self.loader = PayloadLoader(fetch, batch_size=3, cache_size=4)
+
+    def test_stub(self):
+        stub = self.loader.stub('a', 1)
+        self.assertEqual((stub.get_id(), stub.get_changekey()), ('a', 1))
+        self.assertEqual(stub.payload, 'body of a')
+        self.assertEqual(stub.payload, 'body of a')
+        self.assertEqual(self.fetched, [['a']])
+        self.assertEqual((self.loader.hits, self.loader.fetches, self.loader.fetched), (1, 1, 1))
+        # A new version of the member is not served from the cache
+        self.assertEqual(self.loader.stub('a', 2).payload, 'body of a')
+        self.assertEqual(self.fetched, [['a'], ['a']])
+
+    def test_diff_and_prefetch(self):
+        mine = OneWaySyncSet(self.loader.stubs([('a', 1), ('b', 1), ('c', 1)]))
+        master = OneWaySyncSet(self.loader.stubs([(i, 2) for i in 'abcdefg']))
+        _, only_in_master, _, updated_in_master = mine.diff(master)
+        self.assertEqual(self.fetched, [])
+        members = sorted(only_in_master, key=lambda m: m.get_id())
+        self.loader.prefetch(members[1:])
+        self.assertEqual(members[0].payload, 'body of d')
+        self.assertEqual(members[1].payload, 'body of e')
+        self.assertEqual(members[3].payload, 'body of g')
+        self.assertEqual(self.fetched, [['d', 'e', 'f'], ['g']])
+
+    def test_iter_payloads(self):
+        members = list(self.loader.stubs([(i, 1) for i in 'abcdefg']))
+        members[0].payload
+        result = list(self.loader.iter_payloads(members))
+        self.assertEqual([payload for _, payload in result], ['body of %s' % i for i in 'abcdefg'])
+        self.assertEqual(self.fetched, [['a'], ['b', 'c'], ['d', 'e', 'f'], ['g']])
+        # The cache is bounded
+        self.assertEqual(len(self.loader._cache), 4)
+        with self.assertRaises(ValueError):
+            PayloadLoader(dict, batch_size=10, cache_size=5)
+
+
+class IBLTTest(unittest.TestCase):
+    def test_decode(self):
+        a, b = IBLT(30), IBLT(30)
+        for i in range(1000):
+            a.add('item%s' % i, 1)
+            b.add('item%s' % i, 1)
+        a.add('only_a', 1)
+        a.remove('item3', 1)
+        a.add('item3', 2)
+        b.add('only_b', datetime(2020, 1, 1))
+        only_in_a, only_in_b = IBLT.from_bytes((a - b).to_bytes()).decode()
+        self.assertEqual(only_in_a, {'only_a': 1, 'item3': 2})
+        self.assertEqual(only_in_b, {'only_b': datetime(2020, 1, 1), 'item3': 1})
+        with self.assertRaises(ValueError):
+            a - IBLT(60)
+
+    def test_decode_error(self):
+        a = IBLT(6)
+        for i in range(50):
+            a.add(i, 1)
+        with self.assertRaises(IBLTDecodeError):
+            a.decode()
+
+    def _test_reconcile(self, syncset_class):
+        mine = syncset_class([TestMember(i, 1) for i in range(2000)])
+        theirs = syncset_class([TestMember(i, 1) for i in range(5, 2003)])
+        for i in (100, 200, 300):
+            theirs.add(TestMember(i, 2))
+        mine.add(TestMember(400, 2))
+        if syncset_class is TwoWaySyncSet:
+            # Members deleted on the other side aren't reported as only in mine
+            theirs.tombstones = Tombstones()
+            theirs.remove(theirs[50], tombstone=True)
+            theirs.remove(theirs[60], tombstone=True)
+            mine.add(TestMember(60, 3))
+        result = diff_iblt(mine, theirs, expected_difference=12)
+        for bucket, expected_bucket in zip(result, mine.diff(theirs)):
+            self.assertIsInstance(bucket, syncset_class)
+            self.assertEqual(bucket, expected_bucket)
+
+    def test_reconcile(self):
+        self._test_reconcile(OneWaySyncSet)
+        self._test_reconcile(TwoWaySyncSet)
+
+    def test_fallback(self):
+        mine = TwoWaySyncSet([TestMember(i, 1) for i in range(100)])
+        theirs = TwoWaySyncSet([TestMember(i, 2) for i in range(50, 200)])
+        sizes, fetched = [], []
+
+        def fetch_sketch(size):
+            sizes.append(size)
+            return IBLT.from_bytes(IBLT.from_syncset(theirs, size).to_bytes())
+
+        def fetch_members(ids):
+            fetched.extend(ids)
+            return [theirs[i] for i in ids]
+
+        result = reconcile(mine, fetch_sketch, fetch_members, expected_difference=5)
+        self.assertEqual(result, mine.diff(theirs))
+        self.assertGreater(len(sizes), 1)
+        self.assertEqual(sizes, [10 * 2 ** i for i in range(len(sizes))])
+        self.assertEqual(sorted(fetched), list(range(50, 200)))
+        with self.assertRaises(IBLTDecodeError):
+            reconcile(mine, fetch_sketch, fetch_members, expected_difference=5, max_size=40)
+
+    def test_default_max_size(self):
+        mine = TwoWaySyncSet([TestMember(i, 1) for i in range(100)])
+        theirs = TwoWaySyncSet([TestMember(i, 1) for i in range(100)])
+        sizes = []
+
+        def fetch_sketch(size):
+            # A sketch which can never be decoded
+            sizes.append(size)
+            sketch = IBLT.from_syncset(theirs, size)
+            sketch.hash_sums = [h ^ 1 for h in sketch.hash_sums]
+            return sketch
+
+        with self.assertRaises(IBLTDecodeError):
+            reconcile(mine, fetch_sketch, lambda ids: [], expected_difference=5)
+        self.assertLessEqual(sizes[-1], 8 * 200 + 6)
+
+
+class LoadersTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _write(self, name, data):
+        path = os.path.join(self.tmpdir.name, name)
+        with open(path, 'w', encoding='utf-8', newline='') as f:
+            f.write(data)
+        return path
+
+    def test_add_many(self):
+        items = [TestMember(i % 5, i) for i in range(12)] + [TestMember(1, 0)]
+        for syncset_class in (OneWaySyncSet, TwoWaySyncSet):
+            expected = syncset_class([TestMember(0, 100)]).update(items)
+            result = syncset_class([TestMember(0, 100)])._add_many(items)
+            self.assertEqual(result, expected)
+            self.assertEqual(len(result.item_dict), set.__len__(result))
+
+    def test_csv(self):
+        path = self._write('pages.csv', 'url,last_modified,title\nfoo,2012-01-01,Foo\nbar,2011-12-08,Bar\n'
+                                        'foo,2012-02-01,Foo2\n')
+
+        def parse_date(value):
+            return datetime.strptime(value, '%Y-%m-%d').date()
+
+        pages = TwoWaySyncSet.from_csv(path, 'url', 'last_modified', changekey_type=parse_date, block_size=2)
+        self.assertIsInstance(pages, TwoWaySyncSet)
+        self.assertEqual(sorted(pages.keys()), ['bar', 'foo'])
+        self.assertEqual(pages['foo'].changekey, date(2012, 2, 1))
+        self.assertIsNone(pages['foo'].row)
+        pages = OneWaySyncSet.from_csv(path, 0, 2, keep_row=True)
+        # The header row is a member when columns are given by index
+        self.assertEqual(pages['url'].changekey, 'title')
+        self.assertEqual(pages['foo'].row, ['foo', '2012-02-01', 'Foo2'])
+        with self.assertRaises(ValueError):
+            OneWaySyncSet.from_csv(path, 'url', 'etag')
+
+    def test_jsonl(self):
+        path = self._write('pages.jsonl', '{"url": "foo", "rev": 3}\n\n{"url": "bar", "rev": 1}\n'
+                                          '{"url": "foo", "rev": 2}\n')
+        pages = TwoWaySyncSet.from_jsonl(path, 'url', 'rev',
+                                         member_factory=lambda i, ck, row: TestMember(i, ck))
+        self.assertEqual(pages, TwoWaySyncSet([TestMember('foo', 3), TestMember('bar', 1)]))
+        pages = OneWaySyncSet.from_jsonl(path, 'url', 'rev')
+        self.assertEqual(pages['foo'].changekey, 2)
+
+    def test_cursor(self):
+        conn = sqlite3.connect(':memory:')
+        conn.execute('CREATE TABLE pages (url TEXT, rev INTEGER)')
+        conn.executemany('INSERT INTO pages VALUES (?, ?)', [('page%s' % i, i) for i in range(25)])
+        pages = OneWaySyncSet.from_cursor(conn.execute('SELECT url, rev FROM pages'), 'url', 'rev', block_size=10,
+                                          changekey_type=str)
+        self.assertEqual(len(pages), 25)
+        self.assertEqual(pages['page7'].changekey, '7')
+        conn.close()
+
+
+class ScanTreeTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.root = self.tmpdir.name
+        for path in ('a.txt', 'b.py', 'src/c.py', 'src/deep/d.py', 'build/e.py', 'src/build.txt'):
+            self._write(path, path)
+        os.symlink(os.path.join(self.root, 'a.txt'), os.path.join(self.root, 'link.txt'))
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _write(self, path, data):
+        full_path = os.path.join(self.root, *path.split('/'))
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        with open(full_path, 'w') as f:
+            f.write(data)
+
+    def test_scan(self):
+        files = scan_tree(self.root, workers=3)
+        self.assertIsInstance(files, OneWaySyncSet)
+        self.assertEqual(sorted(files.keys()),
+                         ['a.txt', 'b.py', 'build/e.py', 'src/build.txt', 'src/c.py', 'src/deep/d.py'])
+        st = os.stat(os.path.join(self.root, 'src', 'c.py'))
+        member = files['src/c.py']
+        self.assertEqual(member.changekey, (st.st_mtime_ns, 8))
+        self.assertEqual((member.size, member.inode), (8, st.st_ino))
+        inode_files = scan_tree(self.root, syncset_class=TwoWaySyncSet, changekey='inode')
+        self.assertIsInstance(inode_files, TwoWaySyncSet)
+        self.assertEqual(inode_files['b.py'].changekey[0], os.stat(os.path.join(self.root, 'b.py')).st_ino)
+
+    def test_filters(self):
+        files = scan_tree(self.root, include=['*.py'], exclude=['build', '*/deep'])
+        self.assertEqual(sorted(files.keys()), ['b.py', 'src/c.py'])
+        # Patterns also match the name of entries below the root
+        files = scan_tree(self.root, include=['d.py', 'a.*'])
+        self.assertEqual(sorted(files.keys()), ['a.txt', 'src/deep/d.py'])
+        self.assertEqual(sorted(scan_tree(self.root, exclude=['deep', 'build*']).keys()), ['a.txt', 'b.py', 'src/c.py'])
+
+    def test_batches(self):
+        for i in range(30):
+            self._write('many/%s/%s/f.txt' % (i % 4, i), '')
+        expected = sorted(
+            os.path.relpath(os.path.join(path, name), self.root).replace(os.sep, '/')
+            for path, _, names in os.walk(self.root) for name in names if name != 'link.txt'
+        )
+        # Workers hand back the directories left after a batch
+        with mock.patch('syncset.fsscan.BATCH_SIZE', 3):
+            for workers in (1, 4):
+                self.assertEqual(sorted(scan_tree(self.root, workers=workers).keys()), expected)
+
+    def test_diff(self):
+        before = scan_tree(self.root)
+        self._write('src/c.py', 'changed')
+        self._write('new.txt', '')
+        os.remove(os.path.join(self.root, 'b.py'))
+        only_in_before, only_in_after, outdated, updated = before.diff(scan_tree(self.root))
+        self.assertEqual(list(only_in_before.keys()), ['b.py'])
+        self.assertEqual(list(only_in_after.keys()), ['new.txt'])
+        self.assertEqual(list(updated.keys()), ['src/c.py'])
+
+
+class HashCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.root = os.path.join(self.tmpdir.name, 'tree')
+        self.cache_path = os.path.join(self.tmpdir.name, 'hashes.db')
+        for path in ('a.txt', 'b.py', 'src/c.py', 'empty.txt'):
+            self._write(path, '' if path == 'empty.txt' else path)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _write(self, path, data):
+        full_path = os.path.join(self.root, *path.split('/'))
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        with open(full_path, 'w') as f:
+            f.write(data)
+
+    def _test_cache(self, workers):
+        with HashCache(self.cache_path, workers=workers) as cache:
+            hashed = cache.apply(self.root, scan_tree(self.root))
+            self.assertIsInstance(hashed, OneWaySyncSet)
+            self.assertEqual(hashed['a.txt'].changekey, hashlib.sha256(b'a.txt').hexdigest())
+            self.assertEqual(hashed['empty.txt'].changekey, hashlib.sha256(b'').hexdigest())
+            self.assertEqual(hashed['src/c.py'].size, 8)
+            self.assertEqual((cache.hits, cache.misses), (0, 4))
+            # Only changed files are hashed again
+            self._write('src/c.py', 'changed')
+            hashed = cache.apply(self.root, scan_tree(self.root))
+            self.assertEqual((cache.hits, cache.misses), (3, 5))
+            self.assertEqual(hashed['src/c.py'].changekey, hashlib.sha256(b'changed').hexdigest())
+        with HashCache(self.cache_path, workers=workers) as cache:
+            # The cache is persistent, and entries for deleted files are evicted
+            os.remove(os.path.join(self.root, 'b.py'))
+            hashed = cache.apply(self.root, scan_tree(self.root))
+            self.assertEqual((cache.hits, cache.misses), (3, 0))
+            self.assertEqual(len(cache), 3)
+            self.assertEqual(sorted(hashed.keys()), ['a.txt', 'empty.txt', 'src/c.py'])
+
+    def test_cache(self):
+        self._test_cache(workers=0)
+
+    def test_cache_processes(self):
+        self._test_cache(workers=2)
+
+
+def _run_async(coro):
+    # asyncio.run() needs Python 3.7
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+
+
+class _StubHTTPHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def log_message(self, *args):
+        pass
+
+    def _respond(self, send_body):
+        self.server.requests.append((self.command, self.path))
+        resource = self.server.resources.get(self.path)
+        if resource is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        last_modified, etag, body = resource
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Last-Modified', format_datetime(last_modified, usegmt=True))
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+
+    def do_HEAD(self):
+        self._respond(send_body=False)
+
+    def do_GET(self):
+        self._respond(send_body=True)
+
+
+class HTTPAdapterTest(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), _StubHTTPHandler)
+        self.server.daemon_threads = True
+        self.server.connections = 0
+        self.server.requests = []
+        self.server.resources = {
+            '/page/%s' % i: (datetime(2020, 1, 1 + i, tzinfo=timezone.utc), '"v1-%s"' % i, b'body %d' % i)
+            for i in range(10)
+        }
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base_url = 'http://127.0.0.1:%s' % self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _urls(self, n):
+        return ['%s/page/%s' % (self.base_url, i) for i in range(n)]
+
+    def test_master(self):
+        async def run():
+            async with HTTPAdapter(per_host=2) as http:
+                master = await http.master(self._urls(10) + [self.base_url + '/missing'])
+                return http, master
+
+        http, master = _run_async(run())
+        self.assertIsInstance(master, OneWaySyncSet)
+        self.assertEqual(len(master), 10)
+        page = master[self.base_url + '/page/3']
+        self.assertEqual(page.etag, '"v1-3"')
+        self.assertEqual(page.last_modified, datetime(2020, 1, 4, tzinfo=timezone.utc))
+        self.assertIsNone(page.body)
+        self.assertEqual(http.failed, {self.base_url + '/missing': 404})
+        # Requests are spread over at most per_host keep-alive connections
+        self.assertEqual(http.requests, 11)
+        self.assertLessEqual(self.server.connections, 2)
+        self.assertEqual({method for method, _ in self.server.requests}, {'HEAD'})
+
+    def test_sync(self):
+        async def run(local, urls):
+            async with HTTPAdapter(concurrency=4) as http:
+                return await http.sync(local, urls)
+
+        _, local, _, _ = _run_async(run(OneWaySyncSet(), self._urls(5)))
+        self.assertEqual(local[self.base_url + '/page/1'].body, b'body 1')
+        local = OneWaySyncSet(local)
+        # Update one page and add another
+        self.server.resources['/page/2'] = (datetime(2021, 1, 1, tzinfo=timezone.utc), '"v2-2"', b'new body')
+        self.server.requests = []
+        only_in_self, only_in_master, outdated_in_self, updated_in_master = _run_async(run(local, self._urls(6)))
+        self.assertEqual(len(only_in_self), 0)
+        self.assertEqual(list(only_in_master.keys()), [self.base_url + '/page/5'])
+        self.assertEqual(list(outdated_in_self.keys()), [self.base_url + '/page/2'])
+        self.assertEqual(updated_in_master[self.base_url + '/page/2'].body, b'new body')
+        # Bodies are only fetched for new and updated pages
+        self.assertEqual(sorted(path for method, path in self.server.requests if method == 'GET'),
+                         ['/page/2', '/page/5'])
+
+    def test_busy_host(self):
+        class SlowHandler(_StubHTTPHandler):
+            def do_HEAD(self):
+                time.sleep(0.2)
+                super().do_HEAD()
+
+        slow_server = ThreadingHTTPServer(('127.0.0.1', 0), SlowHandler)
+        slow_server.daemon_threads = True
+        slow_server.connections = 0
+        slow_server.requests = []
+        slow_server.resources = self.server.resources
+        threading.Thread(target=slow_server.serve_forever, daemon=True).start()
+        slow_url = 'http://127.0.0.1:%s/page/0' % slow_server.server_address[1]
+        self.addCleanup(slow_server.server_close)
+        self.addCleanup(slow_server.shutdown)
+
+        async def run():
+            async with HTTPAdapter(concurrency=2, per_host=1) as http:
+                urls = [slow_url] * 3 + [self.base_url + '/page/0']
+                return [member.get_id() async for member in http.iter_members(urls)]
+
+        # Requests queued for the busy host must not hold the global slots
+        self.assertEqual(_run_async(run())[0], self.base_url + '/page/0')
+
+    def test_timeout(self):
+        # A server which accepts connections but never responds
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        sock.listen(1)
+        self.addCleanup(sock.close)
+        url = 'http://127.0.0.1:%s/page/0' % sock.getsockname()[1]
+
+        async def run():
+            async with HTTPAdapter(timeout=0.2) as http:
+                return http, await http.master([url])
+
+        http, master = _run_async(run())
+        self.assertEqual(len(master), 0)
+        self.assertIsInstance(http.failed[url], asyncio.TimeoutError)
+
+
+class IngestBufferTest(unittest.TestCase):
+    def test_coalesce_two_way(self):
+        s = TwoWaySyncSet([TestMember('a', 5), TestMember('b', 1)])
+        s.tombstones = Tombstones()
+        buffer = IngestBuffer(s, flush_size=100)
+        for changekey in (6, 8, 7):
+            buffer.upsert(TestMember('a', changekey))
+        buffer.upsert(TestMember('b', 2))
+        buffer.delete('b', 2)
+        buffer.upsert(TestMember('b', 2))
+        buffer.upsert(TestMember('c', 1))
+        buffer.delete('c', 0)
+        with self.assertRaises(ValueError):
+            buffer.delete('c')
+        self.assertEqual(len(buffer), 3)
+        self.assertEqual(len(s), 2)
+        self.assertEqual(buffer.flush(), 3)
+        self.assertEqual(s['a'].changekey, 8)
+        self.assertNotIn('b', s.keys())
+        self.assertTrue(s.is_tombstoned(TestMember('b', 2)))
+        self.assertEqual(s['c'].changekey, 1)
+        self.assertEqual((buffer.events_in, buffer.coalesced, buffer.applied, buffer.flushes), (8, 5, 3, 1))
+        self.assertEqual(buffer.flush(), 0)
+        self.assertEqual(buffer.flushes, 1)
+
+    def test_coalesce_one_way(self):
+        s = OneWaySyncSet([TestMember('a', 5), TestMember('b', 1)])
+        with IngestBuffer(s, flush_size=2) as buffer:
+            buffer.upsert(TestMember('a', 8))
+            buffer.upsert(TestMember('a', 3))
+            self.assertEqual(s['a'].changekey, 5)
+            # Reaching flush_size flushes
+            buffer.delete('b')
+            self.assertEqual(len(buffer), 0)
+            self.assertEqual(s, OneWaySyncSet([TestMember('a', 3)]))
+            buffer.upsert(TestMember('c', 1))
+        # Closing flushes the rest
+        self.assertEqual(s, OneWaySyncSet([TestMember('a', 3), TestMember('c', 1)]))
+        self.assertEqual((buffer.events_in, buffer.applied, buffer.flushes), (4, 3, 2))
+
+    def test_flush_interval(self):
+        now = [0]
+        s = TwoWaySyncSet()
+        buffer = IngestBuffer(s, flush_interval=10, clock=lambda: now[0])
+        buffer.upsert(TestMember('a', 1))
+        now[0] = 5
+        buffer.upsert(TestMember('b', 1))
+        self.assertEqual(len(s), 0)
+        now[0] = 10
+        buffer.upsert(TestMember('c', 1))
+        self.assertEqual(len(s), 3)
+        with self.assertRaises(ValueError):
+            IngestBuffer(s).start()
+
+    def test_background_flush(self):
+        s = ConcurrentTwoWaySyncSet()
+        buffer = IngestBuffer(s, flush_interval=0.01)
+        buffer.start()
+        try:
+            threads = [
+                threading.Thread(target=lambda n=n: [buffer.upsert(TestMember(i, n)) for i in range(100)])
+                for n in range(4)
+            ]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            for _ in range(200):
+                if not len(buffer):
+                    break
+                time.sleep(0.01)
+            self.assertEqual(len(buffer), 0)
+        finally:
+            buffer.close()
+        self.assertEqual(len(s), 100)
+        self.assertEqual({item.changekey for item in s.snapshot()}, {3})
+        self.assertEqual(buffer.events_in, 400)
+        self.assertEqual(buffer.applied + buffer.coalesced, 400)
+
+
+class SortedIdListTest(unittest.TestCase):
+    def test_sorted_id_list(self):
+        with mock.patch.object(SortedIdList, 'load', 4):
+            ids = SortedIdList([5, 1, 3])
+            for i in range(20, 5, -1):
+                ids.add(i)
+            ids.update([4, 2, 0])
+            ids.remove(20)
+            ids.discard(20)
+            with self.assertRaises(ValueError):
+                ids.remove(20)
+            self.assertEqual(list(ids), list(range(20)))
+            self.assertEqual(len(ids), 20)
+            self.assertGreater(len(ids._blocks), 2)
+            self.assertIn(7, ids)
+            self.assertNotIn(-1, ids)
+            self.assertEqual(list(ids.irange(3, 12)), list(range(3, 12)))
+            self.assertEqual(list(ids.irange(3, 12, inclusive=(False, True))), list(range(4, 13)))
+            self.assertEqual(list(ids.irange(hi=3)), [0, 1, 2])
+            self.assertEqual(list(ids.irange(17)), [17, 18, 19])
+            self.assertEqual(list(ids.irange(8, 3)), [])
+            self.assertEqual(list(ids.irange(12, 15, reverse=True)), [14, 13, 12])
+            ids.clear()
+            self.assertEqual(list(ids.irange(1, 2)), [])
+        paths = SortedIdList(['a/1', 'b', 'a/2', 'a', 'ab'])
+        self.assertEqual(list(paths.iprefix('a/')), ['a/1', 'a/2'])
+        self.assertEqual(list(SortedIdList([(1, 2), (2, 1), (1, 3)]).iprefix((1,))), [(1, 2), (1, 3)])
+
+
+class SliceDiffTest(unittest.TestCase):
+    def setUp(self):
+        self.a = TwoWaySyncSet(TestMember('%s/%s' % (tenant, i), 1) for tenant in 'xyz' for i in range(5))
+        self.b = TwoWaySyncSet(TestMember('%s/%s' % (tenant, i), 2 if i == 3 else 1)
+                               for tenant in 'xyz' for i in range(1, 6))
+
+    def test_slice(self):
+        self.assertEqual(sorted(self.a.slice(prefix='y/').keys()), ['y/%s' % i for i in range(5)])
+        self.assertEqual(sorted(self.a.slice(id_range=('x/3', 'y/1')).keys()), ['x/3', 'x/4', 'y/0'])
+        self.assertEqual(sorted(self.a.slice(id_range=(None, 'x/2')).keys()), ['x/0', 'x/1'])
+        self.assertEqual(sorted(self.a.slice(ids=['x/1', 'y/1', 'q'], prefix='x/').keys()), ['x/1'])
+        self.assertEqual(sorted(self.a.slice(prefix='z/', where=lambda m: m.uid > 'z/2').keys()), ['z/3', 'z/4'])
+        self.assertEqual(self.a.slice(), self.a)
+        self.a.tombstones = Tombstones()
+        self.assertIs(self.a.slice(prefix='x/').tombstones, self.a.tombstones)
+
+    def test_index_maintained(self):
+        self.assertEqual(len(self.a.slice(prefix='x/')), 5)
+        self.assertIsNotNone(self.a._id_index)
+        self.a.add(TestMember('x/9', 1))
+        self.a.discard(TestMember('x/0', 1))
+        self.a._add_many([TestMember('x/7', 1), TestMember('w', 1)])
+        self.a.pop()
+        self.assertEqual(list(self.a._id_index), sorted(self.a.keys()))
+        self.a.clear()
+        self.assertEqual(len(self.a._id_index), 0)
+
+    def test_diff_slice(self):
+        for kwargs in ({'prefix': 'y/'}, {'id_range': ('y/', 'z/')}, {'ids': ['y/%s' % i for i in range(6)]},
+                       {'where': lambda m: m.uid.startswith('y/')}):
+            only_in_a, only_in_b, newer_in_a, newer_in_b = self.a.diff(self.b, **kwargs)
+            self.assertEqual(list(only_in_a.keys()), ['y/0'])
+            self.assertEqual(list(only_in_b.keys()), ['y/5'])
+            self.assertEqual(len(newer_in_a), 0)
+            self.assertEqual(list(newer_in_b.keys()), ['y/3'])
+        one_way = OneWaySyncSet(self.a)
+        self.assertEqual([len(bucket) for bucket in one_way.diff(OneWaySyncSet(self.b), prefix='x/')],
+                         [1, 1, 1, 1])
+        concurrent = ConcurrentTwoWaySyncSet(self.a)
+        self.assertEqual([list(bucket.keys()) for bucket in concurrent.diff(self.b, id_range=('z/3', None))],
+                         [[], ['z/5'], [], ['z/3']])
+        self.assertEqual([list(bucket.keys()) for bucket in concurrent.snapshot().diff(self.b, prefix='z/4')],
+                         [[], [], [], []])
+
+
+class SortedSyncSetTest(unittest.TestCase):
+    def test_ordered_access(self):
+        s = SortedTwoWaySyncSet(TestMember(path, 1) for path in ('b/2', 'a/1', 'c', 'b/1', 'a/2', 'ab'))
+        s.add(TestMember('a/0', 1))
+        s.discard(TestMember('c', 1))
+        self.assertEqual([item.uid for item in s], ['a/0', 'a/1', 'a/2', 'ab', 'b/1', 'b/2'])
+        self.assertEqual([item.uid for item in reversed(s)], ['b/2', 'b/1', 'ab', 'a/2', 'a/1', 'a/0'])
+        self.assertEqual([item.uid for item in s.irange('a/1', 'b/1')], ['a/1', 'a/2', 'ab'])
+        self.assertEqual([item.uid for item in s.irange('ab', inclusive=(False, False))], ['b/1', 'b/2'])
+        self.assertEqual([item.uid for item in s.prefix('a/')], ['a/0', 'a/1', 'a/2'])
+        copy = s.copy()
+        self.assertIsInstance(copy, SortedTwoWaySyncSet)
+        self.assertEqual([item.uid for item in copy.prefix('b')], ['b/1', 'b/2'])
+        self.assertEqual(sorted(s.pop().uid for _ in range(len(s))), ['a/0', 'a/1', 'a/2', 'ab', 'b/1', 'b/2'])
+        self.assertEqual(list(s.irange()), [])
+
+    def test_merge_diff(self):
+        a_members = [TestMember(i, i % 3) for i in range(0, 60, 2)]
+        b_members = [TestMember(i, i % 4) for i in range(0, 60, 3)]
+        for plain_class, sorted_class in ((OneWaySyncSet, SortedOneWaySyncSet),
+                                          (TwoWaySyncSet, SortedTwoWaySyncSet)):
+            a, b = sorted_class(a_members), sorted_class(b_members)
+            plain_a, plain_b = plain_class(a_members), plain_class(b_members)
+            if plain_class is TwoWaySyncSet:
+                for items in (a, plain_a):
+                    items.tombstones = Tombstones()
+                    items.tombstones.add(3, 5)
+                for items in (b, plain_b):
+                    items.tombstones = Tombstones()
+                    items.tombstones.add(4, 5)
+            with mock.patch.object(plain_class, '_diff', wraps=plain_a._diff) as plain_diff:
+                result = a.diff(b)
+                self.assertFalse(plain_diff.called)
+            for bucket, expected in zip(result, plain_a.diff(plain_b)):
+                self.assertIsInstance(bucket, sorted_class)
+                self.assertEqual(bucket, expected)
+                self.assertEqual([item.uid for item in bucket], sorted(expected.keys()))
+            # Falls back to the hash-based diff against plain syncsets. Slices of sorted syncsets are merged, too.
+            self.assertEqual(a.diff(plain_b), plain_a.diff(plain_b))
+            self.assertEqual(a.diff(b, id_range=(10, 20)), plain_a.diff(plain_b, id_range=(10, 20)))
+
+
+class IndexTest(unittest.TestCase):
+    def _lookup(self, s, value):
+        return sorted(item.uid for item in s.lookup('body', value))
+
+    def test_index_maintained(self):
+        s = OneWaySyncSet([SlotsMember('a', 1, 'x'), SlotsMember('b', 1, 'x'), SlotsMember('c', 1, None)])
+        s.create_index('body', lambda m: m.body)
+        self.assertEqual(self._lookup(s, 'x'), ['a', 'b'])
+        self.assertEqual(s.lookup('body', None), [])
+        s.add(SlotsMember('a', 2, 'y'))
+        self.assertEqual(self._lookup(s, 'x'), ['b'])
+        self.assertEqual(self._lookup(s, 'y'), ['a'])
+        s.remove(SlotsMember('b', 1))
+        self.assertEqual(self._lookup(s, 'x'), [])
+        s |= [SlotsMember('d', 1, 'y')]
+        s -= [SlotsMember('a', 2)]
+        self.assertEqual(self._lookup(s, 'y'), ['d'])
+        s._add_many([SlotsMember('e', 1, 'z'), SlotsMember('f', 1, 'z')])
+        s &= [SlotsMember('d', 1), SlotsMember('e', 1), SlotsMember('f', 1)]
+        s ^= [SlotsMember('f', 1), SlotsMember('g', 1, 'z')]
+        self.assertEqual(self._lookup(s, 'z'), ['e', 'g'])
+        s.sync(deleted=[SlotsMember('e', 1)], updated=[], new=[SlotsMember('h', 1, 'y')])
+        self.assertEqual(self._lookup(s, 'y'), ['d', 'h'])
+        self.assertEqual(self._lookup(s, 'z'), ['g'])
+        popped = s.pop()
+        self.assertNotIn(popped.uid, self._lookup(s, popped.body))
+        s.clear()
+        self.assertEqual(s._indexes['body'].entries, {})
+        # Indexes are not copied
+        self.assertIsNone(s.copy()._indexes)
+        s.drop_index('body')
+        with self.assertRaises(KeyError):
+            s.lookup('body', 'x')
+        with self.assertRaises(KeyError):
+            s.drop_index('body')
+
+    def test_unique_index(self):
+        s = TwoWaySyncSet([SlotsMember('a', 1, 'x'), SlotsMember('b', 1, 'y')])
+        s.create_index('body', lambda m: m.body, unique=True)
+        with self.assertRaises(ValueError):
+            s.create_index('body', lambda m: m.body)
+        # Replacing a member with the same key is fine
+        s.add(SlotsMember('a', 2, 'x'))
+        with self.assertRaises(ValueError):
+            s.add(SlotsMember('a', 3, 'y'))
+        # The existing member is kept
+        self.assertEqual(s['a'].changekey, 2)
+        self.assertEqual(self._lookup(s, 'x'), ['a'])
+        with self.assertRaises(ValueError):
+            s._add_many([SlotsMember('c', 1, 'z'), SlotsMember('d', 1, 'z')])
+        self.assertNotIn('c', s.keys())
+        with self.assertRaises(ValueError):
+            TwoWaySyncSet([SlotsMember('a', 1, 'x'), SlotsMember('b', 1, 'x')]).create_index(
+                'body', lambda m: m.body, unique=True)
+
+    def test_move_detection(self):
+        before = OneWaySyncSet([SlotsMember('docs/a.txt', 1, 'hash-a'), SlotsMember('docs/b.txt', 1, 'hash-b')])
+        after = OneWaySyncSet([SlotsMember('archive/a.txt', 2, 'hash-a'), SlotsMember('docs/b.txt', 1, 'hash-b')])
+        only_before, only_after, _, _ = before.diff(after)
+        only_before.create_index('hash', lambda m: m.body)
+        moves = {old.uid: new.uid for new in only_after for old in only_before.lookup('hash', new.body)}
+        self.assertEqual(moves, {'docs/a.txt': 'archive/a.txt'})
+
+
+class IdOperationsTest(unittest.TestCase):
+    def setUp(self):
+        self.s = TwoWaySyncSet(SlotsMember(i, 1, 'even' if i % 2 == 0 else 'odd') for i in range(10))
+
+    def test_lookups(self):
+        self.assertEqual([m.uid if m else m for m in self.s.get_many([1, 11, 3])], [1, None, 3])
+        self.assertEqual(self.s.get_many([11], default=False), [False])
+        self.assertEqual(self.s.contains_ids([0, 10, 9]), [True, False, True])
+
+    def test_discard_ids(self):
+        self.s.create_index('parity', lambda m: m.body)
+        self.s._ordered_ids()
+        self.s.discard_ids(iter([0, 2, 2, 42]))
+        self.assertEqual(sorted(self.s.keys()), [1, 3, 4, 5, 6, 7, 8, 9])
+        self.assertEqual(len(self.s), 8)
+        self.assertEqual(sorted(m.uid for m in self.s.lookup('parity', 'even')), [4, 6, 8])
+        self.assertEqual(list(self.s._id_index), [1, 3, 4, 5, 6, 7, 8, 9])
+        with self.assertRaises(ValueError):
+            self.s.discard_ids([1], tombstone=True)
+        self.s.tombstones = Tombstones()
+        self.s.discard_ids([1], tombstone=True)
+        self.assertTrue(self.s.is_tombstoned(SlotsMember(1, 1)))
+
+    def test_remove_ids(self):
+        with self.assertRaises(KeyError):
+            self.s.remove_ids([1, 2, 42])
+        self.assertEqual(len(self.s), 10)
+        self.s.remove_ids([1, 2])
+        self.assertEqual(self.s.contains_ids([1, 2, 3]), [False, False, True])
+        concurrent = ConcurrentOneWaySyncSet(self.s)
+        snapshot = concurrent.snapshot()
+        concurrent.discard_ids([3, 42])
+        concurrent.remove_ids([4])
+        self.assertEqual(sorted(concurrent.keys()), [0, 5, 6, 7, 8, 9])
+        self.assertEqual(sorted(snapshot.keys()), [0, 3, 4, 5, 6, 7, 8, 9])
+        with self.assertRaises(TypeError):
+            snapshot.discard_ids([0])
+
+    def test_sync_with_ids(self):
+        self.s.sync(deleted=[0, SlotsMember(1, 1)], updated=[], new=[SlotsMember(10, 1)])
+        self.assertEqual(sorted(self.s.keys()), list(range(2, 11)))
+
+
+class BoundedSyncSetTest(unittest.TestCase):
+    def test_max_count(self):
+        evicted = []
+        s = BoundedOneWaySyncSet((TestMember(i, 1) for i in range(3)), max_count=3, on_evict=evicted.append)
+        self.assertIs(s[0], s.get(0))
+        s.add(TestMember(1, 2))
+        s.add(TestMember(3, 1))
+        # 2 is the least recently used
+        self.assertEqual([item.uid for item in evicted], [2])
+        self.assertEqual(sorted(s.keys()), [0, 1, 3])
+        self.assertIsNone(s.get(2))
+        with self.assertRaises(KeyError):
+            s[2]
+        s._add_many([TestMember(4, 1), TestMember(5, 1)])
+        self.assertEqual(sorted(s.keys()), [1, 3, 4, 5][-3:])
+        self.assertEqual((s.hits, s.misses, s.evictions), (2, 2, 3))
+        # Evicted members are absent in diffs
+        only_in_cache, only_in_master, _, _ = s.diff(OneWaySyncSet(TestMember(i, 1) for i in range(6)))
+        self.assertEqual(sorted(only_in_master.keys()), [0, 1, 2])
+        self.assertEqual(len(only_in_cache), 0)
+        s.discard_ids([3])
+        s.pop()
+        self.assertEqual(len(s._recency), 1)
+        s.clear()
+        self.assertEqual(len(s._recency), 0)
+
+    def test_diff_keeps_recency(self):
+        for bounded_class, plain_class in ((BoundedOneWaySyncSet, OneWaySyncSet),
+                                           (BoundedTwoWaySyncSet, TwoWaySyncSet)):
+            s = bounded_class((TestMember(i, 1) for i in range(5)), max_count=5)
+            master = plain_class(TestMember(i, i % 2 + 1) for i in range(2, 8))
+            recency = list(s._recency)
+            s.diff(master)
+            master.diff(s)
+            s.intersection(master)
+            master.intersection(s)
+            self.assertEqual(list(s._recency), recency)
+            self.assertEqual((s.hits, s.misses), (0, 0))
+            # The least recently added member is still the first to go
+            s.add(TestMember(8, 1))
+            self.assertNotIn(0, s.item_dict)
+
+    def test_touch_on_add(self):
+        s = BoundedTwoWaySyncSet([TestMember('a', 2), TestMember('b', 1)], max_count=2)
+        # The older member isn't added, but 'a' still counts as used
+        s.add(TestMember('a', 1))
+        s.add(TestMember('c', 1))
+        self.assertEqual(sorted(s.keys()), ['a', 'c'])
+        self.assertEqual(s['a'].changekey, 2)
+
+    def test_max_bytes(self):
+        s = BoundedOneWaySyncSet(max_bytes=100, size_func=lambda m: len(m.body or ''))
+        s.add(SlotsMember('a', 1, 'x' * 40))
+        s.add(SlotsMember('b', 1, 'x' * 40))
+        self.assertEqual(s.total_bytes, 80)
+        s.add(SlotsMember('a', 2, 'x' * 70))
+        self.assertEqual(sorted(s.keys()), ['a'])
+        self.assertEqual(s.total_bytes, 70)
+        # The newest member is kept even if it is too large
+        s.add(SlotsMember('c', 1, 'x' * 200))
+        self.assertEqual(sorted(s.keys()), ['c'])
+        self.assertGreater(approximate_size(SlotsMember('a', 1, 'x' * 1000)), 1000)
+        self.assertGreater(approximate_size(TestMember('a', 'x' * 1000)), 1000)
+        with self.assertRaises(ValueError):
+            BoundedOneWaySyncSet(max_count=0)
+
+
+class DiffIterTest(unittest.TestCase):
+    def test_same_as_diff(self):
+        for syncset_class in (OneWaySyncSet, TwoWaySyncSet, SortedOneWaySyncSet, ConcurrentTwoWaySyncSet):
+            mine = syncset_class(TestMember(i, i % 3) for i in range(20))
+            other = syncset_class(TestMember(i, i % 4) for i in range(10, 30))
+            result = mine.diff_iter(TestMember(i, i % 4) for i in range(10, 30))
+            self.assertEqual(result, mine.diff(other))
+            self.assertEqual(mine.diff_iter(iter(mine)), tuple(OneWaySyncSet() for _ in range(4)))
+
+    def test_repeated_ids(self):
+        mine = OneWaySyncSet([TestMember('a', 1), TestMember('b', 1)])
+        _, only_in_master, outdated, updated = mine.diff_iter(
+            [TestMember('a', 2), TestMember('a', 1), TestMember('c', 1), TestMember('c', 2)])
+        self.assertEqual((len(outdated), len(updated)), (0, 0))
+        self.assertEqual(only_in_master['c'].changekey, 2)
+        mine = TwoWaySyncSet([TestMember('a', 2), TestMember('b', 2)])
+        only_in_self, only_in_other, newer_in_self, newer_in_other = mine.diff_iter(
+            [TestMember('a', 3), TestMember('a', 1), TestMember('b', 2), TestMember('b', 1), TestMember('c', 2),
+             TestMember('c', 1)])
+        self.assertEqual(len(only_in_self), 0)
+        self.assertEqual(only_in_other['c'].changekey, 2)
+        self.assertEqual(len(newer_in_self), 0)
+        self.assertEqual(newer_in_other['a'].changekey, 3)
+
+    def test_tombstones(self):
+        mine = TwoWaySyncSet([TestMember('a', 1)])
+        mine.tombstones = Tombstones()
+        mine.remove(mine['a'], tombstone=True)
+        only_in_self, only_in_other, _, _ = mine.diff_iter([TestMember('a', 1), TestMember('b', 1)])
+        self.assertEqual(sorted(only_in_other.keys()), ['b'])
+
+
+class DiffCacheTest(unittest.TestCase):
+    def test_versions(self):
+        s = OneWaySyncSet([TestMember('a', 1)])
+        versions = [s.version]
+        for mutate in (lambda: s.add(TestMember('b', 1)), lambda: s.remove(s['b']), lambda: s.discard_ids(['a']),
+                       lambda: s.update([TestMember('c', 1)]), lambda: s.sync([], [], [TestMember('e', 1)]),
+                       lambda: s.__isub__([TestMember('c', 1)]), lambda: s._add_many([TestMember('d', 1)]),
+                       s.pop, s.clear):
+            mutate()
+            versions.append(s.version)
+        self.assertEqual(versions, sorted(set(versions)))
+        # Rejected adds and copies don't change the version
+        s = TwoWaySyncSet([TestMember('a', 2)])
+        version = s.version
+        s.add(TestMember('a', 1))
+        s.discard_ids(['b'])
+        s.copy()
+        self.assertEqual(s.version, version)
+        self.assertNotEqual(pickle.loads(pickle.dumps(s)).version, version)
+
+    def test_cache(self):
+        cache = DiffCache(maxsize=2)
+        mine = OneWaySyncSet(TestMember(i, 1) for i in range(5))
+        mine.diff_cache = cache
+        master = OneWaySyncSet(TestMember(i, 2) for i in range(3, 8))
+        with mock.patch.object(OneWaySyncSet, '_diff', side_effect=OneWaySyncSet._diff, autospec=True) as diff:
+            first = mine.diff(master)
+            second = mine.diff(master)
+            self.assertEqual(diff.call_count, 1)
+            self.assertEqual(first, second)
+            # Results are copies
+            second[0].clear()
+            self.assertEqual(len(mine.diff(master)[0]), 3)
+            self.assertEqual((cache.hits, cache.misses, cache.hit_rate), (2, 1, 2 / 3))
+            master.add(TestMember(9, 1))
+            self.assertEqual(len(mine.diff(master)[1]), 4)
+            self.assertEqual(diff.call_count, 2)
+            mine.diff(master, id_range=(0, 4))
+            self.assertEqual(diff.call_count, 3)
+            self.assertEqual(len(cache), 2)
+            cache.invalidate(master)
+            self.assertEqual(len(cache), 0)
+            mine.diff(master)
+            cache.clear()
+            mine.diff(master)
+            self.assertEqual(diff.call_count, 5)
+        with self.assertRaises(ValueError):
+            DiffCache(maxsize=0)
+
+    def test_not_cached(self):
+        cache = DiffCache()
+        mine = TwoWaySyncSet([TestMember('a', 1)])
+        mine.diff_cache = cache
+        mine.tombstones = Tombstones()
+        mine.diff(TwoWaySyncSet([TestMember('a', 2)]))
+        self.assertEqual((len(cache), cache.misses), (0, 0))
+
+    def test_concurrent(self):
+        s = ConcurrentOneWaySyncSet(TestMember(i, 1) for i in range(5))
+        s.diff_cache = DiffCache()
+        master = OneWaySyncSet(TestMember(i, 2) for i in range(3))
+        s.diff(master)
+        s.diff(master)
+        self.assertEqual((s.diff_cache.hits, s.diff_cache.misses), (1, 1))
+        s.add(TestMember(9, 1))
+        self.assertEqual(len(s.diff(master)[0]), 3)
+        self.assertEqual(s.diff_cache.misses, 2)
+
+
+@unittest.skipIf(ShardedSyncSet is None, 'multiprocessing.shared_memory needs Python 3.8')
+class ShardedSyncSetTest(unittest.TestCase):
+    def _test_routing(self, processes):
+        a1, b1, b2 = TestMember('a', 1), TestMember('b', 1), TestMember('b', 2)
+        with ShardedSyncSet([a1, b1], shards=3, syncset_class=OneWaySyncSet, processes=processes) as s:
+            self.assertEqual(len(s), 2)
+            self.assertIn(a1, s)
+            self.assertNotIn(b2, s)
+            self.assertTrue(s.contains_similar(b2))
+            self.assertEqual(s['a'], a1)
+            self.assertIsNone(s.get('c'))
+            with self.assertRaises(KeyError):
+                s['c']
+            s.add(b2)
+            self.assertEqual(s['b'].changekey, 2)
+            s.discard(a1)
+            self.assertEqual(sorted(s.keys()), ['b'])
+            self.assertEqual(list(s), [b2])
+            # Errors in a shard are raised in the caller
+            with self.assertRaises(KeyError):
+                s.remove(a1)
+            s.clear()
+            self.assertEqual(len(s), 0)
+
+    def test_routing(self):
+        self._test_routing(processes=False)
+        self._test_routing(processes=True)
+        # The shard of an id must not depend on the process
+        self.assertEqual(stable_hash('a'), stable_hash('a'))
+        self.assertNotEqual(stable_hash('a'), stable_hash('b'))
+
+    def _test_diff(self, syncset_class, processes):
+        mine = [TestMember('item%s' % i, 1) for i in range(0, 40)]
+        theirs = [TestMember('item%s' % i, 1 + i % 3) for i in range(10, 50)]
+        theirs += [TestMember('item%s' % i, 0) for i in range(0, 5)]
+        expected = syncset_class(mine).diff(syncset_class(theirs))
+        with ShardedSyncSet(mine, shards=3, syncset_class=syncset_class, processes=processes) as a, \
+                ShardedSyncSet(theirs, shards=3, syncset_class=syncset_class, processes=processes) as b:
+            result = a.diff(b)
+            for bucket, expected_bucket in zip(result, expected):
+                self.assertIsInstance(bucket, syncset_class)
+                self.assertEqual(bucket, expected_bucket)
+            # Diffing again after a mutation must see the new contents
+            a.add(TestMember('item49', 3))
+            self.assertNotIn(TestMember('item49', 3), a.diff(b)[1])
+
+    def test_diff(self):
+        self._test_diff(OneWaySyncSet, processes=False)
+        self._test_diff(TwoWaySyncSet, processes=False)
+        self._test_diff(OneWaySyncSet, processes=True)
+        self._test_diff(TwoWaySyncSet, processes=True)
+
+    def test_diff_layout(self):
+        with ShardedSyncSet(shards=2, processes=False) as a, ShardedSyncSet(shards=3, processes=False) as b:
+            with self.assertRaises(ValueError):
+                a.diff(b)
+            with self.assertRaises(ValueError):
+                a.diff(TwoWaySyncSet())
+
+
+class ConcurrentSyncSetTest(unittest.TestCase):
+    def test_add_if_newer(self):
+        s = ConcurrentTwoWaySyncSet()
+        self.assertTrue(s.add_if_newer(TestMember('a', 2)))
+        self.assertFalse(s.add_if_newer(TestMember('a', 1)))
+        self.assertFalse(s.add_if_newer(TestMember('a', 2)))
+        self.assertTrue(s.add_if_newer(TestMember('a', 3)))
+        self.assertEqual(s['a'].changekey, 3)
+
+    def test_in_place_operators(self):
+        s = ConcurrentOneWaySyncSet(stripes=4)
+        stop = threading.Event()
+        errors = []
+
+        def writer():
+            try:
+                while not stop.is_set():
+                    for i in range(0, 200, 2):
+                        s.discard(TestMember(i, 0))
+                        s.add(TestMember(i, 0))
+            except Exception as e:
+                errors.append(e)
+
+        thread = threading.Thread(target=writer)
+        thread.start()
+        try:
+            for _ in range(20):
+                s.update(TestMember(i, 0) for i in range(200))
+                s.intersection_update([TestMember(i, 0) for i in range(100)])
+                s.difference_update([TestMember(i, 0) for i in range(0, 50, 3)])
+                s.symmetric_difference_update(ConcurrentOneWaySyncSet(TestMember(i, 0) for i in range(50, 150)))
+        finally:
+            stop.set()
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(s.item_dict), set.__len__(s))
+        self.assertEqual(set(s.item_dict.values()), set(set.__iter__(s)))
+
+    def _run_writers(self, writer, n=4):
+        errors = []
+
+        def run(offset):
+            try:
+                writer(offset)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=run, args=(offset,)) for offset in range(n)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+
+    def test_ordered_index(self):
+        class SlowId(int):
+            # Switch threads in the middle of index updates
+            def __lt__(self, other):
+                time.sleep(0)
+                return int(self) < int(other)
+
+        s = ConcurrentOneWaySyncSet((TestMember(SlowId(i), 0) for i in range(0, 400, 2)), stripes=8)
+        # Builds the ordered id index, which is then maintained by all writers
+        self.assertEqual(len(s.slice(id_range=(0, 100))), 50)
+
+        def writer(offset):
+            for i in range(offset, 400, 4):
+                s.add(TestMember(SlowId(i), 1))
+                s.discard(TestMember(SlowId(i + 2), 0))
+
+        self._run_writers(writer)
+        self.assertEqual(list(s._id_index), sorted(s.item_dict))
+
+    def test_unique_index(self):
+        def key_func(item):
+            # Switch threads between checking and updating the index
+            time.sleep(0)
+            return item.changekey
+
+        for _ in range(3):
+            s = ConcurrentOneWaySyncSet(stripes=8)
+            s.create_index('key', key_func, unique=True)
+
+            def writer(offset):
+                for i in range(200):
+                    try:
+                        s.add(TestMember((offset, i), i))
+                    except ValueError:
+                        pass
+                for i in range(0, 200, 2):
+                    s.discard(TestMember((offset, i), i))
+
+            self._run_writers(writer)
+            keys = [item.changekey for item in s.item_dict.values()]
+            self.assertEqual(len(keys), len(set(keys)))
+            self.assertEqual(sorted(s.lookup('key', key)[0].uid for key in keys), sorted(s.item_dict))
+
+    def test_concurrent_writers(self):
+        s = ConcurrentTwoWaySyncSet(stripes=4)
+
+        def writer(offset):
+            for changekey in range(200):
+                for i in range(20):
+                    s.add(TestMember(i, (changekey + offset) % 200))
+                    if changekey % 7 == 0:
+                        s.discard(TestMember(i + 20, 0))
+                        s.add(TestMember(i + 20, changekey))
+
+        threads = [threading.Thread(target=writer, args=(n,)) for n in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        # item_dict and the underlying set must still agree
+        self.assertEqual(len(s.item_dict), set.__len__(s))
+        self.assertEqual(set(s.item_dict.values()), set(set.__iter__(s)))
+        for i in range(20):
+            self.assertEqual(s[i].changekey, 199)
+
+    def test_snapshot_and_diff(self):
+        a1, a2, b1 = TestMember('a', 1), TestMember('a', 2), TestMember('b', 1)
+        s = ConcurrentOneWaySyncSet([a1, b1])
+        snapshot = s.snapshot()
+        s.add(a2)
+        self.assertIsInstance(snapshot, OneWaySyncSet)
+        self.assertNotIsInstance(snapshot, ConcurrentOneWaySyncSet)
+        self.assertIn(a1, snapshot)
+        self.assertIn(a2, s)
+        only_in_self, only_in_master, outdated_in_self, updated_in_master = snapshot.diff(s)
+        self.assertEqual(outdated_in_self, OneWaySyncSet([a1]))
+        self.assertEqual(updated_in_master, OneWaySyncSet([a2]))
+        self.assertEqual(s.diff(ConcurrentOneWaySyncSet([a2])),
+                         (OneWaySyncSet([b1]), OneWaySyncSet(), OneWaySyncSet(), OneWaySyncSet()))
+        self.assertIsInstance(s.copy(), ConcurrentOneWaySyncSet)
+        self.assertIn(s.pop(), (a2, b1))
+        s.clear()
+        self.assertEqual(len(s), 0)
+
+    def test_snapshot_versions(self):
+        a1, a2, b1, c1 = TestMember('a', 1), TestMember('a', 2), TestMember('b', 1), TestMember('c', 1)
+        s = ConcurrentTwoWaySyncSet([a1, b1])
+        first = s.snapshot()
+        self.assertIs(s.snapshot()._log, first._log)
+        s.add(a2)
+        s.remove(b1)
+        second = s.snapshot()
+        self.assertEqual(second._log.version, first._log.version + 1)
+        self.assertGreater(second.version, first.version)
+        s.add(c1)
+        s.clear()
+        # Point lookups before the snapshots are materialized
+        self.assertIs(first['a'], a1)
+        self.assertIn(b1, first)
+        self.assertIsNone(first.get('c'))
+        self.assertIs(second.get('a'), a2)
+        self.assertFalse(second.contains_similar(b1))
+        self.assertEqual(first, TwoWaySyncSet([a1, b1]))
+        self.assertEqual(second, TwoWaySyncSet([a2]))
+        self.assertEqual(len(s), 0)
+        # Snapshots are read-only, but copies and diff results are not
+        self.assertIsInstance(first, TwoWaySyncSet)
+        for method, args in (('add', [c1]), ('remove', [a1]), ('discard', [a1]), ('pop', []), ('clear', []),
+                             ('update', [[c1]])):
+            with self.assertRaises(TypeError):
+                getattr(first, method)(*args)
+        copy = first.copy()
+        self.assertIs(type(copy), TwoWaySyncSet)
+        copy.add(c1)
+        _, _, _, newer_in_other = first.diff(second)
+        self.assertIs(type(newer_in_other), TwoWaySyncSet)
+        self.assertEqual(newer_in_other, TwoWaySyncSet([a2]))
+        # The version logs are released when the last snapshot is gone, and writers stop saving
+        # pre-images
+        del first, second, copy
+        gc.collect()
+        self.assertIsNone(s._log_ref())
+        s.add(a1)
+
+    def test_snapshot_while_writing(self):
+        s = ConcurrentTwoWaySyncSet((TestMember(i, 0) for i in range(100)), stripes=4)
+        done = threading.Event()
+
+        def writer(offset):
+            changekey = 0
+            while not done.is_set():
+                changekey += 1
+                for i in range(offset, 100, 4):
+                    s.add(TestMember(i, changekey))
+
+        threads = [threading.Thread(target=writer, args=(n,)) for n in range(4)]
+        for t in threads:
+            t.start()
+        try:
+            for _ in range(20):
+                snapshot = s.snapshot()
+                before = {i: snapshot[i].changekey for i in range(100)}
+                # Materializing later gives the same members as the point lookups
+                self.assertEqual({item.uid: item.changekey for item in snapshot}, before)
+        finally:
+            done.set()
+            for t in threads:
+                t.join()
+
+
 if __name__ == '__main__':
     unittest.main()